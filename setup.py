@@ -21,6 +21,9 @@ setup(
         'sleekxmpp',
         'sqlalchemy',
     ],
+    extras_require={
+        'asyncio': ['slixmpp'],
+    },
     tests_require=[
         'coverage',
         'hypothesis',
@@ -0,0 +1,109 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark for the commit throughput of database engine settings.
+
+Compares the default engine settings with the tuned settings EcheLOn
+uses, by committing small transactions like the ones EcheLOn does
+when players join or games get reported. Without a database URL a
+temporary SQLite database gets used for each variant.
+
+Run with `python3 -m tests.benchmarks.bench_engine`.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from tests.benchmarks.timing import measure
+from xpartamupp.echelon import get_engine_options
+from xpartamupp.lobby_ranking import Base, Player, configure_engine
+
+
+def bench_commits(engine, commits):
+    """Measure the throughput of small committed transactions.
+
+    Arguments:
+        engine (sqlalchemy.engine.Engine): Engine to use
+        commits (int): Number of transactions to commit
+
+    Returns:
+        dict with the results of the benchmark
+
+    """
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    counter = iter(range(commits))
+
+    def commit():
+        session.add(Player(jid='bench%i@lobby.wildfiregames.com' % next(counter), rating=-1))
+        session.commit()
+
+    try:
+        return measure(commit, commits)
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def run(commits, db_url=None):
+    """Compare the commit throughput of default and tuned settings.
+
+    Arguments:
+        commits (int): Number of transactions to commit per variant
+        db_url (str): URL of the database to use, a temporary SQLite
+            database if None
+
+    Returns:
+        dict with the results for both variants
+
+    """
+    results = {}
+    for variant in ('default', 'tuned'):
+        with tempfile.TemporaryDirectory() as directory:
+            url = db_url or 'sqlite:///%s' % os.path.join(directory, 'bench.sqlite3')
+            if variant == 'default':
+                engine = create_engine(url)
+            else:
+                engine = create_engine(url, **get_engine_options(url))
+                configure_engine(engine)
+            results[variant] = bench_commits(engine, commits)
+            if db_url:
+                with engine.begin() as connection:
+                    connection.execute(Player.__table__.delete().where(
+                        Player.jid.like('bench%@lobby.wildfiregames.com')))
+    return results
+
+
+def main():
+    """Entry point for running the benchmark."""
+    parser = argparse.ArgumentParser(description="Benchmark commit throughput")
+    parser.add_argument('--commits', type=int, default=500,
+                        help="number of transactions to commit per variant")
+    parser.add_argument('--database-url',
+                        help="URL of the database to use instead of a temporary SQLite database")
+    args = parser.parse_args(sys.argv[1:])
+    print(json.dumps(run(args.commits, args.database_url), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmarks for the construction of stanzas.
+
+Run with `python3 -m tests.benchmarks.bench_stanzas`.
+"""
+
+import argparse
+import json
+import sys
+
+from tests.benchmarks.timing import measure
+from xpartamupp.stanzas import BoardListXmppPlugin, GameListXmppPlugin
+
+
+def make_board(size):
+    """Create the data of a leaderboard.
+
+    Arguments:
+        size (int): Number of players on the leaderboard
+
+    Returns:
+        list with tuples of player name and rating
+
+    """
+    return [('player%i' % i, 2000 - i) for i in range(size)]
+
+
+def make_games(size):
+    """Create the data of a list of games.
+
+    Arguments:
+        size (int): Number of games
+
+    Returns:
+        list with dicts containing the game data as 0ad sends it
+
+    """
+    return [{'name': 'Game %i' % i, 'ip': '192.0.2.%i' % (i % 256), 'port': '20595',
+             'stunIP': '', 'stunPort': '', 'mapName': 'Alpine Lakes',
+             'niceMapName': 'Alpine Lakes', 'mapSize': 'Normal', 'mapType': 'random',
+             'victoryCondition': 'conquest',
+             'nbp': '2', 'maxnbp': '4', 'players': 'player%i, player%i' % (i, i + 1),
+             'mods': 'mod,0.0.23,public,0.0.23', 'state': 'init', 'players-init': 'player%i' % i,
+             'nbp-init': '2'} for i in range(size)]
+
+
+def build_board(board):
+    """Build and serialize a leaderboard stanza.
+
+    Arguments:
+        board (list): Leaderboard data as returned by `make_board()`
+
+    """
+    stanza = BoardListXmppPlugin()
+    stanza.add_command('boardlist')
+    stanza.add_items(board)
+    str(stanza)
+
+
+def build_game_list(games):
+    """Build and serialize a game list stanza.
+
+    Arguments:
+        games (list): Game data as returned by `make_games()`
+
+    """
+    stanza = GameListXmppPlugin()
+    stanza.add_items(games)
+    str(stanza)
+
+
+def run(repeat, board_size=100, games_size=500):
+    """Run all stanza benchmarks.
+
+    Arguments:
+        repeat (int): Number of repetitions of each benchmark
+        board_size (int): Number of entries on the leaderboard
+        games_size (int): Number of games in the game list
+
+    Returns:
+        dict with the results of the benchmarks
+
+    """
+    board = make_board(board_size)
+    games = make_games(games_size)
+    return {
+        'board_%i' % board_size: measure(lambda: build_board(board), repeat),
+        'gamelist_%i' % games_size: measure(lambda: build_game_list(games), repeat),
+    }
+
+
+def main():
+    """Entry point for running the benchmarks."""
+    parser = argparse.ArgumentParser(description="Benchmark stanza construction")
+    parser.add_argument('--repeat', type=int, default=200,
+                        help="number of repetitions of each benchmark")
+    args = parser.parse_args(sys.argv[1:])
+    print(json.dumps(run(args.repeat), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
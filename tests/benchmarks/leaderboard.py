@@ -0,0 +1,523 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmarks for the leaderboard database.
+
+Contains a generator which fills a leaderboard database with a
+synthetic history of players and games, and a benchmark runner
+measuring the performance of the `Leaderboard` methods used by
+EcheLOn against such a database. Results are emitted as JSON, so
+they can be compared between runs and database backends.
+
+Generate a database and run the benchmarks with:
+
+    $ python3 -m tests.benchmarks.leaderboard generate --players 10000 --games 100000
+    $ python3 -m tests.benchmarks.leaderboard run
+
+A stress test lets multiple processes rate games of a small group of
+players at the same time, to verify that no rating updates get lost:
+
+    $ python3 -m tests.benchmarks.leaderboard stress --workers 4 --iterations 100
+
+The effect of the indexes added by the `upgrade` action of
+`lobby_ranking` can be measured by running the benchmarks without and
+with them:
+
+    $ python3 -m tests.benchmarks.leaderboard indexes
+
+The throughput of exporting a database and importing it into another
+one can be measured with:
+
+    $ python3 -m tests.benchmarks.leaderboard transfer --target-url sqlite:///copy.sqlite3
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from itertools import accumulate
+
+from sleekxmpp.jid import JID
+from sqlalchemy import create_engine, select
+
+from tests.benchmarks.timing import summarize
+from xpartamupp.echelon import LEADERBOARD_DEFAULT_RATING, RATING_CONFLICTS, Leaderboard
+from xpartamupp.lobby_ranking import (HOT_PATH_INDEXES, MATCH_HISTORY_INDEXES, Base, Game,
+                                      Player, PlayerInfo, configure_engine,
+                                      create_hot_path_indexes, create_match_history_indexes,
+                                      export_database, import_database)
+
+CIVS = ['athen', 'brit', 'cart', 'gaul', 'iber', 'kush', 'mace', 'maur', 'pers', 'ptol',
+        'rome', 'sele', 'spart']
+MAPS = ['Alpine Lakes', 'Mainland', 'Gulf of Bothnia', 'Acropolis Bay', 'Arcadia',
+        'Corinthian Isthmus', 'Cantabrian Highlands', 'Continent', 'Sahel', 'Persian Highlands']
+DOMAIN = 'lobby.wildfiregames.com'
+STATS = [column.name for column in PlayerInfo.__table__.columns
+         if column.name not in {'id', 'player_id', 'game_id', 'civs', 'teams', 'rating_change'}]
+
+
+def player_jid(index):
+    """Get the JID of a synthetic player.
+
+    Arguments:
+        index (int): Number of the player
+
+    Returns:
+        str with the bare JID of the player
+
+    """
+    return 'player%i@%s' % (index, DOMAIN)
+
+
+def generate_stats(rng, duration):
+    """Generate plausible statistics of a player in a game.
+
+    Values scale with the duration of the game and vary per player.
+
+    Arguments:
+        rng (random.Random): Random number generator to use
+        duration (int): Duration of the game in seconds
+
+    Returns:
+        dict with a value for each statistic
+
+    """
+    scale = duration / 60 * rng.lognormvariate(0, 0.5)
+    return {stat: int(rng.expovariate(1) * scale * 10) for stat in STATS}
+
+
+def generate(db_url, num_players, num_games, seed=0, chunk_size=1000):
+    """Fill a database with a synthetic history.
+
+    Ratings follow a normal distribution, the number of games per
+    player a long-tail distribution. Most games are 1v1s, but team
+    games with up to 8 players are generated as well.
+
+    Arguments:
+        db_url (str): URL of the database to fill
+        num_players (int): Number of players to create
+        num_games (int): Number of games to create
+        seed (int): Seed for the random number generator
+        chunk_size (int): Number of rows to insert at once
+
+    """
+    rng = random.Random(seed)
+    engine = create_engine(db_url)
+    Base.metadata.create_all(engine)
+
+    with engine.begin() as connection:
+        player_offset = connection.execute(
+            'SELECT COALESCE(MAX(id), 0) FROM players').scalar()
+        game_offset = connection.execute('SELECT COALESCE(MAX(id), 0) FROM games').scalar()
+
+    players = []
+    for index in range(1, num_players + 1):
+        rated = rng.random() < 0.6
+        rating = int(rng.normalvariate(1300, 200)) if rated else -1
+        highest_rating = rating + int(rng.expovariate(1 / 50)) if rated else None
+        players.append({'id': player_offset + index, 'jid': player_jid(player_offset + index),
+                        'rating': rating, 'highest_rating': highest_rating})
+    with engine.begin() as connection:
+        for start in range(0, len(players), chunk_size):
+            connection.execute(Player.__table__.insert(), players[start:start + chunk_size])
+
+    # Activity of players follows a long-tail distribution, so a few
+    # players take part in many games.
+    activity = list(accumulate(rng.paretovariate(1.2) for _ in players))
+    player_indexes = range(len(players))
+    games = []
+    player_infos = []
+    for index in range(1, num_games + 1):
+        num_game_players = rng.choices([2, 4, 6, 8], [80, 12, 5, 3])[0]
+        participants = set()
+        while len(participants) < min(num_game_players, len(players)):
+            participants.add(rng.choices(player_indexes, cum_weights=activity)[0])
+        participants = [players[participant]['id'] for participant in participants]
+        duration = int(rng.lognormvariate(7.3, 0.5))
+        game_id = game_offset + index
+        games.append({'id': game_id, 'map': rng.choice(MAPS), 'duration': duration,
+                      'teamsLocked': rng.random() < 0.5, 'matchID': '%016x' % rng.getrandbits(64),
+                      'winner_id': rng.choice(participants)})
+        for team, player_id in enumerate(participants):
+            player_info = generate_stats(rng, duration)
+            rating_change = rng.randint(1, 30) if len(participants) == 2 else None
+            if rating_change and player_id != games[-1]['winner_id']:
+                rating_change = -rating_change
+            player_info.update({'player_id': player_id, 'game_id': game_id,
+                                'civs': rng.choice(CIVS), 'teams': team % 2,
+                                'rating_change': rating_change})
+            player_infos.append(player_info)
+
+        if len(games) >= chunk_size or index == num_games:
+            with engine.begin() as connection:
+                connection.execute(Game.__table__.insert(), games)
+                connection.execute(PlayerInfo.__table__.insert(), player_infos)
+            games = []
+            player_infos = []
+
+
+def make_game_report(rng, jids):
+    """Create an expanded game report as passed to the leaderboard.
+
+    Arguments:
+        rng (random.Random): Random number generator to use
+        jids (list): JIDs of the players of the game
+
+    Returns:
+        dict with the game report
+
+    """
+    duration = int(rng.lognormvariate(7.3, 0.5))
+    winner = rng.choice(jids)
+    report = {'mapName': rng.choice(MAPS), 'timeElapsed': str(duration * 1000),
+              'teamsLocked': 'true', 'matchID': '%016x' % rng.getrandbits(64),
+              'playerStates': {jid: 'won' if jid == winner else 'defeated' for jid in jids},
+              'civs': {jid: rng.choice(CIVS) for jid in jids},
+              'teams': {jid: str(team % 2) for team, jid in enumerate(jids)}}
+    player_stats = {jid: generate_stats(rng, duration) for jid in jids}
+    for stat in STATS:
+        report[stat] = {jid: str(player_stats[jid][stat]) for jid in jids}
+    return report
+
+
+def measure_calls(func, arguments):
+    """Measure the duration of calls of a function.
+
+    Arguments:
+        func (callable): Function to call
+        arguments (list): Tuples of arguments to call the function
+            with, one call per tuple
+
+    Returns:
+        dict as returned by `summarize()`
+
+    """
+    durations = []
+    for args in arguments:
+        start = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+def run(db_url, iterations, online=200, seed=0):
+    """Run the benchmarks against a leaderboard database.
+
+    Arguments:
+        db_url (str): URL of the database to benchmark
+        iterations (int): Number of calls per benchmarked method
+        online (int): Number of online players passed to
+            `get_rating_list()`
+        seed (int): Seed for the random number generator
+
+    Returns:
+        dict with the results of the benchmarks
+
+    """
+    rng = random.Random(seed)
+    leaderboard = Leaderboard(db_url)
+    db = leaderboard.db
+    player_jids = [jid for jid, in db.query(Player.jid)]
+
+    def random_jid():
+        return JID(rng.choice(player_jids) + '/0ad')
+
+    results = {
+        'database': {'dialect': db.get_bind().dialect.name, 'players': len(player_jids),
+                     'games': db.query(Game).count(),
+                     'players_info': db.query(PlayerInfo).count()},
+        'get_profile': measure_calls(leaderboard.get_profile,
+                                     [(random_jid(),) for _ in range(iterations)]),
+        'get_board': measure_calls(leaderboard.get_board, [() for _ in range(iterations)]),
+    }
+
+    # Pages deep down the leaderboard should be as cheap as the first
+    # one, as they're retrieved by seeking to a rating and id.
+    cursors = db.query(Player.rating, Player.id).filter(Player.rating != -1).all()
+    if cursors:
+        results['get_board_page'] = measure_calls(
+            leaderboard.get_board, [(100, tuple(rng.choice(cursors))) for _ in range(iterations)])
+    results['get_board_around'] = measure_calls(leaderboard.get_board_around,
+                                                [(random_jid(),) for _ in range(iterations)])
+
+    # The same goes for pages deep down the match history of a player.
+    results['get_match_history'] = measure_calls(
+        leaderboard.get_match_history, [(random_jid(), 20) for _ in range(iterations)])
+    history = db.query(PlayerInfo.player_id, PlayerInfo.game_id).all()
+    if history:
+        players_by_id = dict(db.query(Player.id, Player.jid))
+        pages = [rng.choice(history) for _ in range(iterations)]
+        results['get_match_history_page'] = measure_calls(
+            leaderboard.get_match_history,
+            [(JID(players_by_id[player_id] + '/0ad'), 20, game_id)
+             for player_id, game_id in pages])
+
+    nicks = [{jid: jid.local for jid in (random_jid() for _ in range(online))}
+             for _ in range(iterations)]
+    results['get_rating_list'] = measure_calls(leaderboard.get_rating_list,
+                                               [(nick_list,) for nick_list in nicks])
+
+    # Every tenth player requested doesn't exist yet and gets created.
+    jids = [(JID('new%i-%016x@%s/0ad' % (i, rng.getrandbits(64), DOMAIN)),)
+            if i % 10 == 0 else (random_jid(),) for i in range(iterations)]
+    results['get_or_create_player'] = measure_calls(leaderboard.get_or_create_player, jids)
+
+    reports = [(make_game_report(rng, [jid.lower() for jid in rng.sample(player_jids, 2)]),)
+               for _ in range(iterations)]
+    results['add_and_rate_game'] = measure_calls(leaderboard.add_and_rate_game, reports)
+    return results
+
+
+def _rate_games(db_url, jids, games, seed):
+    """Rate games between random players of a group.
+
+    Runs in a worker process of `stress()`.
+
+    Arguments:
+        db_url (str): URL of the leaderboard database
+        jids (list): Bare JIDs of the players
+        games (int): Number of games to rate
+        seed (int): Seed for the random number generator
+
+    Returns:
+        tuple of a dict with the sum of the rating adjustments per
+        player and the number of retried rating updates
+
+    """
+    rng = random.Random(seed)
+    leaderboard = Leaderboard(db_url)
+    adjustments = Counter()
+    conflicts = RATING_CONFLICTS.samples()[0][2]
+
+    def record(jid, old_rating, new_rating):
+        if old_rating is not None:
+            if old_rating == -1:
+                old_rating = LEADERBOARD_DEFAULT_RATING
+            adjustments[jid.lower()] += new_rating - old_rating
+
+    leaderboard.write_listeners.append(record)
+    for _ in range(games):
+        leaderboard.add_and_rate_game(make_game_report(rng, rng.sample(jids, 2)))
+    return dict(adjustments), RATING_CONFLICTS.samples()[0][2] - conflicts
+
+
+def stress(db_url, workers, iterations, players=4, seed=0):
+    """Rate games concurrently from multiple processes.
+
+    All processes rate games between the same few players, so their
+    rating updates conflict frequently. Every rating adjustment which
+    got committed has to be reflected in the final ratings, otherwise
+    updates got lost.
+
+    Arguments:
+        db_url (str): URL of the leaderboard database, must be
+            accessible from multiple processes
+        workers (int): Number of processes rating games
+        iterations (int): Number of games rated per process
+        players (int): Number of players taking part in the games
+        seed (int): Seed for the random number generator
+
+    Returns:
+        dict with the number of rated games, retried rating updates
+        and lost updates
+
+    """
+    engine = create_engine(db_url)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        player_offset = connection.execute(
+            'SELECT COALESCE(MAX(id), 0) FROM players').scalar()
+        jids = [player_jid(player_offset + index) for index in range(1, players + 1)]
+        connection.execute(Player.__table__.insert(), [{'jid': jid, 'rating': -1}
+                                                       for jid in jids])
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.starmap(_rate_games, [(db_url, jids, iterations, seed + worker)
+                                             for worker in range(workers)])
+    duration = time.perf_counter() - start
+
+    adjustments = Counter()
+    for worker_adjustments, _ in results:
+        adjustments.update(worker_adjustments)
+
+    with engine.begin() as connection:
+        ratings = dict(connection.execute(select([Player.jid, Player.rating])
+                                          .where(Player.jid.in_(jids))).fetchall())
+    lost_updates = [jid for jid in jids
+                    if ratings[jid] != LEADERBOARD_DEFAULT_RATING + adjustments[jid]]
+    return {
+        'workers': workers,
+        'games': workers * iterations,
+        'games_per_second': round(workers * iterations / duration, 1),
+        'conflicts': sum(conflicts for _, conflicts in results),
+        'lost_updates': len(lost_updates),
+    }
+
+
+def compare_indexes(db_url, iterations, seed=0):
+    """Run the benchmarks without and with the hot path indexes.
+
+    The hot path and match history indexes get dropped, the
+    benchmarks run, and the indexes created again before running the
+    benchmarks a second time.
+
+    Arguments:
+        db_url (str): URL of the database to benchmark
+        iterations (int): Number of calls per benchmarked method
+        seed (int): Seed for the random number generator
+
+    Returns:
+        dict with the results of the benchmarks before and after
+        creating the indexes
+
+    """
+    engine = create_engine(db_url)
+    with engine.begin() as connection:
+        quote = connection.dialect.identifier_preparer.quote
+        for name, _, _ in HOT_PATH_INDEXES + MATCH_HISTORY_INDEXES:
+            connection.execute('DROP INDEX IF EXISTS %s' % quote(name))
+    results = {'before': run(db_url, iterations, seed=seed)}
+    with engine.begin() as connection:
+        create_hot_path_indexes(connection)
+        create_match_history_indexes(connection)
+    results['after'] = run(db_url, iterations, seed=seed)
+    return results
+
+
+def _measure_transfer(func, engine, path, chunk_size):
+    """Measure the throughput and memory use of an export or import.
+
+    Arguments:
+        func (callable): `export_database()` or `import_database()`
+        engine (sqlalchemy.engine.Engine): Engine to pass to `func`
+        path (str): Path of the exported file
+        chunk_size (int): Number of rows to transfer at once
+
+    Returns:
+        dict with the number of rows per second and the peak memory
+        allocated by Python in MiB
+
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    counts = func(engine, path, chunk_size)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows = sum(counts.values())
+    return {
+        'rows': rows,
+        'rows_per_second': round(rows / duration, 1) if duration else None,
+        'peak_memory_mib': round(peak / 2**20, 2),
+    }
+
+
+def transfer(db_url, target_url, chunk_size):
+    """Export a database and import it into another database.
+
+    The peak memory use should stay the same regardless of the size of
+    the database, as rows get streamed in chunks.
+
+    Arguments:
+        db_url (str): URL of the database to export
+        target_url (str): URL of an empty database to import into
+        chunk_size (int): Number of rows to transfer at once
+
+    Returns:
+        dict with the results of the export and import
+
+    """
+    source = create_engine(db_url)
+    configure_engine(source)
+    target = create_engine(target_url)
+    configure_engine(target)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'export.jsonl.gz')
+        results = {'export': _measure_transfer(export_database, source, path, chunk_size)}
+        results['file_size_mib'] = round(os.path.getsize(path) / 2**20, 2)
+        results['import'] = _measure_transfer(import_database, target, path, chunk_size)
+    return results
+
+
+def parse_args(args):
+    """Parse command line arguments.
+
+    Arguments:
+        args (dict): Raw command line arguments given to the script
+
+    Returns:
+         Parsed command line arguments
+
+    """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description="Benchmarks for the leaderboard database")
+    parser.add_argument('action', help="generate a synthetic database, run the benchmarks, "
+                                       "run them without and with indexes, rate games "
+                                       "concurrently from multiple processes or export and "
+                                       "import the database",
+                        choices=['generate', 'run', 'indexes', 'stress', 'transfer'])
+    parser.add_argument('--database-url', help="URL for the leaderboard database",
+                        default='sqlite:///lobby_rankings_benchmark.sqlite3')
+    parser.add_argument('--target-url', help="URL of an empty database to import into",
+                        default='sqlite:///lobby_rankings_benchmark_copy.sqlite3')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help="number of rows to export or import at once")
+    parser.add_argument('--players', type=int, default=10000,
+                        help="number of players to generate")
+    parser.add_argument('--games', type=int, default=100000, help="number of games to generate")
+    parser.add_argument('--iterations', type=int, default=500,
+                        help="number of calls per benchmarked method or games rated per worker")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="number of processes rating games in the stress test")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the random data")
+    parser.add_argument('--output', help="file to write the results to instead of stdout")
+    return parser.parse_args(args)
+
+
+def main():
+    """Entry point for the benchmark."""
+    args = parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.ERROR)
+    if args.action == 'generate':
+        generate(args.database_url, args.players, args.games, args.seed)
+    else:
+        if args.action == 'stress':
+            results = stress(args.database_url, args.workers, args.iterations, seed=args.seed)
+        elif args.action == 'indexes':
+            results = compare_indexes(args.database_url, args.iterations, seed=args.seed)
+        elif args.action == 'transfer':
+            results = transfer(args.database_url, args.target_url, args.chunk_size)
+        else:
+            results = run(args.database_url, args.iterations, seed=args.seed)
+        results = json.dumps(results, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as output:
+                output.write(results + '\n')
+        else:
+            print(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Synthetic load generator for XpartaMuPP.
+
+Runs XpartaMuPP against an in-process fake transport: the MUC roster
+is stubbed, sent stanzas are captured instead of written to a socket
+and time is provided by a virtual clock. A configurable workload of
+joins, leaves, game registrations and state changes gets replayed
+and the latency of the handlers as well as the amount of data sent
+per event is reported.
+
+Run with `python3 -m tests.benchmarks.lobby_load`.
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import random
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from unittest.mock import patch
+
+from sleekxmpp.jid import JID
+from sleekxmpp.xmlstream import ET
+
+from tests.benchmarks.timing import percentile
+from xpartamupp.xpartamupp import XpartaMuPP
+
+EVENT_TYPES = ('join', 'leave', 'register', 'changestate', 'unregister')
+
+
+class VirtualClock(object):
+    """Clock which only advances when told to.
+
+    Also replaces the scheduler of the bot, so scheduled callbacks
+    are executed when the virtual time passes their deadline.
+    """
+
+    def __init__(self, start=1500000000.0):
+        """Initialize the clock.
+
+        Arguments:
+            start (float): Initial UNIX timestamp of the clock
+
+        """
+        self.now = start
+        self.scheduled = []
+        self._counter = 0
+
+    def time(self):
+        """Return the current virtual time."""
+        return self.now
+
+    def schedule(self, name, seconds, callback, args=None,  # pylint: disable=too-many-arguments
+                 kwargs=None, repeat=False):
+        """Schedule a callback in virtual time.
+
+        Has the same signature as `sleekxmpp.ClientXMPP.schedule()`.
+        """
+        self._counter += 1
+        heapq.heappush(self.scheduled, (self.now + seconds, self._counter, name, seconds,
+                                        callback, args or (), kwargs or {}, repeat))
+
+    def advance(self, seconds):
+        """Advance the clock and run all callbacks which got due.
+
+        Arguments:
+            seconds (float): Number of seconds to advance the clock
+
+        """
+        target = self.now + seconds
+        while self.scheduled and self.scheduled[0][0] <= target:
+            due, _, name, interval, callback, args, kwargs, repeat = \
+                heapq.heappop(self.scheduled)
+            self.now = due
+            callback(*args, **kwargs)
+            if repeat:
+                self.schedule(name, interval, callback, args, kwargs, repeat)
+        self.now = target
+
+
+class FakeMUC(object):
+    """Stub of the XEP-0045 plugin holding the roster of rooms."""
+
+    def __init__(self):
+        """Initialize with empty rooms."""
+        self.rooms = defaultdict(dict)
+
+    def joinMUC(self, room, nick, **kwargs):  # pylint: disable=invalid-name,unused-argument
+        """Join a room."""
+        self.rooms[room][nick] = None
+
+    def getRoster(self, room):  # pylint: disable=invalid-name
+        """Get the nicks of all occupants of a room."""
+        return list(self.rooms[room])
+
+    def getJidProperty(self, room, nick, prop):  # pylint: disable=invalid-name
+        """Get a property of an occupant of a room."""
+        if prop != 'jid':
+            return None
+        return self.rooms[room].get(nick)
+
+
+class LoadTestXpartaMuPP(XpartaMuPP):
+    """XpartaMuPP which captures stanzas instead of sending them."""
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the bot with a fake transport."""
+        self.clock = VirtualClock()
+        super().__init__(*args, **kwargs)
+        self.plugin = {'xep_0045': FakeMUC()}
+        self.sent_stanzas = 0
+        self.sent_bytes = 0
+
+    def send_raw(self, data, now=False, reconnect=None):
+        """Capture data instead of sending it."""
+        self.sent_stanzas += 1
+        self.sent_bytes += len(data.encode('utf-8'))
+
+    def schedule(self, name, seconds, callback, args=None,  # pylint: disable=too-many-arguments
+                 kwargs=None, repeat=False):
+        """Schedule callbacks in virtual time."""
+        self.clock.schedule(name, seconds, callback, args, kwargs, repeat)
+
+
+class LobbyLoadGenerator(object):
+    """Replays a synthetic workload against XpartaMuPP."""
+
+    def __init__(self, rooms=('arena@conference.localhost',), nick='WFGBot', seed=0):
+        """Initialize the load generator.
+
+        Arguments:
+            rooms (tuple): Rooms the bot is in, joining players get
+                distributed evenly across them
+            nick (str): Nick of the bot
+            seed (int): Seed for the random workload
+
+        """
+        self.random = random.Random(seed)
+        self.rooms = list(rooms)
+        self.bot = LoadTestXpartaMuPP(JID('xpartamupp@localhost/CC'), 'XXXXXX', self.rooms, nick)
+        for room in self.rooms:
+            self.bot.plugin['xep_0045'].joinMUC(room, nick)
+        self.occupants = {}
+        self.occupant_rooms = {}
+        self.hosts = set()
+        self._next_player = 0
+        self.durations = defaultdict(list)
+        self.stanzas = defaultdict(int)
+        self.bytes = defaultdict(int)
+
+    def _presence(self, nick):
+        """Create a stub presence for an occupant."""
+        return {'muc': {'nick': nick, 'jid': self.occupants[nick],
+                        'room': self.occupant_rooms[nick]}}
+
+    def _gamelist_iq(self, nick, command, game=None):
+        """Create a gamelist IQ as sent by a client."""
+        iq = self.bot.Iq()
+        iq['type'] = 'set'
+        iq['from'] = self.occupants[nick]
+        iq['to'] = self.bot.boundjid
+        iq['gamelist']['command'] = command
+        if game is not None:
+            iq['gamelist'].xml.append(ET.Element('{jabber:iq:gamelist}game', game))
+        return iq
+
+    def _game(self, nick, players):
+        """Create the data of a game hosted by a player."""
+        return {'name': '%s\'s game' % nick, 'ip': '192.0.2.1', 'port': '20595',
+                'mapName': self.random.choice(['Alpine Lakes', 'Mainland', 'Gulf of Bothnia']),
+                'mapSize': 'Normal', 'mapType': 'random', 'victoryCondition': 'conquest',
+                'nbp': str(players), 'maxnbp': '8', 'players': nick,
+                'mods': 'mod,0.0.23,public,0.0.23'}
+
+    def join(self):
+        """Let a new player join the room."""
+        self._next_player += 1
+        nick = 'player%i' % self._next_player
+        self.occupants[nick] = JID('%s@localhost/0ad' % nick)
+        self.occupant_rooms[nick] = self.rooms[self._next_player % len(self.rooms)]
+        self.bot.plugin['xep_0045'].rooms[self.occupant_rooms[nick]][nick] = \
+            str(self.occupants[nick])
+        self.bot._muc_online(self._presence(nick))  # pylint: disable=protected-access
+
+    def leave(self):
+        """Let a random player leave the room."""
+        if not self.occupants:
+            return
+        nick = self.random.choice(list(self.occupants))
+        presence = self._presence(nick)
+        del self.bot.plugin['xep_0045'].rooms[self.occupant_rooms[nick]][nick]
+        del self.occupants[nick]
+        del self.occupant_rooms[nick]
+        self.hosts.discard(nick)
+        self.bot._muc_offline(presence)  # pylint: disable=protected-access
+
+    def register(self):
+        """Let a random player, who isn't hosting, host a game."""
+        candidates = list(set(self.occupants) - self.hosts)
+        if not candidates:
+            return
+        nick = self.random.choice(candidates)
+        self.hosts.add(nick)
+        iq = self._gamelist_iq(nick, 'register', self._game(nick, self.random.randint(1, 4)))
+        self.bot._iq_game_list_handler(iq)  # pylint: disable=protected-access
+
+    def changestate(self):
+        """Let a random host change the state of its game."""
+        if not self.hosts:
+            return
+        nick = self.random.choice(list(self.hosts))
+        iq = self._gamelist_iq(nick, 'changestate', {'nbp': str(self.random.randint(1, 8)),
+                                                     'players': nick})
+        self.bot._iq_game_list_handler(iq)  # pylint: disable=protected-access
+
+    def unregister(self):
+        """Let a random host close its game."""
+        if not self.hosts:
+            return
+        nick = self.random.choice(list(self.hosts))
+        self.hosts.discard(nick)
+        self.bot._iq_game_list_handler(  # pylint: disable=protected-access
+            self._gamelist_iq(nick, 'unregister'))
+
+    def run_event(self, event_type, record=True):
+        """Run a single event and record its costs.
+
+        Arguments:
+            event_type (str): Type of the event, one of `EVENT_TYPES`
+            record (bool): Whether to record the costs of the event
+
+        """
+        stanzas = self.bot.sent_stanzas
+        sent_bytes = self.bot.sent_bytes
+        start = time.perf_counter()
+        with patch('xpartamupp.xpartamupp.time', self.bot.clock):
+            getattr(self, event_type)()
+        duration = time.perf_counter() - start
+        if record:
+            self.durations[event_type].append(duration)
+            self.stanzas[event_type] += self.bot.sent_stanzas - stanzas
+            self.bytes[event_type] += self.bot.sent_bytes - sent_bytes
+
+    def populate(self, occupants, games):
+        """Bring the lobby into its initial state without recording.
+
+        Arguments:
+            occupants (int): Number of players in the room
+            games (int): Number of games hosted
+
+        """
+        for _ in range(occupants):
+            self.run_event('join', record=False)
+        for _ in range(min(games, occupants)):
+            self.run_event('register', record=False)
+
+    def replay(self, events, weights, interval=1.0):
+        """Replay a random workload.
+
+        Arguments:
+            events (int): Number of events to replay
+            weights (dict): Relative weights of the event types
+            interval (float): Virtual seconds between two events
+
+        """
+        event_types = [event_type for event_type in EVENT_TYPES if weights.get(event_type)]
+        event_weights = [weights[event_type] for event_type in event_types]
+        for _ in range(events):
+            self.run_event(self.random.choices(event_types, event_weights)[0])
+            self.bot.clock.advance(interval)
+
+    def report(self):
+        """Summarize the recorded costs per event type.
+
+        Returns:
+            dict with latency percentiles in milliseconds, bytes and
+            stanzas sent per event for each event type
+
+        """
+        result = {}
+        for event_type, durations in self.durations.items():
+            durations = sorted(durations)
+            count = len(durations)
+            result[event_type] = {
+                'events': count,
+                'p50_ms': round(percentile(durations, 0.5) * 1000, 3),
+                'p90_ms': round(percentile(durations, 0.9) * 1000, 3),
+                'p99_ms': round(percentile(durations, 0.99) * 1000, 3),
+                'bytes_per_event': round(self.bytes[event_type] / count, 1),
+                'stanzas_per_event': round(self.stanzas[event_type] / count, 2),
+            }
+        return result
+
+
+def get_rooms(count):
+    """Get the JIDs of a number of rooms.
+
+    Arguments:
+        count (int): Number of rooms
+
+    Returns:
+        list of room JIDs
+
+    """
+    return ['arena%i@conference.localhost' % index for index in range(count)]
+
+
+def measure_room_memory(rooms, occupants, games):
+    """Measure the memory used by the bot per additional room.
+
+    The same number of players and games is distributed across a
+    single room and across multiple rooms, so the difference in
+    allocated memory is the overhead of the additional rooms.
+
+    Arguments:
+        rooms (int): Number of rooms to compare a single room with
+        occupants (int): Number of players in all rooms together
+        games (int): Number of games hosted in all rooms together
+
+    Returns:
+        dict with the bytes allocated for a single room, for all
+        rooms and per additional room
+
+    """
+    allocated = []
+    for count in (1, rooms):
+        tracemalloc.start()
+        generator = LobbyLoadGenerator(rooms=get_rooms(count))
+        generator.populate(occupants, games)
+        allocated.append(tracemalloc.get_traced_memory()[0])
+        tracemalloc.stop()
+        del generator
+    return {
+        'single_room_bytes': allocated[0],
+        'all_rooms_bytes': allocated[1],
+        'bytes_per_additional_room': round((allocated[1] - allocated[0]) / max(rooms - 1, 1)),
+    }
+
+
+def parse_args(args):
+    """Parse command line arguments.
+
+    Arguments:
+        args (dict): Raw command line arguments given to the script
+
+    Returns:
+         Parsed command line arguments
+
+    """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description="Synthetic load generator for XpartaMuPP")
+    parser.add_argument('--rooms', type=int, default=1,
+                        help="number of rooms the players are distributed across, if greater "
+                             "than one the memory used per additional room gets measured too")
+    parser.add_argument('--occupants', type=int, default=1000,
+                        help="number of players in the rooms before the workload starts")
+    parser.add_argument('--games', type=int, default=300,
+                        help="number of games hosted before the workload starts")
+    parser.add_argument('--events', type=int, default=500, help="number of events to replay")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the random workload")
+    for event_type, weight in zip(EVENT_TYPES, (2, 2, 1, 4, 1)):
+        parser.add_argument('--%s-weight' % event_type, type=float, default=weight,
+                            dest=event_type, help="relative weight of %s events" % event_type)
+    return parser.parse_args(args)
+
+
+def main():
+    """Entry point for running the load generator."""
+    args = parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.ERROR)
+    generator = LobbyLoadGenerator(rooms=get_rooms(args.rooms), seed=args.seed)
+    generator.populate(args.occupants, args.games)
+    generator.replay(args.events, {event_type: getattr(args, event_type)
+                                   for event_type in EVENT_TYPES})
+    result = generator.report()
+    if args.rooms > 1:
+        result['memory'] = measure_room_memory(args.rooms, args.occupants, args.games)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Helpers for timing benchmarks."""
+
+import time
+
+
+def percentile(samples, fraction):
+    """Get a percentile from a list of samples.
+
+    Arguments:
+        samples (list): Sorted samples
+        fraction (float): Percentile to get as fraction between 0
+            and 1
+
+    Returns:
+        Sample at the given percentile or None if there are no
+        samples
+
+    """
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def summarize(durations):
+    """Summarize durations of operations.
+
+    Arguments:
+        durations (list): Durations of single operations in seconds
+
+    Returns:
+        dict with the number of operations, operations per second
+        and the p50 and p99 latencies in milliseconds
+
+    """
+    durations = sorted(durations)
+    total = sum(durations)
+    return {
+        'operations': len(durations),
+        'ops_per_second': round(len(durations) / total, 1) if total else None,
+        'p50_ms': round(percentile(durations, 0.5) * 1000, 3) if durations else None,
+        'p99_ms': round(percentile(durations, 0.99) * 1000, 3) if durations else None,
+    }
+
+
+def measure(func, repeat):
+    """Measure the duration of repeated calls of a function.
+
+    Arguments:
+        func (callable): Function to call without arguments
+        repeat (int): Number of times to call the function
+
+    Returns:
+        dict as returned by `summarize()`
+
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
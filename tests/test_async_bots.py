@@ -0,0 +1,301 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=protected-access
+
+"""Tests for the asyncio-based bots."""
+
+import asyncio
+
+from collections import deque
+from unittest import TestCase, skipUnless
+from unittest.mock import Mock, patch
+
+try:
+    import slixmpp
+except ImportError:
+    slixmpp = None
+
+if slixmpp:
+    from xpartamupp.async_bots import (BROADCAST_BATCH_SIZE, AsyncEcheLOn, AsyncXpartaMuPP,
+                                       BoardListXmppPlugin)
+from xpartamupp.stanzas import BoardListXmppPlugin as SleekBoardListXmppPlugin
+
+GAME = {'name': 'game', 'ip': '127.0.0.1', 'port': '20595', 'hostUsername': 'player0',
+        'state': 'init', 'nbp': '1', 'maxnbp': '2', 'players': 'player0'}
+
+ROOM = 'arena@conference.localhost'
+
+
+@skipUnless(slixmpp, 'slixmpp is not installed')
+class TestStanzas(TestCase):
+    """Test the stanza extensions bound to slixmpp."""
+
+    def test_same_as_sleekxmpp(self):
+        """Test that both XMPP libraries produce the same stanzas."""
+        stanzas = []
+        for stanza_class in (BoardListXmppPlugin, SleekBoardListXmppPlugin):
+            stanza = stanza_class()
+            stanza.add_command('boardlist')
+            stanza.add_items([('player1', 1600), ('player2', 1500)])
+            stanzas.append(str(stanza))
+        self.assertEqual(stanzas[0], stanzas[1])
+
+
+@skipUnless(slixmpp, 'slixmpp is not installed')
+class AsyncBotTestCase(TestCase):
+    """Base class for tests running a bot without connection."""
+
+    def setUp(self):
+        """Set up an event loop and a list to collect sent stanzas."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.sent = []
+
+    def tearDown(self):
+        """Close the event loop."""
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _setup_bot(self, xmpp, occupants):
+        """Prepare a bot for being used without connection.
+
+        Arguments:
+            xmpp (AsyncBot): Bot to prepare
+            occupants (int): Number of players in the MUC room
+
+        """
+        xmpp.register_plugin('xep_0045')
+        xmpp.send = lambda data, *args, **kwargs: self.sent.append(str(data))
+        xmpp._get_occupants = lambda room=None: {'player%i@localhost/0ad' % i: 'player%i' % i
+                                                 for i in range(occupants)}
+        return xmpp
+
+    def _run(self, coroutine):
+        """Run a coroutine and wait for all broadcasts it started."""
+        async def run():
+            await coroutine
+            await asyncio.gather(*self.xmpp.broadcasts.values(), return_exceptions=True)
+        self.loop.run_until_complete(run())
+
+
+class TestAsyncXpartaMuPP(AsyncBotTestCase):
+    """Test handling of game list requests."""
+
+    def setUp(self):
+        """Set up an XpartaMuPP instance without connection."""
+        super().setUp()
+        self.xmpp = self._setup_bot(AsyncXpartaMuPP('xpartamupp@localhost/CC', 'password', ROOM,
+                                                    'WFGBot'),
+                                    occupants=5)
+
+    def test_reconnect(self):
+        """Test that lost connections get established again until disconnecting."""
+        connects = []
+
+        def connect(xmpp, *args, **kwargs):  # pylint: disable=unused-argument
+            connects.append(xmpp)
+            if len(connects) < 3:
+                self.loop.call_soon(xmpp._set_disconnected_future)
+            else:
+                self.loop.call_soon(xmpp.disconnect)
+
+        with patch.object(slixmpp.ClientXMPP, 'connect', connect):
+            self.assertTrue(self.xmpp.connect())
+            self.xmpp.process()
+        self.assertEqual(connects, [self.xmpp] * 3)
+
+    def _make_request(self, command, sender='player0@localhost/0ad'):
+        """Create a game list request."""
+        iq = self.xmpp.make_iq_set(ito='xpartamupp@localhost/CC', ifrom=sender)
+        iq['gamelist']['command'] = command
+        iq['gamelist'].add_game(dict(GAME))
+        return iq
+
+    def test_register(self):
+        """Test that registered games get broadcasted."""
+        self._run(self.xmpp._iq_game_list_handler(self._make_request('register')))
+        self.assertEqual(len(self.xmpp.games[ROOM].get_all_games()), 1)
+        self.assertEqual(len(self.sent), 5)
+        self.assertIn('hostUsername="player0"', self.sent[0])
+
+    def test_ignore_other_resources(self):
+        """Test that requests from other clients than 0ad are ignored."""
+        self._run(self.xmpp._iq_game_list_handler(
+            self._make_request('register', sender='player0@localhost/other')))
+        self.assertEqual(self.xmpp.games[ROOM].get_all_games(), {})
+        self.assertEqual(self.sent, [])
+
+    def test_superseded_broadcast(self):
+        """Test that broadcasts get finished and only the latest newer list follows."""
+        self.xmpp._get_occupants = lambda room=None: {'player%i@localhost/0ad' % i: 'player%i' % i
+                                                      for i in range(BROADCAST_BATCH_SIZE * 2)}
+
+        async def register_unregister_register():
+            await self.xmpp._iq_game_list_handler(self._make_request('register'))
+            await asyncio.sleep(0)
+            await self.xmpp._iq_game_list_handler(self._make_request('unregister'))
+            await self.xmpp._iq_game_list_handler(self._make_request('register'))
+
+        self._run(register_unregister_register())
+        self.assertEqual(len([stanza for stanza in self.sent if 'game ' in stanza]),
+                         BROADCAST_BATCH_SIZE * 4)
+        self.assertEqual(len([stanza for stanza in self.sent if 'game ' not in stanza]), 0)
+
+    def test_multiple_rooms(self):
+        """Test that game lists of different rooms are broadcasted independently."""
+        xmpp = AsyncXpartaMuPP('xpartamupp@localhost/CC', 'password',
+                               [ROOM, 'arena2@conference.localhost'], 'WFGBot')
+        self.xmpp = self._setup_bot(xmpp, occupants=BROADCAST_BATCH_SIZE * 2)
+        xmpp.player_rooms['player1@localhost/0ad'] = 'arena2@conference.localhost'
+
+        async def register_in_both_rooms():
+            await xmpp._iq_game_list_handler(self._make_request('register'))
+            await asyncio.sleep(0)
+            await xmpp._iq_game_list_handler(
+                self._make_request('register', sender='player1@localhost/0ad'))
+
+        self._run(register_in_both_rooms())
+        self.assertEqual(len(xmpp.games[ROOM].get_all_games()), 1)
+        self.assertEqual(len(xmpp.games['arena2@conference.localhost'].get_all_games()), 1)
+        self.assertEqual(len(self.sent), BROADCAST_BATCH_SIZE * 4)
+
+    def test_query(self):
+        """Test that queries only get the matching games."""
+        self._run(self.xmpp._iq_game_list_handler(self._make_request('register')))
+        self.sent.clear()
+        for state in ('running', 'init'):
+            iq = self.xmpp.make_iq_get(ito='xpartamupp@localhost/CC',
+                                       ifrom='player1@localhost/0ad')
+            iq['gamelist']['command'] = 'query'
+            iq['gamelist'].add_game({'state': state})
+            self._run(self.xmpp._iq_game_list_query_handler(iq))
+        self.assertEqual(len(self.sent), 2)
+        self.assertNotIn('hostUsername', self.sent[0])
+        self.assertIn('hostUsername="player0"', self.sent[1])
+
+    def test_rate_limited(self):
+        """Test that requests exceeding the rate limit are rejected."""
+        self.xmpp.set_rate_limit(0.001, 1)
+        self._run(self.xmpp._iq_game_list_handler(self._make_request('register')))
+        self._run(self.xmpp._iq_game_list_handler(self._make_request('changestate')))
+        self.assertEqual(len(self.sent), 6)
+        self.assertIn('resource-constraint', self.sent[-1])
+
+
+class TestAsyncEcheLOn(AsyncBotTestCase):
+    """Test handling of leaderboard, game report and profile requests."""
+
+    def setUp(self):
+        """Set up an EcheLOn instance without connection."""
+        super().setUp()
+        self.leaderboard = Mock(write_listeners=[])
+        self.leaderboard.get_profile.return_value = {
+            'rating': 1500, 'highestRating': 1550, 'rank': 1, 'totalGamesPlayed': 10,
+            'wins': 7, 'losses': 3}
+        self.leaderboard.get_rating_messages.return_value = []
+        self.xmpp = self._setup_bot(AsyncEcheLOn('echelon@localhost/CC', 'password',
+                                                 'arena@conference.localhost', 'RatingsBot',
+                                                 self.leaderboard),
+                                    occupants=3)
+
+    def tearDown(self):
+        """Shut down the thread pools of the bot."""
+        self.xmpp.read_executor.shutdown()
+        self.xmpp.write_executor.shutdown()
+        super().tearDown()
+
+    def _make_request(self, extension, command):
+        """Create a request to EcheLOn."""
+        iq = self.xmpp.make_iq_get(ito='echelon@localhost/CC', ifrom='player0@localhost/0ad')
+        iq[extension]['command'] = command
+        return iq
+
+    def test_profile(self):
+        """Test that profiles get sent and cached."""
+        self._run(self.xmpp._iq_profile_handler(self._make_request('profile', 'player1')))
+        self._run(self.xmpp._iq_profile_handler(self._make_request('profile', 'player1')))
+        self.leaderboard.get_profile.assert_called_once_with('player1@localhost/0ad')
+        self.assertEqual(len(self.sent), 2)
+        self.assertIn('rating="1500"', self.sent[1])
+
+    def test_coalesced(self):
+        """Test that concurrent identical requests share one database call."""
+        async def request_concurrently():
+            await asyncio.gather(*[self.xmpp._iq_profile_handler(
+                self._make_request('profile', 'player1')) for _ in range(3)])
+
+        self._run(request_concurrently())
+        self.leaderboard.get_profile.assert_called_once_with('player1@localhost/0ad')
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(self.xmpp.in_flight, {})
+
+    def test_match_history(self):
+        """Test that a page of the match history gets sent."""
+        self.leaderboard.get_match_history.return_value = [
+            {'id': 3, 'map': 'Mainland', 'duration': 900, 'civ': 'athen', 'team': 0,
+             'result': 'won', 'ratingChange': 16, 'players': [('player2', 'brit', 1)]}]
+        iq = self._make_request('profile', 'player1')
+        iq['profile']['history'] = '1'
+        self._run(self.xmpp._iq_profile_handler(iq))
+        self.leaderboard.get_match_history.assert_called_once_with('player1@localhost/0ad', 1,
+                                                                   None)
+        self.leaderboard.get_profile.assert_not_called()
+        self.assertEqual(len(self.sent), 1)
+        self.assertIn('<player name="player2" civ="brit" team="1" />', self.sent[0])
+        self.assertIn('<cursor>3</cursor>', self.sent[0])
+
+    def test_stats(self):
+        """Test that civilization statistics get sent."""
+        self.leaderboard.get_civ_stats.return_value = {'athen': (10, 7)}
+        self._run(self.xmpp._iq_stats_handler(self._make_request('stats', 'civs')))
+        self.leaderboard.get_civ_stats.assert_called_once_with(None)
+        self.assertEqual(len(self.sent), 1)
+        self.assertIn('<civ name="athen" games="10" wins="7" />', self.sent[0])
+
+    def test_leaderboard(self):
+        """Test that a page of the leaderboard gets sent."""
+        self.leaderboard.get_board.return_value = {
+            1: {'name': 'player1', 'rating': 1600, 'id': 1},
+            2: {'name': 'player2', 'rating': 1500, 'id': 2}}
+        self._run(self.xmpp._iq_board_list_handler(
+            self._make_request('boardlist', 'getleaderboard')))
+        self.leaderboard.get_or_create_player.assert_called_once_with('player0@localhost/0ad')
+        self.leaderboard.get_board.assert_called_once_with(100, None)
+        self.assertEqual(len(self.sent), 1)
+        self.assertIn('<board name="player2" rating="1500" />', self.sent[0])
+
+    def test_rating_list(self):
+        """Test that the rating list gets sent to the requesting player."""
+        self.leaderboard.get_rating_list.return_value = {
+            'player1@localhost': {'name': 'player1', 'rating': 1600}}
+        self._run(self.xmpp._iq_board_list_handler(
+            self._make_request('boardlist', 'getratinglist')))
+        self.assertEqual(len(self.sent), 1)
+        self.assertIn('<command>ratinglist</command>', self.sent[0])
+
+    def test_game_report(self):
+        """Test that rated games result in a broadcast of the ratings."""
+        self.leaderboard.get_rating_messages.return_value = deque(['player0 has won a game'])
+        self.leaderboard.get_rating_list.return_value = {}
+        self.xmpp.report_manager = Mock()
+        iq = self.xmpp.make_iq_set(ito='echelon@localhost/CC', ifrom='player0@localhost/0ad')
+        iq['gamereport'].add_game({'winner': 'player0'})
+        self._run(self.xmpp._iq_game_report_handler(iq))
+        self.xmpp.report_manager.add_report.assert_called_once_with('player0@localhost/0ad',
+                                                                    {'winner': 'player0'})
+        self.assertEqual(len(self.sent), 4)
+        self.assertIn('player0 has won a game', self.sent[0])
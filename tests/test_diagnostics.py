@@ -0,0 +1,140 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests for the on-demand diagnostics."""
+
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import tracemalloc
+from unittest import TestCase
+from unittest.mock import MagicMock, Mock
+
+from sleekxmpp.jid import JID
+
+from xpartamupp.diagnostics import CPU_PROFILE_MAX_DURATION, Diagnostics, SamplingProfiler
+
+
+def busy_function(stop):
+    """Keep a thread busy until told to stop."""
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestSamplingProfiler(TestCase):
+    """Test the sampling CPU profiler."""
+
+    def test_sample(self):
+        """Test sampling the stacks of other threads."""
+        stop = threading.Event()
+        thread = threading.Thread(target=busy_function, args=(stop,), name='busy')
+        thread.start()
+        try:
+            samples = SamplingProfiler(interval=0.001).sample(0.1)
+        finally:
+            stop.set()
+            thread.join()
+        busy_stacks = [stack for stack in samples if stack.startswith('busy;')]
+        self.assertTrue(busy_stacks)
+        self.assertTrue(all('busy_function (test_diagnostics.py:' in stack
+                            for stack in busy_stacks))
+
+
+class TestDiagnostics(TestCase):
+    """Test triggering diagnostics."""
+
+    def setUp(self):
+        """Set up diagnostics writing to a temporary directory."""
+        self.output_dir = tempfile.mkdtemp()
+        self.diagnostics = Diagnostics(self.output_dir, cpu_profile_duration=0.05,
+                                       sampling_interval=0.001)
+
+    def tearDown(self):
+        """Remove written files and stop tracing memory allocations."""
+        shutil.rmtree(self.output_dir)
+        tracemalloc.stop()
+
+    def test_profile_cpu(self):
+        """Test writing a CPU profile."""
+        thread = self.diagnostics.profile_cpu()
+        self.assertIsNone(self.diagnostics.profile_cpu())
+        thread.join()
+        profiles = glob.glob(os.path.join(self.output_dir, 'cpu-profile-*.folded'))
+        self.assertEqual(len(profiles), 1)
+        with open(profiles[0]) as profile:
+            for line in profile:
+                stack, count = line.rsplit(' ', 1)
+                self.assertTrue(stack)
+                self.assertGreater(int(count), 0)
+        self.assertIsNotNone(self.diagnostics.profile_cpu(0.01))
+
+    def test_cpu_profile_duration_bounds(self):
+        """Test rejecting CPU profiles of invalid durations."""
+        with self.assertRaises(ValueError):
+            self.diagnostics.profile_cpu(-1)
+        with self.assertRaises(ValueError):
+            self.diagnostics.profile_cpu(CPU_PROFILE_MAX_DURATION + 1)
+
+    def test_snapshot_memory(self):
+        """Test writing memory snapshots compared to the previous one."""
+        self.diagnostics.snapshot_memory().join()
+        self.assertTrue(tracemalloc.is_tracing())
+        data = [str(i) for i in range(10000)]  # pylint: disable=unused-variable
+        self.diagnostics.snapshot_memory().join()
+        snapshots = sorted(glob.glob(os.path.join(self.output_dir, 'memory-snapshot-*.txt')))
+        self.assertTrue(snapshots)
+        self.assertTrue(glob.glob(os.path.join(self.output_dir, 'memory-snapshot-*.snapshot')))
+        with open(snapshots[-1]) as snapshot:
+            content = snapshot.read()
+        self.assertIn('Largest differences to previous snapshot', content)
+        self.assertIn('test_diagnostics.py', content)
+
+    def test_commands(self):
+        """Test triggering diagnostics by ad-hoc commands."""
+        xmpp = MagicMock()
+        self.diagnostics.profile_cpu = Mock(return_value=Mock())
+        self.diagnostics.register_commands(xmpp, ['Admin@lobby.domain.tld'])
+        add_commands = xmpp.add_event_handler.call_args[0][1]
+        add_commands({})
+        handlers = {call[1]['node']: call[1]['handler']
+                    for call in xmpp['xep_0050'].add_command.call_args_list}
+        self.assertEqual(set(handlers), {'profile-cpu', 'snapshot-memory'})
+
+        session = handlers['profile-cpu']({'from': JID('player@lobby.domain.tld/0ad')}, {})
+        self.assertEqual(session['notes'][0][0], 'error')
+        self.assertIsNone(session['next'])
+
+        session = handlers['profile-cpu']({'from': JID('admin@lobby.domain.tld/Gajim')}, {})
+        self.assertEqual(session['payload'], xmpp['xep_0004'].make_form())
+        submit = session['next']
+
+        for duration in ['foo', '0', '601']:
+            session = submit({'values': {'duration': duration}},
+                             {'from': JID('admin@lobby.domain.tld/Gajim')})
+            self.assertEqual(session['notes'][0][0], 'error')
+        session = submit({'values': {'duration': '10'}},
+                         {'from': JID('player@lobby.domain.tld/0ad')})
+        self.assertEqual(session['notes'][0][0], 'error')
+        self.diagnostics.profile_cpu.assert_not_called()
+
+        session = submit({'values': {'duration': '10'}},
+                         {'from': JID('admin@lobby.domain.tld/Gajim')})
+        self.assertEqual(session['notes'][0][0], 'info')
+        self.assertIsNone(session['next'])
+        self.diagnostics.profile_cpu.assert_called_once_with(10.0)
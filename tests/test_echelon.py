@@ -18,18 +18,34 @@
 
 """Tests for EcheLOn."""
 
+import random
 import sys
+import tempfile
+import threading
+import time
 
 from argparse import Namespace
-from unittest import TestCase
-from unittest.mock import Mock, call, patch
+from unittest import TestCase, skipUnless
+from unittest.mock import ANY, Mock, call, patch
 
 from parameterized import parameterized
 from sleekxmpp.jid import JID
 from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
 
-from xpartamupp.echelon import main, parse_args, Leaderboard
-from xpartamupp.lobby_ranking import Base
+try:
+    import slixmpp
+except ImportError:
+    slixmpp = None
+
+from tests.benchmarks.leaderboard import make_game_report
+from xpartamupp.echelon import (main, parse_args, get_engine_options, get_favourite_civ, EcheLOn,
+                                Leaderboard, ProfileCache, ReportManager,
+                                LEADERBOARD_MAX_PAGE_SIZE, LEADERBOARD_PAGE_SIZE,
+                                MATCH_HISTORY_MAX_PAGE_SIZE, PROFILE_CACHE_TTL,
+                                RATING_CONFLICTS, READ_YOUR_WRITES_WINDOW,
+                                REPORT_DIFF_MAX_FIELDS)
+from xpartamupp.lobby_ranking import Base, Game, Player, PlayerInfo, archive_player_info
 
 
 class TestLeaderboard(TestCase):
@@ -38,10 +54,10 @@ class TestLeaderboard(TestCase):
     def setUp(self):
         """Set up a leaderboard instance."""
         db_url = 'sqlite://'
-        engine = create_engine(db_url)
-        Base.metadata.create_all(engine)
+        self.engine = create_engine(db_url)
+        Base.metadata.create_all(self.engine)
         with patch('xpartamupp.echelon.create_engine') as create_engine_mock:
-            create_engine_mock.return_value = engine
+            create_engine_mock.return_value = self.engine
             self.leaderboard = Leaderboard(db_url)
 
     def test_create_player(self):
@@ -67,50 +83,777 @@ class TestLeaderboard(TestCase):
         self.assertDictEqual(profile, {'highestRating': None, 'losses': 0, 'totalGamesPlayed': 0,
                                        'wins': 0})
 
+    def test_get_profile_archived_games(self):
+        """Test that archived games count as played games."""
+        player = self.leaderboard.get_or_create_player(JID('john@localhost'))
+        player.archived_games = 3
+        self.leaderboard.db.commit()
+        profile = self.leaderboard.get_profile(JID('john@localhost'))
+        self.assertEqual(profile['totalGamesPlayed'], 3)
+        self.assertEqual(profile['losses'], 3)
+
+    def test_civ_stats(self):
+        """Test that civilization statistics get updated with every game."""
+        jids = ['player0@localhost', 'player1@localhost']
+        for jid in jids:
+            self.leaderboard.get_or_create_player(JID(jid))
+        self.assertEqual(self.leaderboard.get_civ_stats(), {})
+
+        report = make_game_report(random.Random(0), jids)
+        self.leaderboard.add_and_rate_game(report)
+        winner = [jid for jid, state in report['playerStates'].items() if state == 'won'][0]
+        expected = {}
+        for jid in jids:
+            games, wins = expected.get(report['civs'][jid], (0, 0))
+            expected[report['civs'][jid]] = (games + 1, wins + int(jid == winner))
+
+        self.assertEqual(self.leaderboard.get_civ_stats(), expected)
+        self.assertEqual(self.leaderboard.get_civ_stats(report['mapName']), expected)
+        self.assertEqual(self.leaderboard.get_civ_stats('Unknown'), {})
+        self.leaderboard.civ_stats.loaded = None
+        self.assertEqual(self.leaderboard.get_civ_stats(), expected)
+        self.assertEqual(self.leaderboard.get_player_civ_stats(JID(winner)),
+                         {report['civs'][winner]: (1, 1)})
+
+    def test_civ_stats_reload(self):
+        """Test that games committed before reloading civilization statistics count once."""
+        jids = ['player0@localhost', 'player1@localhost']
+        for jid in jids:
+            self.leaderboard.get_or_create_player(JID(jid))
+        self.assertEqual(self.leaderboard.get_civ_stats(), {})
+
+        commit = self.leaderboard.db.commit
+
+        def commit_and_reload():
+            commit()
+            self.leaderboard.civ_stats.load(self.leaderboard.read_db)
+
+        report = make_game_report(random.Random(0), jids)
+        with patch.object(self.leaderboard.db, 'commit', side_effect=commit_and_reload):
+            self.leaderboard.add_and_rate_game(report)
+        self.assertEqual(sum(games for games, _ in self.leaderboard.get_civ_stats().values()), 2)
+
+    def test_get_match_history(self):
+        """Test retrieving the match history of a player page by page."""
+        jids = ['player0@localhost', 'player1@localhost', 'player2@localhost']
+        for jid in jids:
+            self.leaderboard.get_or_create_player(JID(jid))
+        rng = random.Random(0)
+        reports = [make_game_report(rng, jids[:2]), make_game_report(rng, jids[:2]),
+                   make_game_report(rng, [jids[0], jids[2]])]
+        for report in reports:
+            self.leaderboard.add_and_rate_game(report)
+        self.assertEqual(archive_player_info(self.engine, keep_games=2), 2)
+
+        first_page = self.leaderboard.get_match_history(JID(jids[0]), 2)
+        self.assertEqual([game['id'] for game in first_page], [3, 2])
+        second_page = self.leaderboard.get_match_history(JID(jids[0]), 2, first_page[-1]['id'])
+        self.assertEqual([game['id'] for game in second_page], [1])
+
+        for game, report in zip(second_page + first_page[::-1], reports):
+            opponent = [jid for jid in report['playerStates'] if jid != jids[0]][0]
+            won = report['playerStates'][jids[0]] == 'won'
+            self.assertEqual(game['map'], report['mapName'])
+            self.assertEqual(game['duration'], int(report['timeElapsed']))
+            self.assertEqual(game['civ'], report['civs'][jids[0]])
+            self.assertEqual(game['result'], 'won' if won else 'lost')
+            self.assertEqual(game['ratingChange'] > 0, won)
+            self.assertEqual(game['players'], [(JID(opponent).local, report['civs'][opponent],
+                                                int(report['teams'][opponent]))])
+
+        self.assertEqual(self.leaderboard.get_match_history(JID(jids[0]), 2, 1), [])
+        self.assertEqual(self.leaderboard.get_match_history(JID('john@localhost'), 2), [])
+
+    def _create_rated_players(self, ratings):
+        """Create players with the given ratings."""
+        for i, rating in enumerate(ratings):
+            player = self.leaderboard.get_or_create_player(JID('player%i@localhost' % i))
+            player.rating = rating
+        self.leaderboard.db.commit()
+
+    def test_get_board_pages(self):
+        """Test retrieving the leaderboard page by page."""
+        self._create_rated_players([1500, 1200, 1500, -1, 1300, 1200, 1100])
+        pages = []
+        after = None
+        while True:
+            page = self.leaderboard.get_board(limit=2, after=after)
+            if not page:
+                break
+            pages.append([player['name'] for player in page.values()])
+            last = list(page.values())[-1]
+            after = (last['rating'], last['id'])
+        self.assertEqual(pages, [['player0', 'player2'], ['player4', 'player1'],
+                                 ['player5', 'player6']])
+
+    @parameterized.expand([
+        ('player0@localhost/0ad', 1, ['player0', 'player2', 'player4']),
+        ('player4@localhost', 2, ['player2', 'player4', 'player1']),
+        ('player6@localhost', 5, ['player5', 'player6']),
+    ])
+    def test_get_board_around(self, jid, expected_position, expected_names):
+        """Test retrieving the leaderboard page around a player."""
+        self._create_rated_players([1500, 1200, 1500, -1, 1300, 1200, 1100])
+        position, page = self.leaderboard.get_board_around(JID(jid), limit=3)
+        self.assertEqual(position, expected_position)
+        self.assertEqual([player['name'] for player in page.values()], expected_names)
+
+    def test_write_listeners(self):
+        """Test notifying listeners about rated players."""
+        self._create_rated_players([1500, -1])
+        players = self.leaderboard.db.query(Player).order_by(Player.id).all()
+        game = Game(map='Arcadia', duration=300, teamsLocked=True, matchID='1')
+        game.player_info.extend([PlayerInfo(player=player) for player in players])
+        game.winner = players[1]
+        self.leaderboard.db.add(game)
+        self.leaderboard.db.commit()
+
+        listener = Mock()
+        self.leaderboard.write_listeners.append(listener)
+        self.leaderboard._rate_game(game)  # pylint: disable=protected-access
+        listener.assert_has_calls([call('player0@localhost', 1500, players[0].rating),
+                                   call('player1@localhost', -1, players[1].rating)])
+        self.assertLess(players[0].rating, 1500)
+
+    def test_get_board_around_unrated(self):
+        """Test retrieving the leaderboard page around unrated players."""
+        self._create_rated_players([1500, -1])
+        self.assertEqual(self.leaderboard.get_board_around(JID('player1@localhost')),
+                         (None, {}))
+        self.assertEqual(self.leaderboard.get_board_around(JID('john@localhost')), (None, {}))
+
+
+class TestReadReplica(TestCase):
+    """Test routing of leaderboard reads to a read replica."""
+
+    def setUp(self):
+        """Set up a leaderboard instance with a read replica."""
+        primary_engine = create_engine('sqlite://')
+        replica_engine = create_engine('sqlite://')
+        for engine in (primary_engine, replica_engine):
+            Base.metadata.create_all(engine)
+        with patch('xpartamupp.echelon.create_engine') as create_engine_mock:
+            create_engine_mock.side_effect = [primary_engine, replica_engine]
+            self.leaderboard = Leaderboard('sqlite://', read_db_url='sqlite://')
+
+        self.player = self.leaderboard.get_or_create_player(JID('john@localhost'))
+        self.player.rating = 1300
+        self.leaderboard.db.commit()
+        self.leaderboard.read_db.add(Player(jid='john@localhost', rating=1200))
+        self.leaderboard.read_db.commit()
+
+    def test_reads_from_replica(self):
+        """Test that reads go to the read replica."""
+        self.assertEqual(self.leaderboard.get_profile(JID('john@localhost'))['rating'], 1200)
+        self.assertEqual(self.leaderboard.get_board(),
+                         {'john@localhost': {'name': 'john', 'rating': 1200, 'id': 1}})
+        self.assertEqual(self.leaderboard.get_rating_list({JID('john@localhost'): 'john'}),
+                         {'john': {'name': 'john', 'rating': '1200'}})
+
+    def test_read_your_writes(self):
+        """Test reading the profile of a recently rated player."""
+        with patch('xpartamupp.echelon.time.monotonic') as monotonic_mock:
+            monotonic_mock.return_value = 1000
+            self.leaderboard._mark_written(self.player)  # pylint: disable=protected-access
+            self.assertEqual(self.leaderboard.get_profile(JID('John@localhost'))['rating'],
+                             1300)
+            self.assertEqual(self.leaderboard.get_profile(JID('jane@localhost')), {})
+
+            monotonic_mock.return_value = 1000 + READ_YOUR_WRITES_WINDOW
+            self.assertEqual(self.leaderboard.get_profile(JID('john@localhost'))['rating'],
+                             1200)
+
+
+class TestConcurrentRating(TestCase):
+    """Test rating games from multiple processes at the same time."""
+
+    def setUp(self):
+        """Set up a database shared by multiple leaderboard instances."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_url = 'sqlite:///%s/db.sqlite3' % self.directory.name
+
+    def tearDown(self):
+        """Remove the database."""
+        self.directory.cleanup()
+
+    def _rate_changed_game(self, lock=True):
+        """Rate a game after another process changed the rating of a player.
+
+        Arguments:
+            lock (bool): Whether to lock the players before rating
+
+        Returns:
+            tuple of the listener of rating changes, the players and
+            the number of retried rating updates
+
+        """
+        leaderboard = Leaderboard(self.db_url, engine_options=get_engine_options(self.db_url))
+        Base.metadata.create_all(leaderboard.db.get_bind())
+        players = [leaderboard.get_or_create_player(JID('player%i@localhost' % i))
+                   for i in range(2)]
+        game = Game(map='Arcadia', duration=300, teamsLocked=True, matchID='1')
+        game.player_info.extend([PlayerInfo(player=player) for player in players])
+        game.winner = players[0]
+        leaderboard.db.add(game)
+        leaderboard.db.commit()
+        self.assertEqual([player.rating for player in game.players], [-1, -1])
+
+        other = Leaderboard(self.db_url, engine_options=get_engine_options(self.db_url))
+        other.get_or_create_player(JID('player0@localhost')).rating = 1600
+        other.db.commit()
+
+        listener = Mock()
+        leaderboard.write_listeners.append(listener)
+        conflicts = RATING_CONFLICTS.samples()[0][2]
+        if not lock:
+            leaderboard._lock_players = Mock()  # pylint: disable=protected-access
+        with patch('xpartamupp.echelon.time.sleep') as sleep_mock:
+            leaderboard._rate_game(game)  # pylint: disable=protected-access
+        self.assertEqual(sleep_mock.call_count, 0 if lock else 1)
+        ratings = [player.rating for player in players]
+        for instance in (leaderboard, other):
+            instance.db.remove()
+        return listener, ratings, RATING_CONFLICTS.samples()[0][2] - conflicts
+
+    def test_lock_players(self):
+        """Test that ratings changed concurrently get read after locking the players."""
+        listener, ratings, conflicts = self._rate_changed_game()
+        self.assertEqual(conflicts, 0)
+        listener.assert_has_calls([call('player0@localhost', 1600, ratings[0]),
+                                   call('player1@localhost', -1, ratings[1])])
+        self.assertGreater(ratings[0], 1600)
+
+    def test_retry_on_conflict(self):
+        """Test that ratings changed concurrently get rated again."""
+        listener, ratings, conflicts = self._rate_changed_game(lock=False)
+        self.assertEqual(conflicts, 1)
+        listener.assert_has_calls([call('player0@localhost', 1600, ratings[0]),
+                                   call('player1@localhost', -1, ratings[1])])
+        self.assertGreater(ratings[0], 1600)
+
+    def test_no_lost_updates(self):
+        """Test that no rating updates get lost with multiple processes.
+
+        Another process rates a game of the same players after every
+        first attempt read the ratings, so every rating update
+        conflicts once. Locking is disabled to allow that.
+        """
+        leaderboard, other = [Leaderboard(self.db_url,
+                                          engine_options=get_engine_options(self.db_url))
+                              for _ in range(2)]
+        Base.metadata.create_all(leaderboard.db.get_bind())
+        jids = ['player0@localhost', 'player1@localhost']
+        for jid in jids:
+            leaderboard.get_or_create_player(JID(jid))
+
+        writes = []
+        for instance in (leaderboard, other):
+            instance.write_listeners.append(lambda *args: writes.append(args))
+
+        rng = random.Random(0)
+        other_reports = [make_game_report(rng, jids) for _ in range(3)]
+        attempts = []
+
+        def adjust_ratings(game, player1, player2):
+            attempts.append(game)
+            if len(attempts) % 2:
+                other.add_and_rate_game(other_reports[len(attempts) // 2])
+            return Leaderboard._adjust_ratings(game, player1, player2)
+
+        leaderboard._lock_players = Mock()  # pylint: disable=protected-access
+        leaderboard._adjust_ratings = adjust_ratings  # pylint: disable=protected-access
+        conflicts = RATING_CONFLICTS.samples()[0][2]
+        with patch('xpartamupp.echelon.time.sleep'):
+            for _ in range(3):
+                leaderboard.add_and_rate_game(make_game_report(rng, jids))
+        self.assertEqual(RATING_CONFLICTS.samples()[0][2] - conflicts, 3)
+
+        for jid in jids:
+            ratings = [(old_rating, new_rating) for player_jid, old_rating, new_rating in writes
+                       if player_jid == jid and new_rating is not None]
+            self.assertEqual(len(ratings), 6)
+            # Every update has to be based on the rating written by the
+            # previous one.
+            for (_, previous_rating), (old_rating, _) in zip(ratings, ratings[1:]):
+                self.assertEqual(old_rating, previous_rating)
+            self.assertEqual(leaderboard.get_or_create_player(JID(jid)).rating,
+                             ratings[-1][1])
+        for instance in (leaderboard, other):
+            instance.db.remove()
+
+
+class TestConcurrentCivStats(TestCase):
+    """Test loading civilization statistics while games get added."""
+
+    def setUp(self):
+        """Set up a leaderboard with a database shared by threads."""
+        self.directory = tempfile.TemporaryDirectory()
+        db_url = 'sqlite:///%s/db.sqlite3' % self.directory.name
+        self.leaderboard = Leaderboard(db_url, engine_options=get_engine_options(db_url))
+        Base.metadata.create_all(self.leaderboard.db.get_bind())
+
+    def tearDown(self):
+        """Remove the database."""
+        self.leaderboard.db.remove()
+        self.directory.cleanup()
+
+    def test_load_during_add_game(self):
+        """Test that a game added while statistics get loaded counts once."""
+        jids = ['player0@localhost', 'player1@localhost']
+        for jid in jids:
+            self.leaderboard.get_or_create_player(JID(jid))
+        self.assertEqual(self.leaderboard.get_civ_stats(), {})
+
+        querying = threading.Event()
+        resume = threading.Event()
+
+        def query(model):
+            querying.set()
+            resume.wait(5)
+            return self.leaderboard.read_db.query(model)
+
+        def load():
+            self.leaderboard.civ_stats.load(Mock(query=query))
+            self.leaderboard.read_db.remove()
+
+        def add_game():
+            self.leaderboard.add_and_rate_game(make_game_report(random.Random(0), jids))
+            self.leaderboard.db.remove()
+
+        loader = threading.Thread(target=load)
+        loader.start()
+        querying.wait(5)
+        # The load has incremented the generation already, but didn't
+        # read the statistics yet, when the game gets added.
+        writer = threading.Thread(target=add_game)
+        writer.start()
+        writer.join(0.5)
+        resume.set()
+        loader.join(5)
+        writer.join(5)
+        self.assertEqual(sum(games for games, _ in self.leaderboard.get_civ_stats().values()), 2)
+
+
+class TestEngineOptions(TestCase):
+    """Test options for the creation of database engines."""
+
+    @parameterized.expand([
+        ('sqlite://', {}, {}),
+        ('sqlite://', {'pool_size': 5}, {}),
+        ('sqlite:////tmp/db.sqlite3', {'pool_size': 5},
+         {'poolclass': QueuePool, 'pool_size': 5, 'connect_args': {'check_same_thread': False}}),
+        ('postgresql://localhost/lobby', {}, {}),
+        ('postgresql://localhost/lobby',
+         {'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 3600, 'pool_pre_ping': True,
+          'statement_timeout': 5000},
+         {'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 3600, 'pool_pre_ping': True,
+          'connect_args': {'options': '-c statement_timeout=5000'}}),
+        ('mysql://localhost/lobby', {'statement_timeout': 5000}, {}),
+    ])
+    def test_options(self, db_url, kwargs, expected_options):
+        """Test options for different databases."""
+        self.assertEqual(get_engine_options(db_url, **kwargs), expected_options)
+
+    def test_sqlite_pragmas(self):
+        """Test that the SQLite profile gets applied to new connections."""
+        with tempfile.TemporaryDirectory() as directory:
+            db_url = 'sqlite:///%s/db.sqlite3' % directory
+            leaderboard = Leaderboard(db_url, engine_options=get_engine_options(db_url))
+            self.assertEqual(leaderboard.db.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(leaderboard.db.execute('PRAGMA synchronous').scalar(), 1)
+            self.assertEqual(leaderboard.db.execute('PRAGMA busy_timeout').scalar(), 5000)
+            leaderboard.db.remove()
+
+
+class TestBoardPageParsing(TestCase):
+    """Test parsing of requested leaderboard pages."""
+
+    @parameterized.expand([
+        ('', '', (LEADERBOARD_PAGE_SIZE, None)),
+        ('50', '', (50, None)),
+        ('', '1300,42', (LEADERBOARD_PAGE_SIZE, (1300, 42))),
+        (str(LEADERBOARD_MAX_PAGE_SIZE), '-1,1', (LEADERBOARD_MAX_PAGE_SIZE, (-1, 1))),
+    ])
+    def test_valid(self, limit, cursor, expected_page):
+        """Test parsing valid page requests."""
+        iq = {'boardlist': {'limit': limit, 'cursor': cursor}}
+        self.assertEqual(EcheLOn._parse_board_page(iq),  # pylint: disable=protected-access
+                         expected_page)
+
+    @parameterized.expand([
+        ('0', ''),
+        (str(LEADERBOARD_MAX_PAGE_SIZE + 1), ''),
+        ('foo', ''),
+        ('', '1300'),
+        ('', '1300,42,1'),
+        ('', 'foo,bar'),
+    ])
+    def test_invalid(self, limit, cursor):
+        """Test parsing invalid page requests."""
+        iq = {'boardlist': {'limit': limit, 'cursor': cursor}}
+        with self.assertRaises(ValueError):
+            EcheLOn._parse_board_page(iq)  # pylint: disable=protected-access
+
+
+class TestProfileCache(TestCase):
+    """Test caching of profile stanzas."""
+
+    def setUp(self):
+        """Set up a profile cache with some cached profiles."""
+        self.cache = ProfileCache(size_limit=4)
+        generation = self.cache.get_generation()
+        for nick, rating in [('john', 1500), ('jane', 1300), ('bob', 1200), ('alice', None)]:
+            self.cache.put(JID('%s@localhost/0ad' % nick), nick, rating, nick, generation)
+
+    def test_get(self):
+        """Test retrieving cached profiles."""
+        self.assertEqual(self.cache.get(JID('John@localhost/foo'), 'john'), 'john')
+        self.assertIsNone(self.cache.get(JID('john@localhost'), 'John'))
+        self.assertIsNone(self.cache.get(JID('carol@localhost'), 'carol'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.assertAlmostEqual(self.cache.get_hit_rate(), 1 / 3)
+
+    def test_least_recently_used_eviction(self):
+        """Test that the least recently used profile gets evicted."""
+        self.cache.get(JID('john@localhost'), 'john')
+        self.cache.put(JID('carol@localhost'), 'carol', None, 'carol',
+                       self.cache.get_generation())
+        self.assertEqual(list(self.cache.entries),
+                         ['bob@localhost', 'alice@localhost', 'john@localhost',
+                          'carol@localhost'])
+
+    @parameterized.expand([
+        ('no rating change', None, None, ['jane', 'bob', 'alice']),
+        ('same rating', 1500, 1500, ['jane', 'bob', 'alice']),
+        ('rating increase', 1250, 1350, ['bob', 'alice']),
+        ('rating decrease', 1550, 1200, ['bob', 'alice']),
+        ('rating decrease below', 1550, 1100, ['alice']),
+        ('first rating', -1, 1216, ['jane', 'alice']),
+    ])
+    def test_invalidate(self, _, old_rating, new_rating, expected_nicks):
+        """Test invalidation of profiles affected by a change."""
+        self.cache.invalidate('john@localhost', old_rating, new_rating)
+        self.assertEqual([nick for nick, _, _, _ in self.cache.entries.values()],
+                         expected_nicks)
+
+    def test_expired(self):
+        """Test that profiles expire, to pick up changes by other processes."""
+        with patch('xpartamupp.echelon.time.monotonic',
+                   return_value=time.monotonic() + PROFILE_CACHE_TTL):
+            self.assertIsNone(self.cache.get(JID('john@localhost'), 'john'))
+        self.assertNotIn('john@localhost', self.cache.entries)
+        self.assertEqual(self.cache.get(JID('jane@localhost'), 'jane'), 'jane')
+
+    def test_put_after_invalidation(self):
+        """Test that profiles retrieved before an invalidation aren't cached."""
+        generation = self.cache.get_generation()
+        self.cache.invalidate('jane@localhost')
+        self.cache.put(JID('carol@localhost'), 'carol', None, 'carol', generation)
+        self.assertIsNone(self.cache.get(JID('carol@localhost'), 'carol'))
+
+
+class TestProfileRequests(TestCase):
+    """Test serving profile requests."""
+
+    def setUp(self):
+        """Set up an EcheLOn instance without connection."""
+        self.leaderboard = Mock(write_listeners=[])
+        self.leaderboard.get_profile.return_value = {
+            'rating': 1500, 'highestRating': 1550, 'rank': 1, 'totalGamesPlayed': 10,
+            'wins': 7, 'losses': 3}
+        self.xmpp = EcheLOn(JID('echelon@localhost/CC'), 'password',
+                            'arena@conference.localhost', 'RatingsBot', self.leaderboard)
+        self.xmpp.plugin = {'xep_0045': Mock(**{'getJidProperty.return_value': None})}
+        self.sent = []
+        self.xmpp.send_raw = lambda data, *args, **kwargs: self.sent.append(data)
+
+    def _request_profile(self, nick):
+        """Send a profile reply for a nick without player online."""
+        iq = self.xmpp.make_iq_get(ito='echelon@localhost/CC', ifrom='jane@localhost/0ad')
+        self.xmpp._send_profile(iq, nick)  # pylint: disable=protected-access
+
+    def test_cached(self):
+        """Test that profiles are served from the cache."""
+        self._request_profile('john')
+        self._request_profile('john')
+        self.leaderboard.get_profile.assert_called_once_with(JID('john@localhost/0ad'))
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(self.sent[0].split('>', 1)[1], self.sent[1].split('>', 1)[1])
+        self.assertIn('rating="1500"', self.sent[1])
+
+    def test_invalidated(self):
+        """Test that changed profiles are retrieved again."""
+        self._request_profile('john')
+        for listener in self.leaderboard.write_listeners:
+            listener('john@localhost', 1500, 1510)
+        self._request_profile('john')
+        self.assertEqual(self.leaderboard.get_profile.call_count, 2)
+
+    def test_coalesced(self):
+        """Test that concurrent requests for a profile are coalesced."""
+        release = threading.Event()
+        profile = self.leaderboard.get_profile.return_value
+        self.leaderboard.get_profile.side_effect = lambda jid: release.wait(5) and profile
+
+        threads = [threading.Thread(target=self._request_profile, args=('john',))
+                   for _ in range(3)]
+        threads[0].start()
+        deadline = time.monotonic() + 5
+        while not self.xmpp.in_flight.calls and time.monotonic() < deadline:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        call_in_flight = list(self.xmpp.in_flight.calls.values())[0]
+        while call_in_flight.waiters < 2 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.leaderboard.get_profile.assert_called_once_with(JID('john@localhost/0ad'))
+        self.assertEqual(len(self.sent), 3)
+        self.assertTrue(all('rating="1500"' in stanza for stanza in self.sent))
+
+    def test_rate_limited(self):
+        """Test that profile requests exceeding the rate limit are rejected."""
+        self.xmpp.set_rate_limit(0.001, 1)
+        for sender in ['jane@localhost/0ad', 'jane@localhost/0ad', 'bob@localhost/0ad']:
+            iq = self.xmpp.make_iq_get(ito='echelon@localhost/CC', ifrom=sender)
+            iq['profile']['command'] = 'john'
+            self.xmpp._iq_profile_handler(iq)  # pylint: disable=protected-access
+
+        self.assertEqual(len(self.sent), 3)
+        self.assertIn('type="result"', self.sent[0])
+        self.assertIn('type="error"', self.sent[1])
+        self.assertIn('<resource-constraint', self.sent[1])
+        self.assertIn('type="result"', self.sent[2])
+
+    def test_failure_not_cached(self):
+        """Test that failing profile retrieval doesn't get cached."""
+        self.leaderboard.get_profile.side_effect = [Exception, {}]
+        self._request_profile('john')
+        self._request_profile('john')
+        self.assertEqual(self.leaderboard.get_profile.call_count, 2)
+        self.assertIn('rating="-2"', self.sent[0])
+
+    def _request_match_history(self, nick, history, cursor=''):
+        """Send a match history request."""
+        iq = self.xmpp.make_iq_get(ito='echelon@localhost/CC', ifrom='jane@localhost/0ad')
+        iq['profile']['command'] = nick
+        iq['profile']['history'] = history
+        iq['profile']['cursor'] = cursor
+        self.xmpp._iq_profile_handler(iq)  # pylint: disable=protected-access
+
+    def test_match_history(self):
+        """Test sending a page of the match history of a player."""
+        self.leaderboard.get_match_history.return_value = [
+            {'id': 12, 'map': 'Mainland', 'duration': 900, 'civ': 'athen', 'team': 0,
+             'result': 'won', 'ratingChange': 16, 'players': [('bob', 'brit', 1)]},
+            {'id': 7, 'map': 'Arcadia', 'duration': 600, 'civ': 'gaul', 'team': 0,
+             'result': 'lost', 'ratingChange': None, 'players': []}]
+        self._request_match_history('john', '2', '20')
+        self.leaderboard.get_match_history.assert_called_once_with(JID('john@localhost/0ad'),
+                                                                   2, 20)
+        self.leaderboard.get_profile.assert_not_called()
+        self.assertEqual(len(self.sent), 1)
+        self.assertIn('<game id="12" map="Mainland" duration="900" civ="athen" team="0" '
+                      'result="won" ratingChange="16"><player name="bob" civ="brit" '
+                      'team="1" /></game><game id="7" map="Arcadia" duration="600" civ="gaul" '
+                      'team="0" result="lost" />', self.sent[0])
+        self.assertIn('<cursor>7</cursor>', self.sent[0])
+
+    def test_match_history_last_page(self):
+        """Test that the last page of the match history has no cursor."""
+        self.leaderboard.get_match_history.return_value = []
+        self._request_match_history('john', '10')
+        self.leaderboard.get_match_history.assert_called_once_with(JID('john@localhost/0ad'),
+                                                                   10, None)
+        self.assertIn('<history>10</history>', self.sent[0])
+        self.assertNotIn('<cursor>', self.sent[0])
+
+    @parameterized.expand([
+        ('0', ''),
+        (str(MATCH_HISTORY_MAX_PAGE_SIZE + 1), ''),
+        ('foo', ''),
+        ('10', 'foo'),
+    ])
+    def test_match_history_invalid(self, history, cursor):
+        """Test rejecting invalid match history requests."""
+        self._request_match_history('john', history, cursor)
+        self.leaderboard.get_match_history.assert_not_called()
+        self.assertIn('<bad-request', self.sent[0])
+
+
+class TestStatsRequests(TestCase):
+    """Test serving civilization statistics requests."""
+
+    def setUp(self):
+        """Set up an EcheLOn instance without connection."""
+        self.leaderboard = Mock(write_listeners=[])
+        self.leaderboard.get_civ_stats.return_value = {'brit': (4, 1), 'athen': (10, 7)}
+        self.leaderboard.get_player_civ_stats.return_value = {'brit': (4, 1), 'gaul': (4, 3)}
+        self.xmpp = EcheLOn(JID('echelon@localhost/CC'), 'password',
+                            'arena@conference.localhost', 'RatingsBot', self.leaderboard)
+        self.xmpp.plugin = {'xep_0045': Mock(**{'getJidProperty.return_value': None})}
+        self.sent = []
+        self.xmpp.send_raw = lambda data, *args, **kwargs: self.sent.append(data)
+
+    def _request_stats(self, command, **kwargs):
+        """Send a civilization statistics request."""
+        iq = self.xmpp.make_iq_get(ito='echelon@localhost/CC', ifrom='jane@localhost/0ad')
+        iq['stats']['command'] = command
+        for key, value in kwargs.items():
+            iq['stats'][key] = value
+        self.xmpp._iq_stats_handler(iq)  # pylint: disable=protected-access
+
+    def test_civs(self):
+        """Test sending the statistics of a map."""
+        self._request_stats('civs', map='Mainland')
+        self.leaderboard.get_civ_stats.assert_called_once_with('Mainland')
+        self.assertEqual(len(self.sent), 1)
+        self.assertIn('<civ name="athen" games="10" wins="7" /><civ name="brit" games="4" '
+                      'wins="1" />', self.sent[0])
+
+    def test_player(self):
+        """Test sending the statistics and favourite civilization of a player."""
+        self._request_stats('player', player='john')
+        self.leaderboard.get_player_civ_stats.assert_called_once_with(
+            JID('john@localhost/0ad'))
+        self.assertIn('<favouriteCiv>gaul</favouriteCiv>', self.sent[0])
+
+    def test_unknown_command(self):
+        """Test rejecting unknown commands."""
+        self._request_stats('maps')
+        self.assertIn('<bad-request', self.sent[0])
+
+    @parameterized.expand([
+        ({}, None),
+        ({'athen': (3, 0), 'brit': (2, 2)}, 'athen'),
+        ({'athen': (2, 0), 'brit': (2, 2)}, 'brit'),
+        ({'brit': (2, 1), 'athen': (2, 1)}, 'athen'),
+    ])
+    def test_favourite_civ(self, civ_stats, expected_civ):
+        """Test determining the civilization played most often."""
+        self.assertEqual(get_favourite_civ(civ_stats), expected_civ)
+
 
 class TestReportManager(TestCase):
     """Test ReportManager functionality."""
 
-    pass
+    def test_report_diff(self):
+        """Test diff of reports with player specific values."""
+        report1 = {'mapName': 'Alpine Lakes', 'civs': 'athen,brit,', 'totalScore': '100,200,'}
+        report2 = {'mapName': 'Alpine Lakes', 'civs': 'athen,gaul,', 'totalScore': '100,200,',
+                   'teamsLocked': 'true'}
+        self.assertDictEqual(ReportManager._get_report_diff(report1, report2),
+                             {'fields': ['civs', 'teamsLocked'],
+                              'diff': {'civs': {1: ['brit', 'gaul']},
+                                       'teamsLocked': [None, 'true']},
+                              'truncated': False})
+
+    def test_report_diff_truncated(self):
+        """Test that diffs of very different reports are capped."""
+        report1 = {'field%i' % i: 'a' * 100 for i in range(REPORT_DIFF_MAX_FIELDS * 2)}
+        report2 = {'field%i' % i: 'b' * 100 for i in range(REPORT_DIFF_MAX_FIELDS * 2)}
+        report_diff = ReportManager._get_report_diff(report1, report2)
+        self.assertEqual(len(report_diff['fields']), REPORT_DIFF_MAX_FIELDS)
+        self.assertEqual(len(report_diff['diff']), REPORT_DIFF_MAX_FIELDS)
+        self.assertTrue(report_diff['truncated'])
+        for value1, value2 in report_diff['diff'].values():
+            self.assertLess(len(value1), 100)
+            self.assertLess(len(value2), 100)
+
+    def test_count_mismatches(self):
+        """Test counting of mismatching report fields."""
+        report_manager = ReportManager(Mock())
+        report = {'playerID': '1', 'matchID': 'abc', 'playerStates': 'won,defeated,',
+                  'civs': 'athen,brit,'}
+        report_manager.add_report(JID('player1@localhost/0ad'), dict(report))
+        report_manager.add_report(JID('player2@localhost/0ad'),
+                                  dict(report, playerID='2', civs='athen,gaul,'))
+        report_manager.add_report(JID('player2@localhost/0ad'),
+                                  dict(report, playerID='2', civs='athen,gaul,'))
+        self.assertEqual(report_manager.get_report_mismatches(), [('civs', 2)])
+        report_manager.leaderboard.add_and_rate_game.assert_not_called()
+
+    def test_compare_mismatches_once(self):
+        """Test that mismatching reports get compared only once."""
+        report_manager = ReportManager(Mock())
+        report = {'playerID': '1', 'matchID': 'abc', 'playerStates': 'won,defeated,',
+                  'civs': 'athen,brit,'}
+        report_manager.add_report(JID('player1@localhost/0ad'), dict(report))
+        with patch('xpartamupp.echelon.ReportManager._get_differing_fields',
+                   wraps=ReportManager._get_differing_fields) as fields_mock:
+            report_manager.add_report(JID('player2@localhost/0ad'),
+                                      dict(report, playerID='2', civs='athen,gaul,'))
+        fields_mock.assert_called_once_with(ANY, ANY)
+        self.assertEqual(report_manager.get_report_mismatches(), [('civs', 1)])
+
+    def test_count_unknown_mismatches(self):
+        """Test that mismatches of unknown fields are counted together."""
+        report_manager = ReportManager(Mock())
+        report = {'playerID': '1', 'matchID': 'abc', 'playerStates': 'won,defeated,'}
+        report_manager.add_report(JID('player1@localhost/0ad'), dict(report))
+        report_manager.add_report(JID('player2@localhost/0ad'),
+                                  dict(report, playerID='2', foo='1', bar='2', mapName='Arcadia'))
+        self.assertEqual(sorted(report_manager.get_report_mismatches()),
+                         [('mapName', 1), ('other', 1)])
+
+
+DEFAULT_ARGS = dict(domain='lobby.wildfiregames.com', login='EcheLOn', log_level=30,
+                    nickname='RatingsBot', password='XXXXXX', room='arena',
+                    database_url='sqlite:///lobby_rankings.sqlite3', database_read_url=None,
+                    database_pool_size=None,
+                    database_max_overflow=None, database_pool_recycle=None,
+                    database_pool_pre_ping=False, database_statement_timeout=None,
+                    slow_query_threshold=None,
+                    slow_query_log=None, query_summary_interval=None, admin_jids=None,
+                    diagnostics_dir='.', cpu_profile_duration=30,
+                    metrics_port=None, metrics_address='127.0.0.1',
+                    rate_limit=None, rate_limit_burst=10, runtime='threaded')
 
 
 class TestArgumentParsing(TestCase):
     """Test handling of parsing command line parameters."""
 
     @parameterized.expand([
-        ([], Namespace(domain='lobby.wildfiregames.com', login='EcheLOn', log_level=30,
-                       nickname='RatingsBot', password='XXXXXX', room='arena',
-                       database_url='sqlite:///lobby_rankings.sqlite3')),
-        (['--debug'],
-         Namespace(domain='lobby.wildfiregames.com', login='EcheLOn', log_level=10,
-                   nickname='RatingsBot', password='XXXXXX', room='arena',
-                   database_url='sqlite:///lobby_rankings.sqlite3')),
-        (['--quiet'],
-         Namespace(domain='lobby.wildfiregames.com', login='EcheLOn', log_level=40,
-                   nickname='RatingsBot', password='XXXXXX', room='arena',
-                   database_url='sqlite:///lobby_rankings.sqlite3')),
-        (['--verbose'],
-         Namespace(domain='lobby.wildfiregames.com', login='EcheLOn', log_level=20,
-                   nickname='RatingsBot', password='XXXXXX', room='arena',
-                   database_url='sqlite:///lobby_rankings.sqlite3')),
-        (['-m', 'lobby.domain.tld'],
-         Namespace(domain='lobby.domain.tld', login='EcheLOn', log_level=30, nickname='RatingsBot',
-                   password='XXXXXX', room='arena',
-                   database_url='sqlite:///lobby_rankings.sqlite3')),
+        ([], Namespace(**DEFAULT_ARGS)),
+        (['--debug'], Namespace(**dict(DEFAULT_ARGS, log_level=10))),
+        (['--quiet'], Namespace(**dict(DEFAULT_ARGS, log_level=40))),
+        (['--verbose'], Namespace(**dict(DEFAULT_ARGS, log_level=20))),
+        (['-m', 'lobby.domain.tld'], Namespace(**dict(DEFAULT_ARGS, domain='lobby.domain.tld'))),
         (['--domain=lobby.domain.tld'],
-         Namespace(domain='lobby.domain.tld', login='EcheLOn', log_level=30, nickname='RatingsBot',
-                   password='XXXXXX', room='arena',
-                   database_url='sqlite:///lobby_rankings.sqlite3')),
+         Namespace(**dict(DEFAULT_ARGS, domain='lobby.domain.tld'))),
         (['-m' 'lobby.domain.tld', '-l', 'bot', '-p', '123456', '-n', 'Bot', '-r', 'arena123',
           '-v'],
-         Namespace(domain='lobby.domain.tld', login='bot', log_level=20, nickname='Bot',
-                   password='123456', room='arena123',
-                   database_url='sqlite:///lobby_rankings.sqlite3')),
+         Namespace(**dict(DEFAULT_ARGS, domain='lobby.domain.tld', login='bot', log_level=20,
+                          nickname='Bot', password='123456', room='arena123'))),
         (['--domain=lobby.domain.tld', '--login=bot', '--password=123456', '--nickname=Bot',
           '--room=arena123', '--database-url=sqlite:////tmp/db.sqlite3', '--verbose'],
-         Namespace(domain='lobby.domain.tld', login='bot', log_level=20, nickname='Bot',
-                   password='123456', room='arena123',
-                   database_url='sqlite:////tmp/db.sqlite3')),
+         Namespace(**dict(DEFAULT_ARGS, domain='lobby.domain.tld', login='bot', log_level=20,
+                          nickname='Bot', password='123456', room='arena123',
+                          database_url='sqlite:////tmp/db.sqlite3'))),
+        (['--metrics-port=9090', '--metrics-address=0.0.0.0'],
+         Namespace(**dict(DEFAULT_ARGS, metrics_port=9090, metrics_address='0.0.0.0'))),
+        (['--slow-query-threshold=50', '--slow-query-log=/tmp/slow.log',
+          '--query-summary-interval=300'],
+         Namespace(**dict(DEFAULT_ARGS, slow_query_threshold=50.0, slow_query_log='/tmp/slow.log',
+                          query_summary_interval=300))),
+        (['--database-pool-size=5', '--database-max-overflow=10', '--database-pool-recycle=3600',
+          '--database-pool-pre-ping', '--database-statement-timeout=5000'],
+         Namespace(**dict(DEFAULT_ARGS, database_pool_size=5, database_max_overflow=10,
+                          database_pool_recycle=3600, database_pool_pre_ping=True,
+                          database_statement_timeout=5000))),
+        (['--rate-limit=0.5', '--rate-limit-burst=5'],
+         Namespace(**dict(DEFAULT_ARGS, rate_limit=0.5, rate_limit_burst=5))),
+        (['--runtime=asyncio'], Namespace(**dict(DEFAULT_ARGS, runtime='asyncio'))),
+        (['--database-read-url=postgresql://replica/lobby'],
+         Namespace(**dict(DEFAULT_ARGS, database_read_url='postgresql://replica/lobby'))),
+        (['--admin-jid=admin@lobby.domain.tld', '--diagnostics-dir=/tmp'],
+         Namespace(**dict(DEFAULT_ARGS, admin_jids=['admin@lobby.domain.tld'],
+                          diagnostics_dir='/tmp'))),
+        (['--cpu-profile-duration=5.5'],
+         Namespace(**dict(DEFAULT_ARGS, cpu_profile_duration=5.5))),
     ])
     def test_valid(self, cmd_args, expected_args):
         """Test valid parameter combinations."""
@@ -123,6 +866,8 @@ class TestArgumentParsing(TestCase):
         (['--quiet', '--verbose'],),
         (['--debug', '--verbose'],),
         (['--debug', '--quiet', '--verbose'],),
+        (['--cpu-profile-duration=0'],),
+        (['--cpu-profile-duration=601'],),
     ])
     def test_invalid(self, cmd_args):
         """Test invalid parameter combinations."""
@@ -138,13 +883,14 @@ class TestMain(TestCase):
         with patch('xpartamupp.echelon.parse_args') as args_mock, \
                 patch('xpartamupp.echelon.Leaderboard') as leaderboard_mock, \
                 patch('xpartamupp.echelon.EcheLOn') as xmpp_mock:
-            args_mock.return_value = Mock(log_level=30, login='EcheLOn',
-                                          domain='lobby.wildfiregames.com', password='XXXXXX',
-                                          room='arena', nickname='RatingsBot',
-                                          database_url='sqlite:///lobby_rankings.sqlite3')
+            args_mock.return_value = Namespace(**DEFAULT_ARGS)
             main()
             args_mock.assert_called_once_with(sys.argv[1:])
-            leaderboard_mock.assert_called_once_with('sqlite:///lobby_rankings.sqlite3')
+            leaderboard_mock.assert_called_once_with(
+                'sqlite:///lobby_rankings.sqlite3', query_profiler=None,
+                engine_options={'poolclass': QueuePool,
+                                'connect_args': {'check_same_thread': False}},
+                read_db_url=None, read_engine_options=None)
             xmpp_mock().register_plugin.assert_has_calls([call('xep_0004'), call('xep_0030'),
                                                           call('xep_0045'), call('xep_0060'),
                                                           call('xep_0199', {'keepalive': True})],
@@ -152,19 +898,90 @@ class TestMain(TestCase):
             xmpp_mock().connect.assert_called_once_with()
             xmpp_mock().process.assert_called_once_with()
 
+    def test_query_profiler(self):
+        """Test enabling the query profiler."""
+        with patch('xpartamupp.echelon.parse_args') as args_mock, \
+                patch('xpartamupp.echelon.Leaderboard') as leaderboard_mock, \
+                patch('xpartamupp.echelon.QueryProfiler') as profiler_mock, \
+                patch('xpartamupp.echelon.EcheLOn') as xmpp_mock:
+            args_mock.return_value = Namespace(**dict(DEFAULT_ARGS, slow_query_threshold=50.0,
+                                                      query_summary_interval=300))
+            main()
+            profiler_mock.assert_called_once_with(0.05)
+            leaderboard_mock.assert_called_once_with(
+                'sqlite:///lobby_rankings.sqlite3', query_profiler=profiler_mock(),
+                engine_options={'poolclass': QueuePool,
+                                'connect_args': {'check_same_thread': False}},
+                read_db_url=None, read_engine_options=None)
+            xmpp_mock().schedule.assert_called_once_with('Query summary', 300,
+                                                         profiler_mock().log_summary,
+                                                         repeat=True)
+
+    def test_read_replica(self):
+        """Test using a read replica of the leaderboard database."""
+        with patch('xpartamupp.echelon.parse_args') as args_mock, \
+                patch('xpartamupp.echelon.Leaderboard') as leaderboard_mock, \
+                patch('xpartamupp.echelon.EcheLOn'):
+            args_mock.return_value = Namespace(**dict(
+                DEFAULT_ARGS, database_read_url='postgresql://replica/lobby',
+                database_statement_timeout=5000))
+            main()
+            leaderboard_mock.assert_called_once_with(
+                'sqlite:///lobby_rankings.sqlite3', query_profiler=None,
+                engine_options={'poolclass': QueuePool,
+                                'connect_args': {'check_same_thread': False}},
+                read_db_url='postgresql://replica/lobby',
+                read_engine_options={'connect_args': {'options': '-c statement_timeout=5000'}})
+
+    @skipUnless(slixmpp, 'slixmpp is not installed')
+    def test_asyncio_runtime(self):
+        """Test running the asyncio-based bot."""
+        with patch('xpartamupp.echelon.parse_args') as args_mock, \
+                patch('xpartamupp.echelon.Leaderboard'), \
+                patch('xpartamupp.echelon.EcheLOn') as xmpp_mock, \
+                patch('xpartamupp.async_bots.AsyncEcheLOn') as async_xmpp_mock:
+            args_mock.return_value = Namespace(**dict(DEFAULT_ARGS, runtime='asyncio'))
+            main()
+            xmpp_mock.assert_not_called()
+            async_xmpp_mock().connect.assert_called_once_with()
+            async_xmpp_mock().process.assert_called_once_with()
+
+    @skipUnless(slixmpp, 'slixmpp is not installed')
+    def test_asyncio_runtime_start(self):
+        """Test starting the asyncio-based bot, whose connect() returns nothing."""
+        with patch('xpartamupp.echelon.parse_args') as args_mock, \
+                patch('xpartamupp.echelon.Leaderboard'), \
+                patch('slixmpp.ClientXMPP.connect', return_value=None) as connect_mock, \
+                patch('xpartamupp.async_bots.AsyncEcheLOn.process') as process_mock:
+            args_mock.return_value = Namespace(**dict(DEFAULT_ARGS, runtime='asyncio'))
+            main()
+            connect_mock.assert_called_once_with(ANY)
+            process_mock.assert_called_once_with()
+
+    def test_rate_limit(self):
+        """Test enabling rate limiting."""
+        with patch('xpartamupp.echelon.parse_args') as args_mock, \
+                patch('xpartamupp.echelon.Leaderboard'), \
+                patch('xpartamupp.echelon.EcheLOn') as xmpp_mock:
+            args_mock.return_value = Namespace(**dict(DEFAULT_ARGS, rate_limit=0.5,
+                                                      rate_limit_burst=5))
+            main()
+            xmpp_mock().set_rate_limit.assert_called_once_with(0.5, 5)
+
     def test_failing_connect(self):
         """Test failing connect to XMPP server."""
         with patch('xpartamupp.echelon.parse_args') as args_mock, \
                 patch('xpartamupp.echelon.Leaderboard') as leaderboard_mock, \
                 patch('xpartamupp.echelon.EcheLOn') as xmpp_mock:
-            args_mock.return_value = Mock(log_level=30, login='EcheLOn',
-                                          domain='lobby.wildfiregames.com', password='XXXXXX',
-                                          room='arena', nickname='RatingsBot',
-                                          database_url='sqlite:///lobby_rankings.sqlite3')
+            args_mock.return_value = Namespace(**DEFAULT_ARGS)
             xmpp_mock().connect.return_value = False
             main()
             args_mock.assert_called_once_with(sys.argv[1:])
-            leaderboard_mock.assert_called_once_with('sqlite:///lobby_rankings.sqlite3')
+            leaderboard_mock.assert_called_once_with(
+                'sqlite:///lobby_rankings.sqlite3', query_profiler=None,
+                engine_options={'poolclass': QueuePool,
+                                'connect_args': {'check_same_thread': False}},
+                read_db_url=None, read_engine_options=None)
             xmpp_mock().register_plugin.assert_has_calls([call('xep_0004'), call('xep_0030'),
                                                           call('xep_0045'), call('xep_0060'),
                                                           call('xep_0199', {'keepalive': True})],
@@ -18,24 +18,64 @@
 
 """Tests for the database schema."""
 
+import gzip
+import os
 import sys
+import tempfile
 
 from argparse import Namespace
 from unittest import TestCase
 from unittest.mock import Mock, patch
 
 from parameterized import parameterized
+from sqlalchemy import create_engine, inspect, select
+from sqlalchemy.orm import sessionmaker
 
-from xpartamupp.lobby_ranking import main, parse_args
+from xpartamupp.lobby_ranking import (MIGRATIONS, Base, CivStats, Game, MapCivStats, Player,
+                                      PlayerCivStats, PlayerInfo, PlayerInfoArchive,
+                                      archive_player_info, create_schema, export_database,
+                                      get_schema_version, import_database, main, parse_args,
+                                      upgrade)
+
+DEFAULT_ARGS = dict(database_url='sqlite:///lobby_rankings.sqlite3',
+                    file='lobby_rankings.jsonl.gz', chunk_size=10000, keep_games=100000)
+
+
+def create_database():
+    """Create an in-memory database with some players and games.
+
+    Returns:
+        sqlalchemy.engine.Engine of the database
+
+    """
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(Player.__table__.insert(),
+                           [{'id': i, 'jid': 'player%i@lobby.tld' % i, 'rating': 1200 + i,
+                             'highest_rating': 1300} for i in range(1, 6)])
+        connection.execute(Game.__table__.insert(),
+                           [{'id': i, 'map': 'Mainland', 'duration': 600, 'teamsLocked': True,
+                             'matchID': 'match%i' % i, 'winner_id': 1} for i in range(1, 4)])
+        connection.execute(PlayerInfo.__table__.insert(),
+                           [{'player_id': 1 + i % 5, 'game_id': 1 + i % 3, 'civs': 'athen',
+                             'teams': 0, 'totalScore': i} for i in range(6)])
+    return engine
 
 
 class TestArgumentParsing(TestCase):
     """Test handling of parsing command line parameters."""
 
     @parameterized.expand([
-        (['create'], Namespace(action='create', database_url='sqlite:///lobby_rankings.sqlite3')),
+        (['create'], Namespace(**dict(DEFAULT_ARGS, action='create'))),
         (['--database-url', 'sqlite:////tmp/db.sqlite3', 'create'],
-         Namespace(action='create', database_url='sqlite:////tmp/db.sqlite3')),
+         Namespace(**dict(DEFAULT_ARGS, action='create',
+                          database_url='sqlite:////tmp/db.sqlite3'))),
+        (['export', '--file', '/tmp/backup.jsonl.gz', '--chunk-size', '500'],
+         Namespace(**dict(DEFAULT_ARGS, action='export', file='/tmp/backup.jsonl.gz',
+                          chunk_size=500))),
+        (['import'], Namespace(**dict(DEFAULT_ARGS, action='import'))),
+        (['upgrade'], Namespace(**dict(DEFAULT_ARGS, action='upgrade'))),
     ])
     def test_valid(self, cmd_args, expected_args):
         """Test valid parameter combinations."""
@@ -58,7 +98,7 @@ class TestMain(TestCase):
         """Test successful execution."""
         with patch('xpartamupp.lobby_ranking.parse_args') as args_mock, \
                 patch('xpartamupp.lobby_ranking.create_engine') as create_engine_mock, \
-                patch('xpartamupp.lobby_ranking.Base') as declarative_base_mock:
+                patch('xpartamupp.lobby_ranking.create_schema') as create_schema_mock:
             args_mock.return_value = Mock(action='create',
                                           database_url='sqlite:///lobby_rankings.sqlite3')
             engine_mock = Mock()
@@ -67,4 +107,211 @@ class TestMain(TestCase):
             args_mock.assert_called_once_with(sys.argv[1:])
             create_engine_mock.assert_called_once_with(
                 'sqlite:///lobby_rankings.sqlite3')
-            declarative_base_mock.metadata.create_all.assert_any_call(engine_mock)
+            create_schema_mock.assert_called_once_with(engine_mock)
+
+    def test_upgrade(self):
+        """Test upgrading the database."""
+        with patch('xpartamupp.lobby_ranking.parse_args') as args_mock, \
+                patch('xpartamupp.lobby_ranking.create_engine') as create_engine_mock, \
+                patch('xpartamupp.lobby_ranking.upgrade') as upgrade_mock:
+            args_mock.return_value = Mock(action='upgrade', **DEFAULT_ARGS)
+            main()
+            upgrade_mock.assert_called_once_with(create_engine_mock())
+
+    def test_export(self):
+        """Test exporting the database."""
+        with patch('xpartamupp.lobby_ranking.parse_args') as args_mock, \
+                patch('xpartamupp.lobby_ranking.create_engine') as create_engine_mock, \
+                patch('xpartamupp.lobby_ranking.export_database') as export_mock:
+            args_mock.return_value = Mock(action='export', **DEFAULT_ARGS)
+            main()
+            export_mock.assert_called_once_with(create_engine_mock(),
+                                                'lobby_rankings.jsonl.gz', 10000)
+
+    def test_import_failure(self):
+        """Test exiting if the import fails."""
+        with patch('xpartamupp.lobby_ranking.parse_args') as args_mock, \
+                patch('xpartamupp.lobby_ranking.create_engine'), \
+                patch('xpartamupp.lobby_ranking.import_database') as import_mock:
+            args_mock.return_value = Mock(action='import', **DEFAULT_ARGS)
+            import_mock.side_effect = ValueError("Table players isn't empty")
+            with self.assertRaises(SystemExit):
+                main()
+
+    def test_archive(self):
+        """Test archiving old game results."""
+        with patch('xpartamupp.lobby_ranking.parse_args') as args_mock, \
+                patch('xpartamupp.lobby_ranking.create_engine') as create_engine_mock, \
+                patch('xpartamupp.lobby_ranking.archive_player_info') as archive_mock:
+            args_mock.return_value = Mock(action='archive', **DEFAULT_ARGS)
+            main()
+            archive_mock.assert_called_once_with(create_engine_mock(), 100000, 10000)
+
+
+class TestMigrations(TestCase):
+    """Test versioned migrations of the schema."""
+
+    def _get_indexes(self, engine, table):
+        """Get the names of the indexes of a table."""
+        return {index['name'] for index in inspect(engine).get_indexes(table)}
+
+    def test_create(self):
+        """Test that new databases get the current schema version."""
+        engine = create_engine('sqlite://')
+        create_schema(engine)
+        with engine.connect() as connection:
+            self.assertEqual(get_schema_version(connection), len(MIGRATIONS))
+        self.assertEqual(upgrade(engine), [])
+
+    def test_upgrade_empty(self):
+        """Test that upgrading an empty database creates the schema."""
+        engine = create_engine('sqlite://')
+        self.assertEqual(upgrade(engine), [len(MIGRATIONS)])
+        self.assertIn('ix_players_info_player_id_game_id',
+                      self._get_indexes(engine, 'players_info'))
+
+    def test_migration_snapshot(self):
+        """Test that migrations create tables as of their version."""
+        engine = create_engine('sqlite://')
+        with engine.begin() as connection:
+            connection.execute('CREATE TABLE players (id INTEGER PRIMARY KEY, jid VARCHAR(255), '
+                               'rating INTEGER, highest_rating INTEGER)')
+            connection.execute('CREATE TABLE games (id INTEGER PRIMARY KEY, winner_id INTEGER, '
+                               '"matchID" VARCHAR(20))')
+            connection.execute('CREATE TABLE players_info (id INTEGER PRIMARY KEY, '
+                               'player_id INTEGER, game_id INTEGER)')
+            for migration in MIGRATIONS[:3]:
+                migration(connection)
+        self.assertEqual(self._get_indexes(engine, 'players_info_archive'),
+                         {'ix_players_info_archive_player_id'})
+
+    @parameterized.expand([
+        (True,),
+        (False,),
+    ])
+    def test_upgrade_baseline(self, create_first):
+        """Test upgrading a database created before migrations existed."""
+        engine = create_engine('sqlite://')
+        with engine.begin() as connection:
+            connection.execute('CREATE TABLE players (id INTEGER PRIMARY KEY, jid VARCHAR(255), '
+                               'rating INTEGER, highest_rating INTEGER)')
+            connection.execute('CREATE TABLE games (id INTEGER PRIMARY KEY, map VARCHAR(80), '
+                               'duration INTEGER, "teamsLocked" BOOLEAN, '
+                               '"matchID" VARCHAR(20), winner_id INTEGER)')
+            connection.execute('CREATE TABLE players_info (id INTEGER PRIMARY KEY, '
+                               'player_id INTEGER, game_id INTEGER, civs VARCHAR(20), '
+                               'teams INTEGER)')
+            connection.execute("INSERT INTO players (jid, rating) VALUES ('player1', 1500), "
+                               "('player2', 1400)")
+            connection.execute("INSERT INTO games (map, winner_id) VALUES ('Mainland', 1), "
+                               "('Mainland', 2), ('Arcadia', 1)")
+            connection.execute("INSERT INTO players_info (player_id, game_id, civs) VALUES "
+                               "(1, 1, 'athen'), (2, 1, 'brit'), (1, 2, 'athen'), "
+                               "(2, 2, 'athen'), (1, 3, 'brit'), (2, 3, 'brit')")
+            self.assertEqual(get_schema_version(connection), 0)
+
+        if create_first:
+            create_schema(engine)
+        self.assertEqual(upgrade(engine), list(range(1, len(MIGRATIONS) + 1)))
+        self.assertEqual(upgrade(engine), [])
+        with engine.connect() as connection:
+            self.assertEqual(get_schema_version(connection), len(MIGRATIONS))
+            self.assertEqual(connection.execute(select([Player.version])).scalar(), 1)
+        self.assertEqual(self._get_indexes(engine, 'players_info'),
+                         {'ix_players_info_player_id_game_id', 'ix_players_info_game_id'})
+        self.assertEqual(self._get_indexes(engine, 'players_info_archive'),
+                         {'ix_players_info_archive_player_id_game_id',
+                          'ix_players_info_archive_game_id'})
+        self.assertIn('rating_change', {column['name'] for column
+                                        in inspect(engine).get_columns('players_info')})
+        self.assertEqual(self._get_indexes(engine, 'games'),
+                         {'ix_games_winner_id', 'ix_games_matchID'})
+        self.assertIn('ix_players_rating_id', self._get_indexes(engine, 'players'))
+        self.assertEqual({column['name'] for column
+                          in inspect(engine).get_columns('players_info_archive')},
+                         {column.name for column in PlayerInfoArchive.__table__.columns})
+        with engine.connect() as connection:
+            def get_rows(model):
+                return sorted(tuple(row) for row in connection.execute(select([model.__table__])))
+            self.assertEqual(get_rows(CivStats), [('athen', 3, 2), ('brit', 3, 1)])
+            self.assertEqual(get_rows(MapCivStats), [('Arcadia', 'brit', 2, 1),
+                                                     ('Mainland', 'athen', 3, 2),
+                                                     ('Mainland', 'brit', 1, 0)])
+            self.assertEqual(get_rows(PlayerCivStats), [(1, 'athen', 2, 1), (1, 'brit', 1, 1),
+                                                        (2, 'athen', 1, 1), (2, 'brit', 2, 0)])
+
+
+class TestExportImport(TestCase):
+    """Test exporting and importing the database."""
+
+    def setUp(self):
+        """Set up a database with some players and games."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'export.jsonl.gz')
+        self.engine = create_database()
+
+    def tearDown(self):
+        """Remove the exported file."""
+        self.directory.cleanup()
+
+    def _dump(self, engine):
+        """Get all rows of the exported tables."""
+        with engine.connect() as connection:
+            return [connection.execute(select([table]).order_by(table.c.id)).fetchall()
+                    for table in (Player.__table__, Game.__table__, PlayerInfo.__table__,
+                                  PlayerInfoArchive.__table__)]
+
+    def test_round_trip(self):
+        """Test that an imported export contains the same rows."""
+        counts = export_database(self.engine, self.path, chunk_size=2)
+        self.assertEqual(counts, {'players': 5, 'games': 3, 'players_info': 6,
+                                  'players_info_archive': 0, 'civ_stats': 0,
+                                  'map_civ_stats': 0, 'player_civ_stats': 0})
+        target = create_engine('sqlite://')
+        self.assertEqual(import_database(target, self.path, chunk_size=4), counts)
+        self.assertEqual(self._dump(target), self._dump(self.engine))
+
+    def test_import_not_empty(self):
+        """Test that importing into a database with data fails."""
+        export_database(self.engine, self.path)
+        with self.assertRaises(ValueError):
+            import_database(self.engine, self.path)
+
+    def test_import_invalid(self):
+        """Test that importing a file of another format fails."""
+        with gzip.open(self.path, 'wt') as export_file:
+            export_file.write('{"format": "something-else"}\n')
+        with self.assertRaises(ValueError):
+            import_database(create_engine('sqlite://'), self.path)
+
+
+class TestArchive(TestCase):
+    """Test archiving old game results."""
+
+    def setUp(self):
+        """Set up a database with some players and games."""
+        self.engine = create_database()
+        self.db = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        """Close the session."""
+        self.db.close()
+
+    def test_archive(self):
+        """Test that results of old games get moved to the archive."""
+        self.assertEqual(archive_player_info(self.engine, keep_games=1, batch_size=3), 4)
+        self.assertEqual(archive_player_info(self.engine, keep_games=1, batch_size=3), 0)
+        self.assertEqual([info.game_id for info in self.db.query(PlayerInfo)], [3, 3])
+        archived = self.db.query(PlayerInfoArchive).order_by(PlayerInfoArchive.id).all()
+        self.assertEqual([(info.player_id, info.game_id) for info in archived],
+                         [(1, 1), (2, 2), (4, 1), (5, 2)])
+        self.assertEqual(archived[2].get_stats()['totalScore'], 3)
+        self.assertNotIn('foodGathered', archived[2].get_stats())
+        self.assertEqual({player.id: player.archived_games for player in self.db.query(Player)},
+                         {1: 1, 2: 1, 3: 0, 4: 1, 5: 1})
+        self.assertEqual(self.db.query(Game).count(), 3)
+
+    def test_keep_all(self):
+        """Test that nothing gets archived if there are too few games."""
+        self.assertEqual(archive_player_info(self.engine, keep_games=3), 0)
+        self.assertEqual(self.db.query(PlayerInfo).count(), 6)
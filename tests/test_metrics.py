@@ -0,0 +1,152 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests for the collection and exposition of metrics."""
+
+from unittest import TestCase
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from sqlalchemy import create_engine
+
+from xpartamupp.metrics import (DB_QUERIES, IQ_REQUESTS, Registry, instrument_engine,
+                                instrument_handler, start_metrics_server)
+
+
+class TestRegistry(TestCase):
+    """Test rendering of metrics in the Prometheus text format."""
+
+    def setUp(self):
+        """Set up an empty registry."""
+        self.registry = Registry()
+
+    def test_counter(self):
+        """Test rendering of a counter with labels."""
+        counter = self.registry.counter('test_total', "Test counter", ('handler',))
+        counter.inc(handler='a')
+        counter.inc(2, handler='a')
+        counter.inc(handler='b"\\')
+        self.assertEqual(self.registry.render(),
+                         '# HELP test_total Test counter\n'
+                         '# TYPE test_total counter\n'
+                         'test_total{handler="a"} 3\n'
+                         'test_total{handler="b\\"\\\\"} 1\n')
+
+    def test_unlabeled_initialized(self):
+        """Test that metrics without labels start at zero."""
+        self.registry.counter('test_total', "Test counter")
+        self.registry.histogram('test_seconds', "Test histogram", buckets=(1,))
+        self.assertEqual(self.registry.render(),
+                         '# HELP test_seconds Test histogram\n'
+                         '# TYPE test_seconds histogram\n'
+                         'test_seconds_bucket{le="1"} 0\n'
+                         'test_seconds_bucket{le="+Inf"} 0\n'
+                         'test_seconds_sum 0\n'
+                         'test_seconds_count 0\n'
+                         '# HELP test_total Test counter\n'
+                         '# TYPE test_total counter\n'
+                         'test_total 0\n')
+
+    def test_counter_invalid_labels(self):
+        """Test that labels have to match the label names."""
+        counter = self.registry.counter('test_total', "Test counter", ('handler',))
+        with self.assertRaises(ValueError):
+            counter.inc(room='arena')
+
+    def test_get_existing(self):
+        """Test that metrics are only created once per name."""
+        counter = self.registry.counter('test_total', "Test counter")
+        self.assertIs(self.registry.counter('test_total', "Test counter"), counter)
+        with self.assertRaises(ValueError):
+            self.registry.gauge('test_total', "Test gauge")
+
+    def test_gauge_callback(self):
+        """Test gauges getting their values from callbacks."""
+        self.registry.gauge('test_queue', "Test gauge", ('queue',),
+                            callback=lambda: {('send',): 2, ('event',): 0})
+        self.registry.gauge('test_games', "Test gauge", callback=lambda: 1 / 0)
+        self.assertEqual(self.registry.render(),
+                         '# HELP test_games Test gauge\n'
+                         '# TYPE test_games gauge\n'
+                         '# HELP test_queue Test gauge\n'
+                         '# TYPE test_queue gauge\n'
+                         'test_queue{queue="event"} 0\n'
+                         'test_queue{queue="send"} 2\n')
+
+    def test_histogram(self):
+        """Test rendering of a histogram."""
+        histogram = self.registry.histogram('test_seconds', "Test histogram", buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(self.registry.render(),
+                         '# HELP test_seconds Test histogram\n'
+                         '# TYPE test_seconds histogram\n'
+                         'test_seconds_bucket{le="0.1"} 1\n'
+                         'test_seconds_bucket{le="1"} 2\n'
+                         'test_seconds_bucket{le="+Inf"} 3\n'
+                         'test_seconds_sum 5.55\n'
+                         'test_seconds_count 3\n')
+
+
+class TestInstrumentation(TestCase):
+    """Test instrumentation of handlers and database engines."""
+
+    def test_instrument_handler(self):
+        """Test counting calls of handlers."""
+        handler = instrument_handler('test')(lambda iq: iq)
+        before = dict((labels, value) for _, labels, value in IQ_REQUESTS.samples())
+        self.assertEqual(handler('iq'), 'iq')
+        after = dict((labels, value) for _, labels, value in IQ_REQUESTS.samples())
+        self.assertEqual(after[(('handler', 'test'),)],
+                         before.get((('handler', 'test'),), 0) + 1)
+
+    def test_instrument_engine(self):
+        """Test counting of executed SQL statements."""
+        engine = create_engine('sqlite://')
+        instrument_engine(engine)
+        before = DB_QUERIES.samples()[0][2]
+        engine.execute('SELECT 1')
+        self.assertEqual(DB_QUERIES.samples()[0][2], before + 1)
+
+
+class TestMetricsServer(TestCase):
+    """Test the HTTP server exposing metrics."""
+
+    def setUp(self):
+        """Start a metrics server on a random port."""
+        self.registry = Registry()
+        self.registry.counter('test_total', "Test counter").inc()
+        self.server = start_metrics_server(0, registry=self.registry)
+        self.url = 'http://127.0.0.1:%i' % self.server.server_port
+
+    def tearDown(self):
+        """Stop the metrics server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_metrics(self):
+        """Test retrieving metrics."""
+        with urlopen(self.url + '/metrics') as response:
+            self.assertEqual(response.headers['Content-Type'],
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.assertEqual(response.read().decode('utf-8'), self.registry.render())
+
+    def test_not_found(self):
+        """Test retrieving an unknown path."""
+        with self.assertRaises(HTTPError):
+            urlopen(self.url + '/foo')
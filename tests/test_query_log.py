@@ -0,0 +1,143 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests for the instrumentation of SQL statements."""
+
+from unittest import TestCase
+from unittest.mock import Mock
+
+from sqlalchemy import create_engine
+
+from xpartamupp.query_log import (QueryProfiler, get_current_context, normalize_statement,
+                                  query_context)
+
+
+class TestQueryContext(TestCase):
+    """Test attribution of statements to callers."""
+
+    def test_nested(self):
+        """Test nesting of contexts."""
+        self.assertEqual(get_current_context(), 'unknown')
+        with query_context('profile'):
+            self.assertEqual(get_current_context(), 'profile')
+            with query_context('get_profile'):
+                self.assertEqual(get_current_context(), 'profile/get_profile')
+            self.assertEqual(get_current_context(), 'profile')
+        self.assertEqual(get_current_context(), 'unknown')
+
+    def test_decorator(self):
+        """Test using contexts as decorator."""
+        func = query_context('get_board')(get_current_context)
+        self.assertEqual(func(), 'get_board')
+        self.assertEqual(get_current_context(), 'unknown')
+
+
+class TestQueryProfiler(TestCase):
+    """Test recording of statistics about SQL statements."""
+
+    def setUp(self):
+        """Set up an instrumented database."""
+        self.engine = create_engine('sqlite://')
+        self.engine.execute('CREATE TABLE players (id INTEGER PRIMARY KEY, rating INTEGER)')
+
+    def test_top_queries(self):
+        """Test aggregation of statements per caller."""
+        profiler = QueryProfiler()
+        profiler.instrument(self.engine)
+        with query_context('get_board'):
+            for _ in range(3):
+                self.engine.execute('SELECT * FROM players ORDER BY rating')
+        self.engine.execute('SELECT 1')
+        top_queries = profiler.get_top_queries()
+        self.assertEqual(len(top_queries), 2)
+        queries = {query['statement']: query for query in top_queries}
+        self.assertEqual(queries['SELECT * FROM players ORDER BY rating']['count'], 3)
+        self.assertEqual(queries['SELECT * FROM players ORDER BY rating']['caller'], 'get_board')
+        self.assertEqual(queries['SELECT 1']['caller'], 'unknown')
+        self.assertEqual(profiler.get_top_queries(limit=1)[0], max(
+            top_queries, key=lambda query: query['total']))
+
+    def test_variable_lists_aggregated(self):
+        """Test that statements differing in the length of lists are aggregated."""
+        profiler = QueryProfiler()
+        profiler.instrument(self.engine)
+        for count in range(1, 4):
+            self.engine.execute('SELECT * FROM players WHERE id IN (%s)' %
+                                ', '.join(['?'] * count), *range(count))
+        self.assertEqual([(query['statement'], query['count'])
+                          for query in profiler.get_top_queries()],
+                         [('SELECT * FROM players WHERE id IN (...)', 3)])
+
+    def test_normalize_statement(self):
+        """Test collapsing lists of bind parameters."""
+        self.assertEqual(normalize_statement('INSERT INTO players (id, rating) VALUES '
+                                             '(%(id_1)s, %(rating_1)s), (%(id_2)s, %(rating_2)s)'),
+                         'INSERT INTO players (id, rating) VALUES (...)')
+        self.assertEqual(normalize_statement('SELECT lower(?) FROM players WHERE id = ?'),
+                         'SELECT lower(?) FROM players WHERE id = ?')
+
+    def test_evict_lowest_total(self):
+        """Test that the statement with the lowest total time gets evicted."""
+        profiler = QueryProfiler(max_statements=2)
+        profiler.record('get_board', 'SELECT 1', 0.5)
+        profiler.record('get_board', 'SELECT 2', 0.1)
+        profiler.record('get_board', 'SELECT 3', 0.2)
+        self.assertEqual([query['statement'] for query in profiler.get_top_queries()],
+                         ['SELECT 1', 'SELECT 3'])
+        profiler.record('get_board', 'SELECT 3', 0.4)
+        profiler.record('get_board', 'SELECT 4', 0.3)
+        self.assertEqual([query['statement'] for query in profiler.get_top_queries()],
+                         ['SELECT 3', 'SELECT 4'])
+
+    def test_slow_query_log(self):
+        """Test logging of slow statements with their query plan."""
+        profiler = QueryProfiler(slow_query_threshold=0)
+        profiler.instrument(self.engine)
+        with self.assertLogs('xpartamupp.slow_queries') as logs:
+            with query_context('get_board'):
+                self.engine.execute('SELECT * FROM players WHERE rating > ?', 1000)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('from get_board: SELECT * FROM players WHERE rating > ?', logs.output[0])
+        self.assertIn('Query plan:', logs.output[0])
+        self.assertIn('SCAN', logs.output[0])
+
+    def test_query_plan_savepoint(self):
+        """Test that failing to get a query plan doesn't abort the transaction."""
+        def execute(statement, *args):  # pylint: disable=unused-argument
+            if statement.startswith('EXPLAIN'):
+                raise ValueError("EXPLAIN failed")
+
+        conn = Mock()
+        conn.dialect.name = 'postgresql'
+        cursor = conn.connection.cursor()
+        cursor.execute.side_effect = execute
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(QueryProfiler._get_query_plan(  # pylint: disable=protected-access
+                conn, 'SELECT 1', ()))
+        self.assertEqual([args[0] for args, _ in cursor.execute.call_args_list],
+                         ['SAVEPOINT query_plan', 'EXPLAIN SELECT 1',
+                          'ROLLBACK TO SAVEPOINT query_plan', 'RELEASE SAVEPOINT query_plan'])
+        cursor.close.assert_called_once_with()
+
+    def test_summary(self):
+        """Test logging a summary of the top queries."""
+        profiler = QueryProfiler()
+        profiler.instrument(self.engine)
+        self.engine.execute('SELECT 1')
+        with self.assertLogs(level='INFO') as logs:
+            profiler.log_summary()
+        self.assertIn('Top 1 queries by total time', logs.output[0])
@@ -0,0 +1,159 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests for the 0ad-specific XMPP-stanzas."""
+
+from unittest import TestCase
+
+from parameterized import parameterized
+from sleekxmpp.xmlstream import ET
+
+from xpartamupp.stanzas import (BoardListXmppPlugin, GameListXmppPlugin, GameReportXmppPlugin,
+                                ProfileXmppPlugin, StatsXmppPlugin)
+
+
+class TestBoardList(TestCase):
+    """Test the boardlist stanza extension."""
+
+    @parameterized.expand([
+        ('boardlist',),
+        ('<injected/>',),
+        ('foo & bar',),
+    ])
+    def test_add_command(self, command):
+        """Test that commands are properly escaped."""
+        stanza = BoardListXmppPlugin()
+        stanza.add_command(command)
+        parsed = BoardListXmppPlugin(ET.fromstring(str(stanza)))
+        self.assertEqual(parsed['command'], command)
+        self.assertEqual(len(parsed.xml), 1)
+
+    def test_add_items(self):
+        """Test adding multiple items at once."""
+        stanza = BoardListXmppPlugin()
+        stanza.add_items([('player1', 1200), ('player2', '')])
+        single_stanza = BoardListXmppPlugin()
+        single_stanza.add_item('player1', 1200)
+        single_stanza.add_item('player2', '')
+        self.assertEqual(str(stanza), str(single_stanza))
+        self.assertEqual([board.attrib for board in stanza.xml],
+                         [{'name': 'player1', 'rating': '1200'},
+                          {'name': 'player2', 'rating': ''}])
+
+    def test_pagination(self):
+        """Test the interfaces used for paginating the leaderboard."""
+        stanza = BoardListXmppPlugin()
+        stanza.add_command('getleaderboard')
+        stanza['limit'] = '50'
+        stanza['cursor'] = '1300,42'
+        parsed = BoardListXmppPlugin(ET.fromstring(str(stanza)))
+        self.assertEqual(parsed['command'], 'getleaderboard')
+        self.assertEqual(parsed['limit'], '50')
+        self.assertEqual(parsed['cursor'], '1300,42')
+        self.assertEqual(parsed['position'], '')
+
+
+class TestGameList(TestCase):
+    """Test the gamelist stanza extension."""
+
+    def test_add_items(self):
+        """Test adding multiple games at once."""
+        games = [{'name': 'game1', 'state': 'init'}, {'name': 'game2', 'state': 'running'}]
+        stanza = GameListXmppPlugin()
+        stanza.add_items(games)
+        self.assertEqual([game.attrib for game in stanza.xml], games)
+        parsed = GameListXmppPlugin(ET.fromstring(str(stanza)))
+        self.assertDictEqual(parsed['game'], games[0])
+
+    def test_add_elements(self):
+        """Test adding prebuilt game elements."""
+        tag = '{%s}game' % GameListXmppPlugin.namespace
+        elements = [ET.Element(tag, {'name': 'game1'}), ET.Element(tag, {'name': 'game2'})]
+        stanza = GameListXmppPlugin()
+        stanza.add_elements(elements)
+        parsed = GameListXmppPlugin(ET.fromstring(str(stanza)))
+        self.assertDictEqual(parsed['game'], {'name': 'game1'})
+        self.assertEqual(len(parsed.xml), 2)
+
+
+class TestGameReport(TestCase):
+    """Test the gamereport stanza extension."""
+
+    def test_add_game_from_stanza(self):
+        """Test copying a game from another report."""
+        report = GameReportXmppPlugin()
+        report.add_game({'mapName': 'Alpine Lakes', 'matchID': 'abc'})
+        copied_report = GameReportXmppPlugin()
+        copied_report.add_game(report)
+        self.assertDictEqual(copied_report['game'], {'mapName': 'Alpine Lakes', 'matchID': 'abc'})
+        self.assertIsNot(copied_report.xml[0], report.xml[0])
+
+
+class TestProfile(TestCase):
+    """Test the profile stanza extension."""
+
+    def test_add_command_escaped(self):
+        """Test that nicks with special characters are escaped."""
+        stanza = ProfileXmppPlugin()
+        stanza.add_command('<b>&nick')
+        stanza.add_item('<b>&nick', 1500, 1600, 3, 10, 7, 3)
+        parsed = ET.fromstring(str(stanza))
+        self.assertEqual(parsed.find('{jabber:iq:profile}command').text, '<b>&nick')
+        self.assertDictEqual(parsed.find('{jabber:iq:profile}profile').attrib,
+                             {'player': '<b>&nick', 'rating': '1500', 'highestRating': '1600',
+                              'rank': '3', 'totalGamesPlayed': '10', 'wins': '7',
+                              'losses': '3'})
+
+    def test_add_games(self):
+        """Test adding games of the match history of a player."""
+        stanza = ProfileXmppPlugin()
+        stanza.add_command('john')
+        stanza['history'] = '2'
+        stanza['cursor'] = '7'
+        stanza.add_games([
+            {'id': 12, 'map': 'Mainland', 'duration': 900, 'civ': 'athen', 'team': 0,
+             'result': 'won', 'ratingChange': -3, 'players': [('bob', 'brit', 1)]},
+            {'id': 7, 'map': 'Arcadia', 'duration': 600, 'civ': 'gaul', 'team': 0,
+             'result': 'lost', 'ratingChange': None, 'players': []}])
+        parsed = ProfileXmppPlugin(ET.fromstring(str(stanza)))
+        self.assertEqual(parsed['command'], 'john')
+        self.assertEqual(parsed['history'], '2')
+        self.assertEqual(parsed['cursor'], '7')
+        self.assertEqual(parsed.get_games(), [
+            {'id': '12', 'map': 'Mainland', 'duration': '900', 'civ': 'athen', 'team': '0',
+             'result': 'won', 'ratingChange': '-3',
+             'players': [{'name': 'bob', 'civ': 'brit', 'team': '1'}]},
+            {'id': '7', 'map': 'Arcadia', 'duration': '600', 'civ': 'gaul', 'team': '0',
+             'result': 'lost', 'players': []}])
+
+
+class TestStats(TestCase):
+    """Test the civilization statistics stanza extension."""
+
+    def test_add_items(self):
+        """Test adding the statistics of multiple civilizations."""
+        stanza = StatsXmppPlugin()
+        stanza.add_command('player')
+        stanza['player'] = 'john'
+        stanza['favouriteCiv'] = 'athen'
+        stanza.add_items([('athen', 10, 7), ('brit', 2, 0)])
+        parsed = StatsXmppPlugin(ET.fromstring(str(stanza)))
+        self.assertEqual(parsed['command'], 'player')
+        self.assertEqual(parsed['player'], 'john')
+        self.assertEqual(parsed['favouriteCiv'], 'athen')
+        self.assertEqual(parsed.get_items(), [{'name': 'athen', 'games': '10', 'wins': '7'},
+                                              {'name': 'brit', 'games': '2', 'wins': '0'}])
@@ -16,12 +16,15 @@
 
 """Tests for utility functions."""
 
+import threading
+import time
 from unittest import TestCase
+from unittest.mock import Mock
 
 from hypothesis import given
 from hypothesis import strategies as st
 
-from xpartamupp.utils import LimitedSizeDict
+from xpartamupp.utils import LimitedSizeDict, SingleFlight, TokenBucketLimiter
 
 
 class TestLimitedSizeDict(TestCase):
@@ -43,3 +46,97 @@ class TestLimitedSizeDict(TestCase):
         self.assertFalse(0 in test_dict.values())
         self.assertTrue(1 in test_dict.values())
         self.assertTrue(size_limit + 1 in test_dict.values())
+
+
+class TestTokenBucketLimiter(TestCase):
+    """Test rate limiting with token buckets."""
+
+    def test_burst_and_refill(self):
+        """Test that buckets allow bursts and refill over time."""
+        clock = Mock(return_value=100.0)
+        limiter = TokenBucketLimiter(rate=2, burst=3, clock=clock)
+        self.assertEqual([limiter.allow('john') for _ in range(4)], [True, True, True, False])
+        self.assertTrue(limiter.allow('jane'))
+
+        clock.return_value = 100.25
+        self.assertFalse(limiter.allow('john'))
+        clock.return_value = 100.5
+        self.assertTrue(limiter.allow('john'))
+        self.assertFalse(limiter.allow('john'))
+
+        clock.return_value = 200.0
+        self.assertEqual([limiter.allow('john') for _ in range(4)], [True, True, True, False])
+
+    @given(st.integers(min_value=1, max_value=2**8))
+    def test_bounded(self, size_limit):
+        """Test that only the buckets of recent keys are kept."""
+        limiter = TokenBucketLimiter(rate=1, burst=1, size_limit=size_limit, clock=lambda: 0)
+        limiter.allow('recent')
+        for i in range(size_limit * 2):
+            limiter.allow(i)
+            limiter.allow('recent')
+        self.assertEqual(len(limiter.buckets), size_limit)
+        self.assertIn('recent', limiter.buckets)
+
+
+class TestSingleFlight(TestCase):
+    """Test coalescing of concurrent calls."""
+
+    def _call_concurrently(self, single_flight, func, key='key', threads=5):
+        """Call a blocking function from multiple threads.
+
+        The function is released once all threads wait for its result.
+        """
+        release = threading.Event()
+        results = []
+
+        def blocking_func():
+            release.wait(5)
+            return func()
+
+        def run():
+            try:
+                results.append(single_flight.do(key, blocking_func))
+            except ValueError as exc:
+                results.append(exc)
+
+        workers = [threading.Thread(target=run) for _ in range(threads)]
+        workers[0].start()
+        while key not in single_flight.calls:
+            time.sleep(0.001)
+        for worker in workers[1:]:
+            worker.start()
+        deadline = time.monotonic() + 5
+        while single_flight.calls[key].waiters < threads - 1 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        release.set()
+        for worker in workers:
+            worker.join(5)
+        return results
+
+    def test_coalesced(self):
+        """Test that concurrent calls share one result."""
+        single_flight = SingleFlight()
+        func = Mock(return_value=42)
+        results = self._call_concurrently(single_flight, func)
+        func.assert_called_once_with()
+        self.assertEqual(sorted(results), [(42, False)] + [(42, True)] * 4)
+        self.assertEqual(single_flight.calls, {})
+
+    def test_exception(self):
+        """Test that exceptions are raised in all waiting threads."""
+        single_flight = SingleFlight()
+        func = Mock(side_effect=ValueError)
+        results = self._call_concurrently(single_flight, func)
+        func.assert_called_once_with()
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(single_flight.calls, {})
+
+    def test_sequential(self):
+        """Test that sequential calls aren't coalesced."""
+        single_flight = SingleFlight()
+        func = Mock(side_effect=[1, 2])
+        self.assertEqual(single_flight.do('key', func), (1, False))
+        self.assertEqual(single_flight.do('key', func), (2, False))
+        self.assertEqual(single_flight.do('other', lambda value: value, 3), (3, False))
@@ -18,16 +18,26 @@
 
 """Tests for XPartaMuPP."""
 
+import json
+import os
 import sys
+import tempfile
 
 from argparse import Namespace
-from unittest import TestCase
-from unittest.mock import Mock, call, patch
+from unittest import TestCase, skipUnless
+from unittest.mock import ANY, call, patch
 
 from parameterized import parameterized
 from sleekxmpp.jid import JID
 
-from xpartamupp.xpartamupp import Games, main, parse_args
+try:
+    import slixmpp
+except ImportError:
+    slixmpp = None
+
+from tests.benchmarks.lobby_load import LobbyLoadGenerator
+from xpartamupp.xpartamupp import (EXPIRY_QUEUE_SLACK, GameRecord, Games, GameSnapshot, main,
+                                   parse_args)
 
 
 class TestGames(TestCase):
@@ -90,36 +100,340 @@ class TestGames(TestCase):
         pass
         # slightly unknown how to do that properly, as some data structures aren't known
 
+    @parameterized.expand([
+        ({}, ['player0', 'player1', 'player2']),
+        ({'state': 'init'}, ['player0', 'player2']),
+        ({'state': 'running'}, ['player1']),
+        ({'state': 'init', 'mapName': 'Mainland'}, ['player2']),
+        ({'mapName': 'Arcadia', 'freeSlots': '1'}, ['player1']),
+        ({'freeSlots': '2'}, ['player1', 'player2']),
+        ({'maxnbp': '8'}, ['player2']),
+        ({'mapName': 'Unknown'}, []),
+    ])
+    def test_get_games(self, filters, expected_hosts):
+        """Test querying games matching filters."""
+        games = Games()
+        for i, (map_name, nbp, maxnbp) in enumerate([('Arcadia', '2', '2'), ('Arcadia', '1', '4'),
+                                                     ('Mainland', '1', '8')]):
+            games.add_game(JID('player%i@domain.tld' % i),
+                           {'players': 'player%i' % i, 'nbp': nbp, 'maxnbp': maxnbp,
+                            'mapName': map_name})
+        games.change_game_state(JID('player1@domain.tld'), {'nbp': '1', 'players': 'player1'})
+        self.assertEqual(sorted(jid.local for jid in games.get_games(filters)), expected_hosts)
+
+    def test_get_games_invalid(self):
+        """Test querying games with an invalid number of free slots."""
+        with self.assertRaises(ValueError):
+            Games().get_games({'freeSlots': 'many'})
+
+    def test_indexes(self):
+        """Test that indexes only contain existing games."""
+        games = Games()
+        jid = JID('player1@domain.tld')
+        games.add_game(jid, {'players': 'player1', 'nbp': '1', 'mapName': 'Arcadia'})
+        self.assertEqual(games.indexes['state'], {'init': {jid}})
+        games.change_game_state(jid, {'nbp': '1', 'players': 'player1'})
+        self.assertEqual(games.indexes['state'], {'running': {jid}})
+        games.remove_game(jid)
+        self.assertEqual(games.indexes, {attribute: {} for attribute in games.indexes})
+
+    def test_expire_games(self):
+        """Test removing games whose hosts weren't seen for a while."""
+        games = Games()
+        jids = [JID('player%i@domain.tld' % i) for i in range(3)]
+        with patch('xpartamupp.xpartamupp.time.time') as time_mock:
+            time_mock.return_value = 1000
+            for jid in jids:
+                games.add_game(jid, {'players': 'player', 'nbp': '1'})
+            time_mock.return_value = 1100
+            self.assertTrue(games.touch(jids[1]))
+            self.assertFalse(games.touch(JID('player3@domain.tld')))
+            games.remove_game(jids[2])
+            time_mock.return_value = 1200
+            self.assertEqual(games.expire_games(150), [jids[0]])
+            self.assertEqual(list(games.get_all_games()), [jids[1]])
+            self.assertEqual(games.expire_games(150), [])
+            time_mock.return_value = 1300
+            self.assertEqual(games.expire_games(150), [jids[1]])
+        self.assertEqual(games.last_seen, {})
+
+    def test_expiry_queue_compaction(self):
+        """Test that the expiry queue doesn't grow with every sign of life."""
+        games = Games()
+        jid = JID('player1@domain.tld')
+        games.add_game(jid, {'players': 'player', 'nbp': '1'})
+        for _ in range(1000):
+            games.touch(jid)
+        self.assertLessEqual(len(games.expiry_queue), 2 + EXPIRY_QUEUE_SLACK + 1)
+
+    def test_many_games(self):
+        """Test that the number of games isn't limited by a fixed count."""
+        games = Games()
+        for i in range(5000):
+            games.add_game(JID('player%i@domain.tld' % i),
+                           {'players': 'player%i' % i, 'nbp': '1', 'mapName': 'Mainland'})
+        self.assertEqual(len(games.get_all_games()), 5000)
+        self.assertEqual(len(games.indexes['state']['init']), 5000)
+
+    def test_memory_limit(self):
+        """Test that the least recently seen games get removed on exceeding the memory limit."""
+        games = Games()
+        game_size = GameRecord({'players': 'player', 'nbp': '1', 'players-init': 'player',
+                                'nbp-init': '1', 'state': 'init'}).get_size()
+        games.memory_limit = 3 * game_size
+        jids = [JID('player%i@domain.tld' % i) for i in range(4)]
+        with patch('xpartamupp.xpartamupp.time.time') as time_mock:
+            for i, jid in enumerate(jids):
+                time_mock.return_value = 1000 + i
+                if i == 3:
+                    games.touch(jids[0])
+                games.add_game(jid, {'players': 'player', 'nbp': '1'})
+        self.assertEqual(set(games.get_all_games()), {jids[0], jids[2], jids[3]})
+        self.assertEqual(games.indexes['state']['init'], {jids[0], jids[2], jids[3]})
+        self.assertEqual(games.memory_used, 3 * game_size)
+        for jid in jids:
+            games.remove_game(jid)
+        self.assertEqual(games.memory_used, 0)
+
+    def test_change_state_memory(self):
+        """Test that the memory used gets updated on state changes."""
+        games = Games()
+        jid = JID('player1@domain.tld')
+        games.add_game(jid, {'players': 'player1', 'nbp': '1'})
+        games.change_game_state(jid, {'nbp': '2', 'players': 'player1,player2'})
+        self.assertEqual(games.memory_used, games.get_all_games()[jid].get_size())
+
+
+class TestGameRecord(TestCase):
+    """Test the compact representation of games."""
+
+    def test_mapping(self):
+        """Test that records behave like read-only dicts."""
+        data = {'name': 'game1', 'state': 'init', 'nbp': '1'}
+        record = GameRecord(data)
+        self.assertEqual(record, dict(data, **{'nbp-init': '1'}))
+        self.assertEqual(record['state'], 'init')
+        self.assertIsNone(record.get('mapName'))
+        with self.assertRaises(KeyError):
+            record['mapName']  # pylint: disable=pointless-statement
+
+    def test_shared_layout(self):
+        """Test that only records with known attributes share their layout."""
+        record1 = GameRecord({'name': 'game1', 'mapName': 'Mainland'})
+        record2 = GameRecord({'name': 'game2', 'mapName': 'Mainland'})
+        self.assertIs(record1.layout, record2.layout)
+        record1 = GameRecord({'name': 'game1', ''.join(['fo', 'o']): 'bar'})
+        record2 = GameRecord({'name': 'game2', ''.join(['fo', 'o']): 'bar'})
+        self.assertIsNot(record1.layout, record2.layout)
+        self.assertIsNot(record1.layout.names[1], record2.layout.names[1])
+
+    def test_initial_attributes(self):
+        """Test that initial attributes are derived until the game changes."""
+        record = GameRecord({'players': 'player1', 'nbp': '1', 'state': 'init'})
+        self.assertIsNone(record.initial)
+        self.assertEqual(record, {'players': 'player1', 'nbp': '1', 'state': 'init',
+                                  'players-init': 'player1', 'nbp-init': '1'})
+        record.update({'players': 'player1,player2', 'nbp': '2', 'state': 'running'})
+        self.assertEqual(record['players-init'], 'player1')
+        self.assertEqual(record['nbp-init'], '1')
+        self.assertEqual(record.get_element().attrib['nbp-init'], '1')
+
+        restored = GameRecord(dict(record))
+        self.assertEqual(restored, record)
+        self.assertEqual(GameRecord(dict(GameRecord({'nbp': '1'}))).initial, None)
+
+    def test_update(self):
+        """Test that updates invalidate the cached element."""
+        record = GameRecord({'name': 'game1', 'state': 'init'})
+        element = record.get_element()
+        self.assertIs(record.get_element(), element)
+        record.update({'state': 'running', 'startTime': '1000'})
+        self.assertEqual(record, {'name': 'game1', 'state': 'running', 'startTime': '1000'})
+        self.assertEqual(record.get_element().attrib,
+                         {'name': 'game1', 'state': 'running', 'startTime': '1000'})
+
+
+class TestFanOut(TestCase):
+    """Test the number of stanzas sent for lobby events."""
+
+    def setUp(self):
+        """Set up a lobby with some players and games."""
+        self.generator = LobbyLoadGenerator()
+        self.generator.populate(occupants=20, games=5)
+
+    def test_join(self):
+        """Test that joining players only get the game list."""
+        self.generator.run_event('join')
+        self.assertEqual(self.generator.report()['join']['stanzas_per_event'], 1)
+
+    def test_register(self):
+        """Test that new games get broadcasted to all players once."""
+        self.generator.run_event('register')
+        self.assertEqual(self.generator.report()['register']['stanzas_per_event'],
+                         len(self.generator.occupants))
+
+    def test_virtual_clock(self):
+        """Test that the start time of games uses the virtual clock."""
+        self.generator.run_event('changestate')
+        games = self.generator.bot.games[self.generator.rooms[0]].get_all_games()
+        self.assertIn(str(round(self.generator.bot.clock.time())),
+                      [game.get('startTime') for game in games.values()])
+
+
+class TestRateLimit(TestCase):
+    """Test rate limiting of game list requests."""
+
+    def test_rate_limited(self):
+        """Test that requests exceeding the rate limit are rejected."""
+        generator = LobbyLoadGenerator()
+        generator.populate(occupants=5, games=0)
+        generator.bot.set_rate_limit(0.001, 2)
+
+        generator.run_event('register')
+        generator.run_event('changestate')
+        self.assertEqual(generator.stanzas['changestate'], 5)
+        generator.run_event('changestate')
+        self.assertEqual(generator.stanzas['changestate'], 6)
+        generator.run_event('register')
+        self.assertEqual(generator.stanzas['register'], 10)
+
+
+class TestMultipleRooms(TestCase):
+    """Test serving multiple rooms from a single bot."""
+
+    def setUp(self):
+        """Set up two rooms with some players."""
+        self.generator = LobbyLoadGenerator(rooms=('arena@conference.localhost',
+                                                   'arena2@conference.localhost'))
+        self.generator.populate(occupants=20, games=0)
+
+    def test_register(self):
+        """Test that new games only get broadcasted to the room of the host."""
+        self.generator.run_event('register')
+        self.assertEqual(self.generator.report()['register']['stanzas_per_event'], 10)
+        self.assertEqual(sorted(len(games.get_all_games())
+                                for games in self.generator.bot.games.values()), [0, 1])
+
+    def test_leave(self):
+        """Test that leaving players are forgotten together with their games."""
+        self.generator.run_event('register')
+        for _ in range(20):
+            self.generator.run_event('leave')
+        self.assertEqual(self.generator.bot.player_rooms, {})
+        self.assertFalse(any(games.get_all_games()
+                             for games in self.generator.bot.games.values()))
+
+
+class TestGameExpiry(TestCase):
+    """Test removal of games whose hosts went silent."""
+
+    def test_expire_games(self):
+        """Test that stale games get removed with a single update."""
+        generator = LobbyLoadGenerator()
+        generator.populate(occupants=10, games=4)
+        generator.bot.enable_game_expiry(300, 60)
+        room = generator.rooms[0]
+        with patch('xpartamupp.xpartamupp.time', generator.bot.clock):
+            generator.bot.clock.advance(200)
+            generator.run_event('changestate')
+            sent_stanzas = generator.bot.sent_stanzas
+            generator.bot.clock.advance(200)
+        self.assertEqual(len(generator.bot.games[room].get_all_games()), 1)
+        self.assertEqual(generator.bot.sent_stanzas - sent_stanzas, 10)
+
+
+class TestSnapshot(TestCase):
+    """Test saving and restoring games from snapshots."""
+
+    def setUp(self):
+        """Set up a lobby with some games and a directory for snapshots."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'games.json')
+        self.generator = LobbyLoadGenerator()
+        self.generator.populate(occupants=10, games=4)
+        self.room = self.generator.rooms[0]
+
+    def tearDown(self):
+        """Remove the snapshots."""
+        self.directory.cleanup()
+
+    def test_periodic_snapshot(self):
+        """Test that snapshots get written periodically."""
+        self.generator.bot.enable_snapshots(self.path, 30)
+        self.assertFalse(os.path.exists(self.path))
+        self.generator.bot.clock.advance(30)
+        with open(self.path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        self.assertEqual(len(snapshot['rooms'][self.room]), 4)
+        self.assertEqual(os.listdir(self.directory.name), ['games.json'])
+
+    def test_load_missing(self):
+        """Test loading a snapshot which doesn't exist."""
+        self.assertEqual(GameSnapshot(self.path).load(), {})
+
+    def test_warm_restart(self):
+        """Test restoring games and removing those of hosts who left."""
+        GameSnapshot(self.path).save(self.generator.bot.games)
+        restarted = LobbyLoadGenerator()
+        restarted.bot.enable_snapshots(self.path, 30)
+        self.assertEqual(restarted.bot.games[self.room].get_all_games(),
+                         self.generator.bot.games[self.room].get_all_games())
+
+        restarted.populate(occupants=10, games=0)
+        del restarted.bot.plugin['xep_0045'].rooms[self.room][sorted(self.generator.hosts)[0]]
+        sent_stanzas = restarted.bot.sent_stanzas
+        restarted.bot._muc_online(  # pylint: disable=protected-access
+            {'muc': {'nick': 'WFGBot', 'jid': 'xpartamupp@localhost/CC', 'room': self.room}})
+        self.assertEqual(len(restarted.bot.games[self.room].get_all_games()), 3)
+        self.assertEqual(restarted.bot.unverified_rooms, set())
+        self.assertEqual(restarted.bot.sent_stanzas - sent_stanzas, 9)
+
+
+DEFAULT_ARGS = dict(domain='lobby.wildfiregames.com', login='xpartamupp', log_level=30,
+                    nickname='WFGBot', password='XXXXXX', room='arena', admin_jids=None,
+                    diagnostics_dir='.', cpu_profile_duration=30,
+                    metrics_port=None, metrics_address='127.0.0.1',
+                    rate_limit=None, rate_limit_burst=10, runtime='threaded',
+                    snapshot_file=None, snapshot_interval=30, game_timeout=None,
+                    game_expiry_interval=60, games_memory_limit=64)
+
 
 class TestArgumentParsing(TestCase):
     """Test handling of parsing command line parameters."""
 
     @parameterized.expand([
-        ([], Namespace(domain='lobby.wildfiregames.com', login='xpartamupp', log_level=30,
-                       nickname='WFGBot', password='XXXXXX', room='arena')),
-        (['--debug'],
-         Namespace(domain='lobby.wildfiregames.com', login='xpartamupp', log_level=10,
-                   nickname='WFGBot', password='XXXXXX', room='arena')),
-        (['--quiet'],
-         Namespace(domain='lobby.wildfiregames.com', login='xpartamupp', log_level=40,
-                   nickname='WFGBot', password='XXXXXX', room='arena')),
-        (['--verbose'],
-         Namespace(domain='lobby.wildfiregames.com', login='xpartamupp', log_level=20,
-                   nickname='WFGBot', password='XXXXXX', room='arena')),
-        (['-m', 'lobby.domain.tld'],
-         Namespace(domain='lobby.domain.tld', login='xpartamupp', log_level=30, nickname='WFGBot',
-                   password='XXXXXX', room='arena')),
+        ([], Namespace(**DEFAULT_ARGS)),
+        (['--debug'], Namespace(**dict(DEFAULT_ARGS, log_level=10))),
+        (['--quiet'], Namespace(**dict(DEFAULT_ARGS, log_level=40))),
+        (['--verbose'], Namespace(**dict(DEFAULT_ARGS, log_level=20))),
+        (['-m', 'lobby.domain.tld'], Namespace(**dict(DEFAULT_ARGS, domain='lobby.domain.tld'))),
         (['--domain=lobby.domain.tld'],
-         Namespace(domain='lobby.domain.tld', login='xpartamupp', log_level=30, nickname='WFGBot',
-                   password='XXXXXX', room='arena')),
+         Namespace(**dict(DEFAULT_ARGS, domain='lobby.domain.tld'))),
         (['-m' 'lobby.domain.tld', '-l', 'bot', '-p', '123456', '-n', 'Bot', '-r', 'arena123',
           '-v'],
-         Namespace(domain='lobby.domain.tld', login='bot', log_level=20,
-                   nickname='Bot', password='123456', room='arena123')),
+         Namespace(**dict(DEFAULT_ARGS, domain='lobby.domain.tld', login='bot', log_level=20,
+                          nickname='Bot', password='123456', room='arena123'))),
         (['--domain=lobby.domain.tld', '--login=bot', '--password=123456', '--nickname=Bot',
           '--room=arena123', '--verbose'],
-         Namespace(domain='lobby.domain.tld', login='bot', log_level=20,
-                   nickname='Bot', password='123456', room='arena123')),
+         Namespace(**dict(DEFAULT_ARGS, domain='lobby.domain.tld', login='bot', log_level=20,
+                          nickname='Bot', password='123456', room='arena123'))),
+        (['--metrics-port=9090', '--metrics-address=0.0.0.0'],
+         Namespace(**dict(DEFAULT_ARGS, metrics_port=9090, metrics_address='0.0.0.0'))),
+        (['--rate-limit=0.5', '--rate-limit-burst=5'],
+         Namespace(**dict(DEFAULT_ARGS, rate_limit=0.5, rate_limit_burst=5))),
+        (['--runtime=asyncio'], Namespace(**dict(DEFAULT_ARGS, runtime='asyncio'))),
+        (['--snapshot-file=/tmp/games.json', '--snapshot-interval=10'],
+         Namespace(**dict(DEFAULT_ARGS, snapshot_file='/tmp/games.json', snapshot_interval=10))),
+        (['--game-timeout=3600', '--game-expiry-interval=30'],
+         Namespace(**dict(DEFAULT_ARGS, game_timeout=3600, game_expiry_interval=30))),
+        (['--games-memory-limit=16'], Namespace(**dict(DEFAULT_ARGS, games_memory_limit=16))),
+        (['--admin-jid=admin@lobby.domain.tld', '--admin-jid=admin2@lobby.domain.tld',
+          '--diagnostics-dir=/tmp'],
+         Namespace(**dict(DEFAULT_ARGS, admin_jids=['admin@lobby.domain.tld',
+                                                    'admin2@lobby.domain.tld'],
+                          diagnostics_dir='/tmp'))),
+        (['--cpu-profile-duration=5.5'],
+         Namespace(**dict(DEFAULT_ARGS, cpu_profile_duration=5.5))),
     ])
     def test_valid(self, cmd_args, expected_args):
         """Test valid parameter combinations."""
@@ -132,6 +446,9 @@ class TestArgumentParsing(TestCase):
         (['--quiet', '--verbose'],),
         (['--debug', '--verbose'],),
         (['--debug', '--quiet', '--verbose'],),
+        (['--cpu-profile-duration=0'],),
+        (['--cpu-profile-duration=601'],),
+        (['--cpu-profile-duration=foo'],),
     ])
     def test_invalid(self, cmd_args):
         """Test invalid parameter combinations."""
@@ -146,9 +463,7 @@ class TestMain(TestCase):
         """Test successful execution."""
         with patch('xpartamupp.xpartamupp.parse_args') as args_mock, \
                 patch('xpartamupp.xpartamupp.XpartaMuPP') as xmpp_mock:
-            args_mock.return_value = Mock(log_level=30, login='xpartamupp',
-                                          domain='lobby.wildfiregames.com', password='XXXXXX',
-                                          room='arena', nickname='WFGBot')
+            args_mock.return_value = Namespace(**DEFAULT_ARGS)
             main()
             args_mock.assert_called_once_with(sys.argv[1:])
             xmpp_mock().register_plugin.assert_has_calls([call('xep_0004'), call('xep_0030'),
@@ -158,13 +473,101 @@ class TestMain(TestCase):
             xmpp_mock().connect.assert_called_once_with()
             xmpp_mock().process.assert_called_once_with()
 
+    def test_multiple_rooms(self):
+        """Test joining multiple rooms."""
+        with patch('xpartamupp.xpartamupp.parse_args') as args_mock, \
+                patch('xpartamupp.xpartamupp.XpartaMuPP') as xmpp_mock:
+            args_mock.return_value = Namespace(**dict(DEFAULT_ARGS, room='arena, arena-a24'))
+            main()
+            xmpp_mock.assert_any_call(ANY, 'XXXXXX',
+                                      ['arena@conference.lobby.wildfiregames.com',
+                                       'arena-a24@conference.lobby.wildfiregames.com'],
+                                      'WFGBot')
+
+    def test_metrics(self):
+        """Test starting the metrics server."""
+        with patch('xpartamupp.xpartamupp.parse_args') as args_mock, \
+                patch('xpartamupp.xpartamupp.start_metrics_server') as metrics_mock, \
+                patch('xpartamupp.xpartamupp.XpartaMuPP'):
+            args_mock.return_value = Namespace(**dict(DEFAULT_ARGS, metrics_port=9090))
+            main()
+            metrics_mock.assert_called_once_with(9090, '127.0.0.1')
+
+    @skipUnless(slixmpp, 'slixmpp is not installed')
+    def test_asyncio_runtime(self):
+        """Test running the asyncio-based bot."""
+        with patch('xpartamupp.xpartamupp.parse_args') as args_mock, \
+                patch('xpartamupp.xpartamupp.XpartaMuPP') as xmpp_mock, \
+                patch('xpartamupp.async_bots.AsyncXpartaMuPP') as async_xmpp_mock:
+            args_mock.return_value = Namespace(**dict(DEFAULT_ARGS, runtime='asyncio'))
+            main()
+            xmpp_mock.assert_not_called()
+            async_xmpp_mock().connect.assert_called_once_with()
+            async_xmpp_mock().process.assert_called_once_with()
+
+    @skipUnless(slixmpp, 'slixmpp is not installed')
+    def test_asyncio_runtime_start(self):
+        """Test starting the asyncio-based bot, whose connect() returns nothing."""
+        with patch('xpartamupp.xpartamupp.parse_args') as args_mock, \
+                patch('slixmpp.ClientXMPP.connect', return_value=None) as connect_mock, \
+                patch('xpartamupp.async_bots.AsyncXpartaMuPP.process') as process_mock:
+            args_mock.return_value = Namespace(**dict(DEFAULT_ARGS, runtime='asyncio'))
+            main()
+            connect_mock.assert_called_once_with(ANY)
+            process_mock.assert_called_once_with()
+
+    def test_rate_limit(self):
+        """Test enabling rate limiting."""
+        with patch('xpartamupp.xpartamupp.parse_args') as args_mock, \
+                patch('xpartamupp.xpartamupp.XpartaMuPP') as xmpp_mock:
+            args_mock.return_value = Namespace(**dict(DEFAULT_ARGS, rate_limit=0.5))
+            main()
+            xmpp_mock().set_rate_limit.assert_called_once_with(0.5, 10)
+
+    def test_snapshots(self):
+        """Test enabling snapshots of the games."""
+        with patch('xpartamupp.xpartamupp.parse_args') as args_mock, \
+                patch('xpartamupp.xpartamupp.XpartaMuPP') as xmpp_mock:
+            args_mock.return_value = Namespace(**dict(DEFAULT_ARGS,
+                                                      snapshot_file='/tmp/games.json'))
+            main()
+            xmpp_mock().enable_snapshots.assert_called_once_with('/tmp/games.json', 30)
+
+    def test_game_expiry(self):
+        """Test enabling the removal of stale games."""
+        with patch('xpartamupp.xpartamupp.parse_args') as args_mock, \
+                patch('xpartamupp.xpartamupp.XpartaMuPP') as xmpp_mock:
+            args_mock.return_value = Namespace(**dict(DEFAULT_ARGS, game_timeout=3600))
+            main()
+            xmpp_mock().enable_game_expiry.assert_called_once_with(3600, 60)
+
+    def test_games_memory_limit(self):
+        """Test limiting the memory used by games."""
+        with patch('xpartamupp.xpartamupp.parse_args') as args_mock, \
+                patch('xpartamupp.xpartamupp.XpartaMuPP') as xmpp_mock:
+            args_mock.return_value = Namespace(**dict(DEFAULT_ARGS, games_memory_limit=16))
+            main()
+            xmpp_mock().set_games_memory_limit.assert_called_once_with(16 * 2**20)
+
+    def test_diagnostics(self):
+        """Test enabling diagnostics commands for admins."""
+        with patch('xpartamupp.xpartamupp.parse_args') as args_mock, \
+                patch('xpartamupp.xpartamupp.Diagnostics') as diagnostics_mock, \
+                patch('xpartamupp.xpartamupp.XpartaMuPP') as xmpp_mock:
+            args_mock.return_value = Namespace(**dict(DEFAULT_ARGS,
+                                                      admin_jids=['admin@lobby.domain.tld']))
+            main()
+            diagnostics_mock.assert_called_once_with('.', cpu_profile_duration=30)
+            diagnostics_mock().install_signal_handlers.assert_called_once_with()
+            xmpp_mock().register_plugin.assert_any_call('xep_0050')
+            diagnostics_mock().register_commands.assert_called_once_with(
+                xmpp_mock(), ['admin@lobby.domain.tld'])
+
     def test_failing_connect(self):
         """Test failing connect to XMPP server."""
         with patch('xpartamupp.xpartamupp.parse_args') as args_mock, \
                 patch('xpartamupp.xpartamupp.XpartaMuPP') as xmpp_mock:
-            args_mock.return_value = Mock(log_level=30, login='xpartamupp',
-                                          domain='lobby.wildfiregames.com', password='XXXXXX',
-                                          room='arena', nickname='WFGBot')
+            args_mock.return_value = Namespace(**DEFAULT_ARGS)
             xmpp_mock().connect.return_value = False
             main()
             args_mock.assert_called_once_with(sys.argv[1:])
@@ -0,0 +1,1110 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Asyncio-based variants of the XMPP bots built on slixmpp.
+
+The bots share the game, leaderboard and report handling as well as
+the stanza definitions with the threaded bots, but handle stanzas in
+coroutines on a single event loop. Blocking database access is run in
+thread pools, so it doesn't block the event loop.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+import slixmpp
+from slixmpp.stanza import Iq
+from slixmpp.xmlstream import ElementBase
+from slixmpp.xmlstream.handler import CoroutineCallback
+from slixmpp.xmlstream.matcher import StanzaPath
+from slixmpp.xmlstream.stanzabase import register_stanza_plugin
+
+from xpartamupp.echelon import (COALESCED_REQUESTS, LEADERBOARD_PAGE_SIZE, EcheLOn, ProfileCache,
+                                ReportManager, get_favourite_civ)
+from xpartamupp.metrics import (BROADCAST_DURATION, BROADCAST_ITEMS, BROADCAST_RECIPIENTS,
+                                IQ_DURATION, IQ_REQUESTS, RATE_LIMITED_REQUESTS, REGISTRY)
+from xpartamupp.query_log import query_context
+from xpartamupp.stanzas import BoardList, GameList, GameReport, Profile, Stats
+from xpartamupp.utils import TokenBucketLimiter
+from xpartamupp.xpartamupp import EXPIRED_GAMES, Games, GameSnapshot
+
+# Number of stanzas a broadcast sends before it lets other tasks run.
+BROADCAST_BATCH_SIZE = 2**6
+
+# Number of threads running read-only database queries.
+DB_READ_WORKERS = 4
+
+
+class BoardListXmppPlugin(BoardList, ElementBase):
+    """Class for custom boardlist and ratinglist stanza extension."""
+
+
+class GameListXmppPlugin(GameList, ElementBase):
+    """Class for custom gamelist stanza extension."""
+
+
+class GameReportXmppPlugin(GameReport, ElementBase):
+    """Class for custom gamereport stanza extension."""
+
+
+class ProfileXmppPlugin(Profile, ElementBase):
+    """Class for custom profile."""
+
+
+class StatsXmppPlugin(Stats, ElementBase):
+    """Class for custom civilization statistics stanza extension."""
+
+
+def instrument_coroutine_handler(handler_name):
+    """Count calls and measure the duration of an IQ handler coroutine.
+
+    Arguments:
+        handler_name (str): Name of the handler used as label
+
+    Returns:
+        Decorator for the handler
+
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            IQ_REQUESTS.inc(handler=handler_name)
+            with IQ_DURATION.time(handler=handler_name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class AsyncBot(slixmpp.ClientXMPP):
+    """Functionality shared by the asyncio-based bots."""
+
+    rate_limited_handlers = ()
+
+    def __init__(self, sjid, password, room, nick):
+        """Initialize the bot.
+
+        Arguments:
+            sjid (sleekxmpp.jid.JID, str): JID of the bot
+            password (str): Password of the bot
+            room (str, list): JID of the MUC room or list of JIDs of
+                MUC rooms to join, the first one is the main room
+            nick (str): Nick of the bot in the MUC rooms
+
+        """
+        slixmpp.ClientXMPP.__init__(self, str(sjid), password)
+        self.whitespace_keepalive = False
+
+        self.sjid = slixmpp.jid.JID(str(sjid))
+        self.rooms = [room] if isinstance(room, str) else list(room)
+        self.room = self.rooms[0]
+        self.nick = nick
+
+        self.rate_limiters = {}
+        self.broadcasts = {}
+        self.pending_broadcasts = {}
+        self.stopping = False
+
+        self.add_event_handler('session_start', self._session_start)
+
+        REGISTRY.gauge('xpartamupp_occupants', "Number of occupants of the MUC rooms",
+                       callback=lambda: sum(len(self.plugin['xep_0045'].get_roster(room) or ())
+                                            for room in self.rooms))
+
+    def connect(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        """Start connecting to the server.
+
+        Unlike sleekxmpp, slixmpp only schedules the connection
+        attempt and retries failed attempts on its own, so whether
+        the connection succeeds isn't known yet.
+
+        Returns:
+            True, so the bot can be started like the threaded bots
+
+        """
+        self.stopping = False
+        slixmpp.ClientXMPP.connect(self, *args, **kwargs)
+        return True
+
+    def disconnect(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        """Close the connection and stop processing afterwards."""
+        self.stopping = True
+        return slixmpp.ClientXMPP.disconnect(self, *args, **kwargs)
+
+    def process(self):
+        """Run the event loop until `disconnect()` gets called.
+
+        Lost connections get established again. slixmpp replaces the
+        `disconnected` future on every disconnect, so it has to be
+        looked up again for every connection.
+        """
+        while True:
+            self.loop.run_until_complete(self.disconnected)
+            if self.stopping:
+                break
+            logging.warning("Connection lost, reconnecting")
+            self.connect()
+
+    def set_rate_limit(self, rate, burst):
+        """Limit the rate of IQ requests per JID.
+
+        Arguments:
+            rate (float): Number of requests per second and handler a
+                JID can send in the long run
+            burst (int): Number of requests per handler a JID can send
+                at once
+
+        """
+        self.rate_limiters = {handler: TokenBucketLimiter(rate, burst)
+                              for handler in self.rate_limited_handlers}
+
+    def _is_rate_limited(self, handler, iq):
+        """Check whether an IQ request exceeds the rate limit.
+
+        Requests exceeding the rate limit get rejected with a
+        resource-constraint error.
+
+        Arguments:
+            handler (str): Name of the handler the request is for
+            iq (slixmpp.stanza.iq.IQ): Received IQ stanza
+
+        Returns:
+            True if the request exceeds the rate limit, False
+            otherwise
+
+        """
+        limiter = self.rate_limiters.get(handler)
+        if not limiter or limiter.allow(iq['from'].bare):
+            return False
+
+        logging.debug("Rate limited %s request from %s", handler, iq['from'])
+        RATE_LIMITED_REQUESTS.inc(handler=handler)
+        self._send_error(iq, 'resource-constraint', 'wait')
+        return True
+
+    async def _session_start(self, event):  # pylint: disable=unused-argument
+        """Join MUC channel and announce presence.
+
+        Arguments:
+            event (dict): empty dummy dict
+
+        """
+        for room in self.rooms:
+            self.plugin['xep_0045'].join_muc(room, self.nick)
+        self.send_presence()
+        await self.get_roster()
+        logging.info("%s started", self.__class__.__name__)
+
+    def _get_occupants(self, room=None):
+        """Get the JIDs and nicks of the occupants of a MUC room.
+
+        Arguments:
+            room (str): MUC room to get the occupants of, defaults to
+                the main room
+
+        Returns:
+            dict with full JIDs as keys and nicks as values
+
+        """
+        room = room or self.room
+        occupants = {}
+        for nick in self.plugin['xep_0045'].get_roster(room) or ():
+            if nick == self.nick:
+                continue
+            jid_str = self.plugin['xep_0045'].get_jid_property(room, nick, 'jid')
+            if jid_str:
+                occupants[str(jid_str)] = nick
+        return occupants
+
+    def _reply(self, iq, stanza, description):
+        """Reply to an IQ stanza with a stanza extension.
+
+        Arguments:
+            iq (slixmpp.stanza.iq.IQ): IQ stanza to reply to
+            stanza (ElementBase): Stanza extension to send
+            description (str): Description of the reply for logging
+
+        """
+        iq = iq.reply(clear=True)
+        iq.set_payload(stanza)
+        try:
+            iq.send()
+        except Exception:
+            logging.exception("Failed to send %s to %s", description, iq['to'])
+
+    def _send_error(self, iq, condition, error_type='modify'):
+        """Reply to an IQ stanza with an error.
+
+        Arguments:
+            iq (slixmpp.stanza.iq.IQ): IQ stanza to reply to
+            condition (str): Defined error condition to reply with
+            error_type (str): Type of the error
+
+        """
+        iq = iq.reply(clear=True).error()
+        iq['error']['type'] = error_type
+        iq['error']['condition'] = condition
+        try:
+            iq.send()
+        except Exception:
+            logging.exception("Failed to send error to %s", iq['to'])
+
+    def _broadcast(self, name, stanza, jids, items, key=None):
+        """Send a stanza extension to many recipients in the background.
+
+        As broadcasts always contain the complete state of a list,
+        only the latest state of a list matters. A broadcast in
+        progress gets finished, so recipients late in the list still
+        get updates in busy rooms, and afterwards only the latest state
+        requested in the meantime gets broadcasted.
+
+        Arguments:
+            name (str): Name of the broadcast used as label
+            stanza (ElementBase): Stanza extension to send
+            jids (iterable): JIDs of the recipients
+            items (int): Number of items contained in the stanza
+            key (hashable): Key identifying the list, defaults to the
+                name of the broadcast
+
+        Returns:
+            asyncio.Task sending the stanzas of this and all later
+            broadcasts of the same list
+
+        """
+        key = key or name
+        self.pending_broadcasts[key] = (name, stanza, list(jids), items)
+        task = self.broadcasts.get(key)
+        if not task or task.done():
+            task = asyncio.ensure_future(self._send_pending_broadcasts(key))
+            self.broadcasts[key] = task
+        return task
+
+    async def _send_pending_broadcasts(self, key):
+        """Send the latest state of a list until no newer one is pending.
+
+        Arguments:
+            key (hashable): Key identifying the list
+
+        """
+        while key in self.pending_broadcasts:
+            await self._send_broadcast(*self.pending_broadcasts.pop(key))
+
+    async def _send_broadcast(self, name, stanza, jids, items):
+        """Send a stanza extension to many recipients.
+
+        Arguments:
+            name (str): Name of the broadcast used as label
+            stanza (ElementBase): Stanza extension to send
+            jids (list): JIDs of the recipients
+            items (int): Number of items contained in the stanza
+
+        """
+        with BROADCAST_DURATION.time(broadcast=name):
+            for index, jid in enumerate(jids, 1):
+                iq = self.make_iq_result(ito=jid)
+                iq.set_payload(stanza)
+                try:
+                    iq.send()
+                except Exception:
+                    logging.exception("Failed to send %s to %s", name, jid)
+                if index % BROADCAST_BATCH_SIZE == 0:
+                    await asyncio.sleep(0)
+        BROADCAST_RECIPIENTS.observe(len(jids), broadcast=name)
+        BROADCAST_ITEMS.observe(items, broadcast=name)
+
+
+class AsyncXpartaMuPP(AsyncBot):
+    """Asyncio-based variant of XpartaMuPP."""
+
+    rate_limited_handlers = ('gamelist', 'gamelist_query')
+
+    def __init__(self, sjid, password, rooms, nick):
+        """Initialize XpartaMuPP.
+
+        Each room has its own list of games and its own game list
+        broadcasts.
+        """
+        AsyncBot.__init__(self, sjid, password, rooms, nick)
+        self.games = {room: Games() for room in self.rooms}
+        self.player_rooms = {}
+        self.snapshot = None
+        self.unverified_rooms = set()
+        self.game_timeout = None
+
+        register_stanza_plugin(Iq, GameListXmppPlugin)
+
+        self.register_handler(CoroutineCallback('Iq Gamelist',
+                                                StanzaPath('iq@type=set/gamelist'),
+                                                self._iq_game_list_handler))
+        self.register_handler(CoroutineCallback('Iq Gamelist Query',
+                                                StanzaPath('iq@type=get/gamelist'),
+                                                self._iq_game_list_query_handler))
+
+        for room in self.rooms:
+            self.add_event_handler('muc::%s::got_online' % room, self._muc_online)
+            self.add_event_handler('muc::%s::got_offline' % room, self._muc_offline)
+            self.add_event_handler('muc::%s::presence' % room, self._muc_presence)
+        self.add_event_handler('groupchat_message', self._muc_message)
+
+        REGISTRY.gauge('xpartamupp_games', "Number of games in the lobby",
+                       callback=lambda: sum(len(games.get_all_games())
+                                            for games in self.games.values()))
+        REGISTRY.gauge('xpartamupp_room_games', "Number of games per MUC room", ('room',),
+                       callback=lambda: {(room,): len(games.get_all_games())
+                                         for room, games in self.games.items()})
+        REGISTRY.gauge('xpartamupp_room_games_bytes',
+                       "Estimated number of bytes used by the games per MUC room", ('room',),
+                       callback=lambda: {(room,): games.memory_used
+                                         for room, games in self.games.items()})
+
+    def set_games_memory_limit(self, limit):
+        """Limit the memory used by the games of each room.
+
+        Arguments:
+            limit (int): Number of bytes the games of a room may use
+                before the games whose hosts were seen least recently
+                get removed
+
+        """
+        for games in self.games.values():
+            games.memory_limit = limit
+
+    def enable_snapshots(self, path, interval):
+        """Periodically save the games to a snapshot file.
+
+        The games of an existing snapshot get restored right away and
+        get verified against the roster once a room got joined.
+
+        Arguments:
+            path (str): Path of the snapshot file
+            interval (float): Number of seconds between two snapshots
+
+        """
+        self.snapshot = GameSnapshot(path)
+        for room, games in self.snapshot.load().items():
+            if room not in self.games:
+                logging.info("Ignoring games of room %s from snapshot", room)
+                continue
+            for jid, data in games.items():
+                self.games[room].restore_game(slixmpp.jid.JID(jid), data)
+            self.unverified_rooms.add(room)
+            logging.info("Restored %i games of room %s", len(games), room)
+
+        self.schedule('Game snapshot', interval, self._save_snapshot, repeat=True)
+        self.add_event_handler('disconnected', self._save_snapshot)
+
+    def _save_snapshot(self, event=None):  # pylint: disable=unused-argument
+        """Save the games of all rooms to the snapshot file.
+
+        Snapshots are small enough to be written without leaving the
+        event loop.
+
+        Arguments:
+            event (dict): empty dummy dict, if called as event handler
+
+        """
+        try:
+            self.snapshot.save(self.games)
+        except Exception:
+            logging.exception("Failed to save game snapshot to %s", self.snapshot.path)
+
+    def enable_game_expiry(self, timeout, interval):
+        """Periodically remove games whose hosts went silent.
+
+        Arguments:
+            timeout (float): Number of seconds without any sign of life
+                of the host after which a game gets removed
+            interval (float): Number of seconds between two checks for
+                stale games
+
+        """
+        self.game_timeout = timeout
+        self.schedule('Game expiry', interval, self._expire_games, repeat=True)
+
+    def _expire_games(self):
+        """Remove stale games and broadcast one update per affected room."""
+        for room, games in self.games.items():
+            expired = games.expire_games(self.game_timeout)
+            if not expired:
+                continue
+
+            EXPIRED_GAMES.inc(len(expired))
+            logging.info("Removed %i stale games of room %s", len(expired), room)
+            self._broadcast_game_list(room)
+
+    def _verify_restored_games(self, room):
+        """Remove restored games whose hosts aren't in the room anymore.
+
+        Arguments:
+            room (str): MUC room the bot has just joined
+
+        """
+        self.unverified_rooms.discard(room)
+        occupants = self._get_occupants(room)
+        games = self.games[room]
+        stale = [jid for jid in games.get_all_games() if str(jid) not in occupants]
+        for jid in stale:
+            games.remove_game(jid)
+
+        logging.info("Removed %i restored games of room %s whose hosts left", len(stale), room)
+        if stale:
+            self._broadcast_game_list(room)
+
+    def _muc_online(self, presence):
+        """Send the list of games to joining players.
+
+        Arguments:
+            presence (slixmpp.stanza.presence.Presence): Received
+                presence stanza.
+
+        """
+        room = str(presence['muc']['room'])
+        nick = str(presence['muc']['nick'])
+        jid = slixmpp.jid.JID(presence['muc']['jid'])
+
+        if nick == self.nick:
+            # The own presence is the last one received when joining a
+            # room, so the roster is complete now.
+            if room in self.unverified_rooms:
+                self._verify_restored_games(room)
+            return
+
+        if jid.resource not in ['0ad', 'CC']:
+            return
+
+        self.player_rooms[str(jid)] = room
+        self._reply_game_list(room, jid)
+
+        logging.debug("Client '%s' connected with a nick '%s'.", jid, nick)
+
+    def _muc_offline(self, presence):
+        """Remove the game hosted by a leaving player.
+
+        Arguments:
+            presence (slixmpp.stanza.presence.Presence): Received
+                presence stanza.
+
+        """
+        room = str(presence['muc']['room'])
+        nick = str(presence['muc']['nick'])
+        jid = slixmpp.jid.JID(presence['muc']['jid'])
+
+        if nick == self.nick:
+            return
+
+        if self.player_rooms.get(str(jid)) == room:
+            del self.player_rooms[str(jid)]
+
+        if self.games[room].remove_game(jid):
+            self._broadcast_game_list(room)
+
+        logging.debug("Client '%s' with nick '%s' disconnected", jid, nick)
+
+    def _muc_presence(self, presence):
+        """Refresh the game of a player whose presence changed.
+
+        Arguments:
+            presence (slixmpp.stanza.presence.Presence): Received
+                presence stanza.
+
+        """
+        room = str(presence['muc']['room'])
+        if room in self.games and presence['type'] != 'unavailable':
+            self.games[room].touch(slixmpp.jid.JID(presence['muc']['jid']))
+
+    def _muc_message(self, msg):
+        """Respond to messages highlighting the bots name.
+
+        Arguments:
+            msg (slixmpp.stanza.message.Message): Received MUC
+                message
+        """
+        if msg['mucnick'] != self.nick and self.nick.lower() in msg['body'].lower():
+            self.send_message(mto=msg['from'].bare,
+                              mbody="I am just a bot and I'm responsible to ensure that your're"
+                                    "able to see the list of games in here. Aside from that I'm"
+                                    "just chilling.",
+                              mtype='groupchat')
+
+    @instrument_coroutine_handler('gamelist')
+    async def _iq_game_list_handler(self, iq):
+        """Handle game state change requests.
+
+        Arguments:
+            iq (slixmpp.stanza.iq.IQ): Received IQ stanza
+
+        """
+        if iq['from'].resource != '0ad':
+            return
+
+        if self._is_rate_limited('gamelist', iq):
+            return
+
+        room = self.player_rooms.get(str(iq['from']), self.room)
+        games = self.games[room]
+        games.touch(iq['from'])
+
+        command = iq['gamelist']['command']
+        if command == 'register':
+            success = games.add_game(iq['from'], iq['gamelist']['game'])
+        elif command == 'unregister':
+            success = games.remove_game(iq['from'])
+        elif command == 'changestate':
+            success = games.change_game_state(iq['from'], iq['gamelist']['game'])
+        else:
+            logging.info('Received unknown game command: "%s"', command)
+            return
+
+        if success:
+            try:
+                self._broadcast_game_list(room)
+            except Exception:
+                logging.exception('Failed to send game list after "%s" command', command)
+
+    @instrument_coroutine_handler('gamelist_query')
+    async def _iq_game_list_query_handler(self, iq):
+        """Handle requests for the games matching a filter.
+
+        Arguments:
+            iq (slixmpp.stanza.iq.IQ): Received IQ stanza
+
+        """
+        if iq['from'].resource != '0ad':
+            return
+
+        if self._is_rate_limited('gamelist_query', iq):
+            return
+
+        command = iq['gamelist']['command']
+        if command != 'query':
+            logging.info('Received unknown game list query command: "%s"', command)
+            self._send_error(iq, 'bad-request')
+            return
+
+        room = self.player_rooms.get(str(iq['from']), self.room)
+        self.games[room].touch(iq['from'])
+        try:
+            games = self.games[room].get_games(iq['gamelist']['game'])
+        except ValueError:
+            logging.warning("Received invalid game list query from %s", iq['from'].bare)
+            self._send_error(iq, 'bad-request')
+            return
+
+        stanza = GameListXmppPlugin()
+        stanza.add_elements([game.get_element() for game in games.values()])
+        self._reply(iq, stanza, 'game list query result')
+
+    def _get_game_list_stanza(self, room):
+        """Create a stanza extension with the whole game list of a room.
+
+        Arguments:
+            room (str): MUC room to create the game list of
+
+        Returns:
+            tuple of the GameListXmppPlugin stanza and the number of
+            games it contains
+
+        """
+        games = self.games[room].get_all_games()
+        stanza = GameListXmppPlugin()
+        stanza.add_elements([game.get_element() for game in games.values()])
+        return stanza, len(games)
+
+    def _reply_game_list(self, room, to):
+        """Send the whole game list of a room to a single player.
+
+        Arguments:
+            room (str): MUC room to send the game list of
+            to (slixmpp.jid.JID): Player to send the game list to
+
+        """
+        stanza, _ = self._get_game_list_stanza(room)
+        iq = self.make_iq_result(ito=to)
+        iq.set_payload(stanza)
+        try:
+            iq.send()
+        except Exception:
+            logging.exception("Failed to send game list to %s", to)
+
+    def _broadcast_game_list(self, room):
+        """Broadcast the whole game list of a room to its occupants.
+
+        Broadcasts of different rooms don't cancel each other.
+
+        Arguments:
+            room (str): MUC room to broadcast the game list of
+
+        Returns:
+            asyncio.Task sending the game list
+
+        """
+        stanza, items = self._get_game_list_stanza(room)
+        return self._broadcast('gamelist', stanza, self._get_occupants(room), items,
+                               key=('gamelist', room))
+
+
+class AsyncEcheLOn(AsyncBot):
+    """Asyncio-based variant of EcheLOn."""
+
+    rate_limited_handlers = ('boardlist', 'gamereport', 'profile', 'stats')
+
+    def __init__(self, sjid, password, room, nick, leaderboard):
+        """Initialize EcheLOn."""
+        AsyncBot.__init__(self, sjid, password, room, nick)
+
+        self.leaderboard = leaderboard
+        self.report_manager = ReportManager(self.leaderboard)
+        self.profile_cache = ProfileCache()
+        self.in_flight = {}
+        self.leaderboard.write_listeners.append(self.profile_cache.invalidate)
+
+        # Writes are done by a single thread, so game reports are
+        # processed one after another, like in the threaded bot.
+        self.read_executor = ThreadPoolExecutor(max_workers=DB_READ_WORKERS)
+        self.write_executor = ThreadPoolExecutor(max_workers=1)
+
+        register_stanza_plugin(Iq, BoardListXmppPlugin)
+        register_stanza_plugin(Iq, GameReportXmppPlugin)
+        register_stanza_plugin(Iq, ProfileXmppPlugin)
+        register_stanza_plugin(Iq, StatsXmppPlugin)
+
+        self.register_handler(CoroutineCallback('Iq Boardlist',
+                                                StanzaPath('iq@type=get/boardlist'),
+                                                self._iq_board_list_handler))
+        self.register_handler(CoroutineCallback('Iq GameReport',
+                                                StanzaPath('iq@type=set/gamereport'),
+                                                self._iq_game_report_handler))
+        self.register_handler(CoroutineCallback('Iq Profile', StanzaPath('iq@type=get/profile'),
+                                                self._iq_profile_handler))
+        self.register_handler(CoroutineCallback('Iq Stats', StanzaPath('iq@type=get/stats'),
+                                                self._iq_stats_handler))
+
+        self.add_event_handler('muc::%s::got_online' % self.room, self._muc_online)
+        self.add_event_handler('groupchat_message', self._muc_message)
+
+        REGISTRY.gauge('xpartamupp_interim_reports',
+                       "Number of matches with incomplete game reports",
+                       callback=lambda: len(self.report_manager.interim_report_tracker))
+        REGISTRY.gauge('xpartamupp_profile_cache_entries', "Number of cached profiles",
+                       callback=lambda: len(self.profile_cache.entries))
+        REGISTRY.gauge('xpartamupp_profile_cache_hit_ratio',
+                       "Ratio of profile requests served from the cache",
+                       callback=self.profile_cache.get_hit_rate)
+
+    def process(self):
+        """Run the event loop until `disconnect()` gets called."""
+        try:
+            AsyncBot.process(self)
+        finally:
+            self.read_executor.shutdown()
+            self.write_executor.shutdown()
+
+    def _run_db(self, context, func, *args, write=False):
+        """Run a blocking database call in a thread pool.
+
+        Arguments:
+            context (str): Name the executed SQL statements get
+                attributed to
+            func (callable): Function to call
+            args: Arguments to call the function with
+            write (bool): Whether the call changes data
+
+        Returns:
+            asyncio.Future for the result of the function
+
+        """
+        def run():
+            try:
+                with query_context(context):
+                    return func(*args)
+            finally:
+                # Sessions are thread-local, so release them before the
+                # thread picks up the next call.
+                self.leaderboard.db.remove()
+                self.leaderboard.read_db.remove()
+
+        executor = self.write_executor if write else self.read_executor
+        return self.loop.run_in_executor(executor, run)
+
+    async def _coalesce(self, context, key, func, *args):
+        """Run a database call, unless an identical call is in progress.
+
+        Arguments:
+            context (str): Name the executed SQL statements get
+                attributed to
+            key (tuple): Key identifying identical calls, the first
+                item is used as label for the metrics
+            func (callable): Function to call
+            args: Arguments to call the function with
+
+        Returns:
+            Result of the function
+
+        """
+        # Calls get coalesced on the event loop, so requests waiting for
+        # a call in progress don't occupy threads of the executor.
+        future = self.in_flight.get(key)
+        if future is None:
+            future = self._run_db(context, func, *args)
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            COALESCED_REQUESTS.inc(request=key[0])
+        # Cancelling one of the waiting requests mustn't cancel the
+        # call for the others.
+        return await asyncio.shield(future)
+
+    async def _muc_online(self, presence):
+        """Add joining players to the leaderboard.
+
+        Arguments:
+            presence (slixmpp.stanza.presence.Presence): Received
+                presence stanza.
+
+        """
+        nick = str(presence['muc']['nick'])
+        jid = slixmpp.jid.JID(presence['muc']['jid'])
+
+        if nick == self.nick or jid.resource != '0ad':
+            return
+
+        await self._run_db('muc_online', self.leaderboard.get_or_create_player, str(jid),
+                           write=True)
+        await self._broadcast_rating_list()
+
+        logging.debug("Client '%s' connected with a nick of '%s'.", jid, nick)
+
+    def _muc_message(self, msg):
+        """Respond to messages highlighting the bots name.
+
+        Arguments:
+            msg (slixmpp.stanza.message.Message): Received MUC
+                message
+        """
+        if msg['mucnick'] != self.nick and self.nick.lower() in msg['body'].lower():
+            self.send_message(mto=msg['from'].bare,
+                              mbody="I am just a bot and provide the rating functionality for "
+                                    "this lobby. Please don't disturb me, calculating these "
+                                    "ratings is already difficult enough.",
+                              mtype='groupchat')
+
+    @instrument_coroutine_handler('boardlist')
+    async def _iq_board_list_handler(self, iq):
+        """Handle incoming leaderboard list requests.
+
+        Arguments:
+            iq (slixmpp.stanza.iq.IQ): Received IQ stanza
+
+        """
+        if iq['from'].resource not in ['0ad']:
+            return
+
+        if self._is_rate_limited('boardlist', iq):
+            return
+
+        command = iq['boardlist']['command']
+        await self._run_db('boardlist', self.leaderboard.get_or_create_player, str(iq['from']),
+                           write=True)
+        if command in ['getleaderboard', 'getleaderboardposition']:
+            try:
+                limit, after = EcheLOn._parse_board_page(iq)  # pylint: disable=protected-access
+            except ValueError:
+                logging.warning("Received invalid leaderboard request from %s", iq['from'].bare)
+                self._send_error(iq, 'bad-request')
+                return
+            try:
+                if command == 'getleaderboardposition':
+                    await self._send_leaderboard(iq, limit, around=iq['from'])
+                else:
+                    await self._send_leaderboard(iq, limit, after=after)
+            except Exception:
+                logging.exception("Failed to process get leaderboard request from %s",
+                                  iq['from'].bare)
+        elif command == 'getratinglist':
+            try:
+                await self._send_rating_list(iq)
+            except Exception:
+                logging.exception("Failed to send the rating list to %s", iq['from'])
+
+    @instrument_coroutine_handler('gamereport')
+    async def _iq_game_report_handler(self, iq):
+        """Handle end of game reports from clients.
+
+        Arguments:
+            iq (slixmpp.stanza.iq.IQ): Received IQ stanza
+
+        """
+        if iq['from'].resource not in ['0ad']:
+            return
+
+        if self._is_rate_limited('gamereport', iq):
+            return
+
+        try:
+            await self._run_db('gamereport', self.report_manager.add_report, str(iq['from']),
+                               iq['gamereport']['game'], write=True)
+        except Exception:
+            logging.exception("Failed to update game statistics for %s", iq['from'].bare)
+
+        rating_messages = self.leaderboard.get_rating_messages()
+        if rating_messages:
+            while rating_messages:
+                message = rating_messages.popleft()
+                self.send_message(mto=self.room, mbody=message, mtype='groupchat', mnick=self.nick)
+            await self._broadcast_rating_list()
+
+    @instrument_coroutine_handler('profile')
+    async def _iq_profile_handler(self, iq):
+        """Handle profile and match history requests from clients.
+
+        Arguments:
+            iq (slixmpp.stanza.iq.IQ): Received IQ stanza
+
+        """
+        if iq['from'].resource not in ['0ad']:
+            return
+
+        if self._is_rate_limited('profile', iq):
+            return
+
+        if iq['profile']['history']:
+            try:
+                limit, before = EcheLOn._parse_history_page(iq)  # pylint: disable=protected-access
+            except ValueError:
+                logging.warning("Received invalid match history request from %s",
+                                iq['from'].bare)
+                self._send_error(iq, 'bad-request')
+                return
+            try:
+                await self._send_match_history(iq, iq['profile']['command'], limit, before)
+            except Exception:
+                logging.exception("Failed to send match history of %s to %s",
+                                  iq['profile']['command'], iq['from'].bare)
+                self._send_error(iq, 'internal-server-error', 'wait')
+            return
+
+        try:
+            await self._send_profile(iq, iq['profile']['command'])
+        except Exception:
+            logging.exception("Failed to send profile about %s to %s", iq['profile']['command'],
+                              iq['from'].bare)
+
+    @instrument_coroutine_handler('stats')
+    async def _iq_stats_handler(self, iq):
+        """Handle civilization statistics requests from clients.
+
+        Arguments:
+            iq (slixmpp.stanza.iq.IQ): Received IQ stanza
+
+        """
+        if iq['from'].resource not in ['0ad']:
+            return
+
+        if self._is_rate_limited('stats', iq):
+            return
+
+        command = iq['stats']['command']
+        stanza = StatsXmppPlugin()
+        stanza.add_command(command)
+        try:
+            if command == 'civs':
+                map_name = iq['stats']['map']
+                civ_stats = await self._run_db('stats', self.leaderboard.get_civ_stats,
+                                               map_name or None)
+                if map_name:
+                    stanza['map'] = map_name
+            elif command == 'player':
+                player_nick = iq['stats']['player']
+                civ_stats = await self._run_db('stats', self.leaderboard.get_player_civ_stats,
+                                               self._get_player_jid(player_nick))
+                stanza['player'] = player_nick
+                if civ_stats:
+                    stanza['favouriteCiv'] = get_favourite_civ(civ_stats)
+            else:
+                logging.info('Received unknown stats command: "%s"', command)
+                self._send_error(iq, 'bad-request')
+                return
+        except Exception:
+            logging.exception("Failed to get civilization statistics for %s", iq['from'].bare)
+            self._send_error(iq, 'internal-server-error', 'wait')
+            return
+
+        stanza.add_items((civ, games, wins) for civ, (games, wins) in sorted(civ_stats.items()))
+        self._reply(iq, stanza, "civilization statistics")
+
+    async def _send_leaderboard(self, iq, limit=LEADERBOARD_PAGE_SIZE, after=None, around=None):
+        """Send a page of the leaderboard.
+
+        Arguments:
+            iq (slixmpp.stanza.iq.IQ): IQ stanza to reply to
+            limit (int): Number of players to send
+            after (tuple): Rating and id of the player after which to
+                start the page
+            around (slixmpp.jid.JID): JID of a player to center the
+                page on
+
+        """
+        position = None
+        if around:
+            position, ratings = await self._coalesce(
+                'boardlist', ('board_around', around.bare.lower(), limit),
+                self.leaderboard.get_board_around, str(around), limit)
+        if not position:
+            ratings = await self._coalesce('boardlist', ('board', limit, after),
+                                           self.leaderboard.get_board, limit, after)
+
+        stanza = BoardListXmppPlugin()
+        stanza.add_command('boardlist')
+        stanza.add_items((player['name'], player['rating']) for player in ratings.values())
+        if position:
+            stanza['position'] = str(position)
+        if ratings and len(ratings) == limit:
+            last = list(ratings.values())[-1]
+            stanza['cursor'] = '%i,%i' % (last['rating'], last['id'])
+        self._reply(iq, stanza, "leaderboard")
+
+    async def _get_rating_list_stanza(self, nicks):
+        """Create a stanza extension with the ratings of players.
+
+        Arguments:
+            nicks (dict): Nicks of the players by JID
+
+        Returns:
+            tuple of the BoardListXmppPlugin stanza and the number of
+            ratings it contains
+
+        """
+        ratings = await self._run_db('boardlist', self.leaderboard.get_rating_list, nicks)
+        stanza = BoardListXmppPlugin()
+        stanza.add_command('ratinglist')
+        stanza.add_items((player['name'], player['rating']) for player in ratings.values())
+        return stanza, len(ratings)
+
+    async def _send_rating_list(self, iq):
+        """Send the ratings of all online players.
+
+        Arguments:
+            iq (slixmpp.stanza.iq.IQ): IQ stanza to reply to
+
+        """
+        stanza, _ = await self._get_rating_list_stanza(self._get_occupants())
+        self._reply(iq, stanza, "rating list")
+
+    async def _broadcast_rating_list(self):
+        """Broadcast the ratings of all online players.
+
+        Returns:
+            asyncio.Task sending the rating list
+
+        """
+        nicks = self._get_occupants()
+        stanza, items = await self._get_rating_list_stanza(nicks)
+        return self._broadcast('ratinglist', stanza, nicks, items)
+
+    async def _send_profile(self, iq, player_nick):
+        """Send the player profile to a specified target.
+
+        Arguments:
+            iq (slixmpp.stanza.iq.IQ): IQ stanza to reply to
+            player_nick (str): The nick of the player to get the
+                profile for
+
+        """
+        player_jid = self._get_player_jid(player_nick)
+        stanza = self.profile_cache.get(player_jid, player_nick)
+        if stanza is None:
+            stanza = await self._coalesce(
+                'profile', ('profile', slixmpp.jid.JID(player_jid).bare.lower(), player_nick),
+                self._get_profile_stanza, player_jid, player_nick)
+        self._reply(iq, stanza, "profile")
+
+    async def _send_match_history(self, iq, player_nick, limit, before=None):
+        """Send a page of the match history of a player.
+
+        Arguments:
+            iq (slixmpp.stanza.iq.IQ): IQ stanza to reply to
+            player_nick (str): Nick of the player to get the match
+                history of
+            limit (int): Number of games to send
+            before (int): Id of the game before which to start the
+                page
+
+        """
+        player_jid = self._get_player_jid(player_nick)
+        games = await self._coalesce(
+            'profile', ('match_history', slixmpp.jid.JID(player_jid).bare.lower(), limit, before),
+            self.leaderboard.get_match_history, player_jid, limit, before)
+
+        stanza = ProfileXmppPlugin()
+        stanza.add_command(player_nick)
+        stanza['history'] = str(limit)
+        stanza.add_games(games)
+        if len(games) == limit:
+            stanza['cursor'] = str(games[-1]['id'])
+        self._reply(iq, stanza, "match history")
+
+    def _get_player_jid(self, player_nick):
+        """Get the JID of a player by nick.
+
+        Arguments:
+            player_nick (str): Nick of the player
+
+        Returns:
+            str with the JID of the player
+
+        """
+        jid_str = self.plugin['xep_0045'].get_jid_property(self.room, player_nick, 'jid')
+
+        # The player is not online, so let's assume the JID contains
+        # the nick as local part.
+        if not jid_str:
+            jid_str = '%s@%s/%s' % (player_nick, self.sjid.domain, '0ad')
+        return str(jid_str)
+
+    def _get_profile_stanza(self, player_jid, player_nick):
+        """Create the profile stanza for a player.
+
+        Successfully created stanzas get added to the profile cache.
+
+        Arguments:
+            player_jid (str): JID of the player
+            player_nick (str): Nick of the player
+
+        Returns:
+            ProfileXmppPlugin stanza for the player
+
+        """
+        generation = self.profile_cache.get_generation()
+        try:
+            stats = self.leaderboard.get_profile(player_jid)
+        except Exception:
+            logging.exception("Failed to get leaderboard profile for player %s", player_jid)
+            stats = None
+
+        stanza = ProfileXmppPlugin()
+        if stats:
+            stanza.add_item(player_nick, stats['rating'], stats['highestRating'],
+                            stats['rank'], stats['totalGamesPlayed'], stats['wins'],
+                            stats['losses'])
+        else:
+            stanza.add_item(player_nick, -2)
+        stanza.add_command(player_nick)
+
+        if stats is not None:
+            self.profile_cache.put(player_jid, player_nick, stats.get('rating'), stanza,
+                                   generation)
+        return stanza
@@ -0,0 +1,336 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""On-demand diagnostics for the XMPP-bots.
+
+Allows sampling CPU profiles and taking memory snapshots of running
+bots without stopping them. Diagnostics get triggered by signals or
+by ad-hoc commands sent by admins and run in background threads, so
+the processing of stanzas continues while they're running. Results
+get written to local files.
+"""
+
+import argparse
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from sleekxmpp.jid import JID
+
+# Number of frames to store for each memory allocation.
+TRACEMALLOC_FRAMES = 25
+
+# Number of entries to write for memory snapshots.
+MEMORY_SNAPSHOT_TOP_ENTRIES = 50
+
+# Default and maximum duration of CPU profiles in seconds.
+CPU_PROFILE_DURATION = 30
+CPU_PROFILE_MAX_DURATION = 600
+
+
+def parse_cpu_profile_duration(value):
+    """Parse the duration of CPU profiles given on the command line.
+
+    Arguments:
+        value (str): Duration in seconds
+
+    Returns:
+        float with the duration in seconds
+
+    Raises:
+        argparse.ArgumentTypeError: if the duration isn't a number
+            between 0 and `CPU_PROFILE_MAX_DURATION`
+
+    """
+    try:
+        duration = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid duration: %s" % value)
+    if not 0 < duration <= CPU_PROFILE_MAX_DURATION:
+        raise argparse.ArgumentTypeError("duration must be between 0 and %i seconds" %
+                                         CPU_PROFILE_MAX_DURATION)
+    return duration
+
+
+class SamplingProfiler(object):
+    """Profiler periodically sampling the stacks of all threads."""
+
+    def __init__(self, interval=0.01):
+        """Initialize the profiler.
+
+        Arguments:
+            interval (float): Time in seconds between two samples
+
+        """
+        self.interval = interval
+
+    def sample(self, duration):
+        """Sample the stacks of all other threads.
+
+        Arguments:
+            duration (float): Time in seconds to sample for
+
+        Returns:
+            collections.Counter with the collapsed stacks as keys and
+            the number of samples as values
+
+        """
+        samples = Counter()
+        own_thread_id = threading.get_ident()
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            for thread_id, frame in frames.items():
+                if thread_id == own_thread_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%i)' % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return samples
+
+
+class Diagnostics(object):
+    """Runs diagnostics of a bot in the background."""
+
+    def __init__(self, output_dir='.', cpu_profile_duration=CPU_PROFILE_DURATION,
+                 sampling_interval=0.01):
+        """Initialize the diagnostics.
+
+        Arguments:
+            output_dir (str): Directory to write results to
+            cpu_profile_duration (float): Default duration of CPU
+                profiles in seconds
+            sampling_interval (float): Time in seconds between two
+                samples of CPU profiles
+
+        """
+        self.output_dir = output_dir
+        self.cpu_profile_duration = cpu_profile_duration
+        self.profiler = SamplingProfiler(sampling_interval)
+        self._cpu_profile_lock = threading.Lock()
+        self._memory_snapshot_lock = threading.Lock()
+        self._memory_snapshot = None
+
+    def _get_path(self, kind, extension):
+        """Get the path of a new result file."""
+        return os.path.join(self.output_dir, '%s-%s-%i.%s' % (
+            kind, time.strftime('%Y%m%d-%H%M%S'), os.getpid(), extension))
+
+    def profile_cpu(self, duration=None):
+        """Start sampling a CPU profile in the background.
+
+        The profile gets written in the collapsed stack format, which
+        can be visualized as flame graph.
+
+        Arguments:
+            duration (float): Time in seconds to sample for, at most
+                `CPU_PROFILE_MAX_DURATION`. Defaults to the duration
+                the diagnostics got initialized with.
+
+        Returns:
+            threading.Thread running the profile or None if a profile
+            is already running
+
+        Raises:
+            ValueError: if the duration is out of bounds
+
+        """
+        duration = duration or self.cpu_profile_duration
+        if not 0 < duration <= CPU_PROFILE_MAX_DURATION:
+            raise ValueError("Invalid CPU profile duration: %s" % duration)
+
+        if not self._cpu_profile_lock.acquire(blocking=False):
+            logging.warning("Not starting CPU profile, as there is already one running")
+            return None
+
+        def run():
+            try:
+                logging.info("Starting CPU profile for %s seconds", duration)
+                samples = self.profiler.sample(duration)
+                path = self._get_path('cpu-profile', 'folded')
+                with open(path, 'w') as profile_file:
+                    for stack, count in samples.most_common():
+                        profile_file.write('%s %i\n' % (stack, count))
+                logging.info("Wrote CPU profile to %s", path)
+            except Exception:
+                logging.exception("Failed to create CPU profile")
+            finally:
+                self._cpu_profile_lock.release()
+
+        thread = threading.Thread(target=run, name='cpu-profile', daemon=True)
+        thread.start()
+        return thread
+
+    def snapshot_memory(self):
+        """Take a memory snapshot in the background.
+
+        The first snapshot starts tracing memory allocations. Every
+        following snapshot gets compared to the previous one and the
+        largest differences as well as the largest allocations get
+        written to a file. The raw snapshot gets stored as well for
+        further analysis with `tracemalloc.Snapshot.load()`.
+
+        Returns:
+            threading.Thread taking the snapshot or None if a snapshot
+            is already being taken
+
+        """
+        if not self._memory_snapshot_lock.acquire(blocking=False):
+            logging.warning("Not taking memory snapshot, as there is already one being taken")
+            return None
+
+        def run():
+            try:
+                self._write_memory_snapshot()
+            except Exception:
+                logging.exception("Failed to take memory snapshot")
+            finally:
+                self._memory_snapshot_lock.release()
+
+        thread = threading.Thread(target=run, name='memory-snapshot', daemon=True)
+        thread.start()
+        return thread
+
+    def _write_memory_snapshot(self):
+        """Take a memory snapshot and write it to a file."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            logging.info("Started tracing memory allocations, take another snapshot to get "
+                         "allocations since now")
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+        path = self._get_path('memory-snapshot', 'txt')
+        with open(path, 'w') as snapshot_file:
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot_file.write('Traced memory: %i bytes, peak: %i bytes\n' % (current, peak))
+            if self._memory_snapshot is not None:
+                snapshot_file.write('\nLargest differences to previous snapshot:\n')
+                for stat in snapshot.compare_to(self._memory_snapshot,
+                                                'lineno')[:MEMORY_SNAPSHOT_TOP_ENTRIES]:
+                    snapshot_file.write('%s\n' % stat)
+            snapshot_file.write('\nLargest allocations:\n')
+            for stat in snapshot.statistics('lineno')[:MEMORY_SNAPSHOT_TOP_ENTRIES]:
+                snapshot_file.write('%s\n' % stat)
+        snapshot.dump(path[:-len('txt')] + 'snapshot')
+        self._memory_snapshot = snapshot
+        logging.info("Wrote memory snapshot to %s", path)
+
+    def install_signal_handlers(self):
+        """Trigger diagnostics by signals.
+
+        SIGUSR1 starts a CPU profile of the duration the diagnostics
+        got initialized with, SIGUSR2 takes a memory snapshot.
+        """
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.profile_cpu())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.snapshot_memory())
+
+    def register_commands(self, xmpp, admin_jids):
+        """Trigger diagnostics by ad-hoc commands from admins.
+
+        The command for CPU profiles asks for the duration of the
+        profile using a form. Requires the XEP-0004 and XEP-0050
+        plugins to be registered.
+
+        Arguments:
+            xmpp (sleekxmpp.ClientXMPP): Bot to offer the commands
+            admin_jids (list): Bare JIDs which are allowed to trigger
+                diagnostics
+
+        """
+        admin_jids = {JID(jid).bare.lower() for jid in admin_jids}
+
+        def is_admin(jid):
+            if JID(jid).bare.lower() in admin_jids:
+                return True
+            logging.warning("Rejected diagnostics command from %s", jid)
+            return False
+
+        def make_handler(action, description):
+            def handler(iq, session):
+                if not is_admin(iq['from']):
+                    session['notes'] = [('error', "Not allowed")]
+                elif action():
+                    session['notes'] = [('info', "Started %s" % description)]
+                else:
+                    session['notes'] = [('warn', "A %s is already running" % description)]
+                session['has_next'] = False
+                session['next'] = None
+                return session
+            return handler
+
+        def profile_cpu_form(iq, session):
+            if not is_admin(iq['from']):
+                session['notes'] = [('error', "Not allowed")]
+                session['has_next'] = False
+                session['next'] = None
+                return session
+
+            form = xmpp['xep_0004'].make_form('form', "Sample a CPU profile")
+            form.add_field(var='duration', ftype='text-single',
+                           label="Duration in seconds (at most %i)" % CPU_PROFILE_MAX_DURATION,
+                           value=str(self.cpu_profile_duration), required=True)
+            session['payload'] = form
+            session['has_next'] = False
+            session['next'] = profile_cpu_submit
+            return session
+
+        def profile_cpu_submit(payload, session):
+            session['payload'] = None
+            session['next'] = None
+            if not is_admin(session['from']):
+                session['notes'] = [('error', "Not allowed")]
+                return session
+
+            try:
+                duration = float(payload['values']['duration'])
+            except (KeyError, TypeError, ValueError):
+                duration = None
+            if duration is None or not 0 < duration <= CPU_PROFILE_MAX_DURATION:
+                session['notes'] = [('error', "The duration must be a number of seconds between "
+                                              "0 and %i" % CPU_PROFILE_MAX_DURATION)]
+            elif self.profile_cpu(duration):
+                session['notes'] = [('info', "Started CPU profile for %s seconds" % duration)]
+            else:
+                session['notes'] = [('warn', "A CPU profile is already running")]
+            return session
+
+        def add_commands(event):  # pylint: disable=unused-argument
+            xmpp['xep_0050'].add_command(node='profile-cpu', name="Sample a CPU profile",
+                                         handler=profile_cpu_form)
+            xmpp['xep_0050'].add_command(node='snapshot-memory', name="Take a memory snapshot",
+                                         handler=make_handler(self.snapshot_memory,
+                                                              "memory snapshot"))
+
+        xmpp.add_event_handler('session_start', add_commands)
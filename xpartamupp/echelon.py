@@ -19,40 +19,429 @@
 """0ad XMPP-bot responsible for managing game ratings."""
 
 import argparse
-import difflib
+import json
 import logging
+import random
 import sys
-from collections import deque
+import threading
+import time
+from collections import Counter, deque
 
 import sleekxmpp
 from sleekxmpp.stanza import Iq
 from sleekxmpp.xmlstream.handler import Callback
 from sleekxmpp.xmlstream.matcher import StanzaPath
 from sleekxmpp.xmlstream.stanzabase import register_stanza_plugin
-from sqlalchemy import create_engine, func
+from sqlalchemy import and_, create_engine, func, or_
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import QueuePool
 
 from xpartamupp.elo import get_rating_adjustment
-from xpartamupp.lobby_ranking import Game, Player, PlayerInfo
-from xpartamupp.stanzas import (BoardListXmppPlugin, GameReportXmppPlugin, ProfileXmppPlugin)
-from xpartamupp.utils import LimitedSizeDict
+from xpartamupp.lobby_ranking import (CivStats, Game, MapCivStats, Player, PlayerCivStats,
+                                      PlayerInfo, PlayerInfoArchive, add_civ_stats,
+                                      configure_engine)
+from xpartamupp.diagnostics import (CPU_PROFILE_DURATION, Diagnostics,
+                                    parse_cpu_profile_duration)
+from xpartamupp.metrics import (BROADCAST_DURATION, BROADCAST_ITEMS, BROADCAST_RECIPIENTS,
+                                RATE_LIMITED_REQUESTS, REGISTRY, instrument_engine,
+                                instrument_handler, register_queue_gauges, start_metrics_server)
+from xpartamupp.query_log import QueryProfiler, query_context, slow_query_logger
+from xpartamupp.stanzas import (BoardListXmppPlugin, GameReportXmppPlugin, ProfileXmppPlugin,
+                                StatsXmppPlugin)
+from xpartamupp.utils import LimitedSizeDict, SingleFlight, TokenBucketLimiter
 
 # Rating that new players should be inserted into the
 # database with, before they've played any games.
 LEADERBOARD_DEFAULT_RATING = 1200
 
+# Number of players sent per page of the leaderboard, unless the
+# client requests a different page size.
+LEADERBOARD_PAGE_SIZE = 100
+
+# Maximum number of players clients can request per leaderboard page.
+LEADERBOARD_MAX_PAGE_SIZE = 500
+
+# Maximum number of games clients can request per page of the match
+# history of a player.
+MATCH_HISTORY_MAX_PAGE_SIZE = 100
+
+PROFILE_CACHE_REQUESTS = REGISTRY.counter('xpartamupp_profile_cache_requests_total',
+                                          "Number of profile requests by cache result",
+                                          ('result',))
+COALESCED_REQUESTS = REGISTRY.counter('xpartamupp_coalesced_requests_total',
+                                      "Number of requests served by the result of a concurrent "
+                                      "identical request", ('request',))
+RATING_CONFLICTS = REGISTRY.counter('xpartamupp_rating_conflicts_total',
+                                    "Number of rating updates retried due to concurrent changes "
+                                    "of the same players")
+
+# Maximum number of differing fields included in the diff of two
+# mismatching game reports, to keep log lines at a sane size.
+REPORT_DIFF_MAX_FIELDS = 16
+
+# Maximum length of a single value included in a report diff.
+REPORT_DIFF_MAX_VALUE_LENGTH = 64
+
+# Fields of game reports describing the game as a whole.
+REPORT_GAME_FIELDS = frozenset({'timeElapsed', 'mapName', 'teamsLocked', 'matchID',
+                                'playerStates', 'playerID'})
+
+# Statistics of game reports reported per player, which get stored
+# as columns of `PlayerInfo`.
+REPORT_PLAYER_STATS = frozenset({
+    # Scores
+    'economyScore', 'militaryScore', 'totalScore',
+    # Resources
+    'foodGathered', 'foodUsed', 'woodGathered', 'woodUsed', 'stoneGathered', 'stoneUsed',
+    'metalGathered', 'metalUsed', 'vegetarianFoodGathered', 'treasuresCollected',
+    'lootCollected', 'tributesSent', 'tributesReceived',
+    # Units
+    'totalUnitsTrained', 'totalUnitsLost', 'enemytotalUnitsKilled', 'infantryUnitsTrained',
+    'infantryUnitsLost', 'enemyInfantryUnitsKilled', 'workerUnitsTrained', 'workerUnitsLost',
+    'enemyWorkerUnitsKilled', 'femaleCitizenUnitsTrained', 'femaleCitizenUnitsLost',
+    'enemyFemaleCitizenUnitsKilled', 'cavalryUnitsTrained', 'cavalryUnitsLost',
+    'enemyCavalryUnitsKilled', 'championUnitsTrained', 'championUnitsLost',
+    'enemyChampionUnitsKilled', 'heroUnitsTrained', 'heroUnitsLost', 'enemyHeroUnitsKilled',
+    'shipUnitsTrained', 'shipUnitsLost', 'enemyShipUnitsKilled', 'traderUnitsTrained',
+    'traderUnitsLost', 'enemyTraderUnitsKilled',
+    # Buildings
+    'totalBuildingsConstructed', 'totalBuildingsLost', 'enemytotalBuildingsDestroyed',
+    'civCentreBuildingsConstructed', 'civCentreBuildingsLost', 'enemyCivCentreBuildingsDestroyed',
+    'houseBuildingsConstructed', 'houseBuildingsLost', 'enemyHouseBuildingsDestroyed',
+    'economicBuildingsConstructed', 'economicBuildingsLost', 'enemyEconomicBuildingsDestroyed',
+    'outpostBuildingsConstructed', 'outpostBuildingsLost', 'enemyOutpostBuildingsDestroyed',
+    'militaryBuildingsConstructed', 'militaryBuildingsLost', 'enemyMilitaryBuildingsDestroyed',
+    'fortressBuildingsConstructed', 'fortressBuildingsLost', 'enemyFortressBuildingsDestroyed',
+    'wonderBuildingsConstructed', 'wonderBuildingsLost', 'enemyWonderBuildingsDestroyed',
+    # Market
+    'woodBought', 'foodBought', 'stoneBought', 'metalBought', 'tradeIncome',
+    # Miscellaneous
+    'civs', 'teams', 'percentMapExplored',
+})
+
+# Fields of game reports counted individually as report mismatches.
+# Clients can send arbitrary fields, so all others get counted as
+# "other", to keep the number of metric labels bounded.
+REPORT_FIELDS = REPORT_GAME_FIELDS | REPORT_PLAYER_STATS
+
+# Number of seconds after a write during which the profile of an
+# affected player gets read from the primary database instead of the
+# read replica, to not serve stale data due to replication lag.
+READ_YOUR_WRITES_WINDOW = 30
+
+# Number of times the rating update of a game gets attempted, if the
+# ratings of its players got changed concurrently by another process.
+RATING_UPDATE_ATTEMPTS = 5
+
+# Base number of seconds to wait before attempting a rating update
+# again. The wait doubles with every attempt and is randomized, so
+# conflicting processes don't retry in lockstep.
+RATING_RETRY_BACKOFF = 0.05
+
+# Number of seconds after which the cached civilization statistics get
+# loaded from the database again, to include games added by other
+# EcheLOn processes.
+CIV_STATS_CACHE_TTL = 300
+
+# Number of seconds after which cached profiles get retrieved from
+# the database again. Changes by other EcheLOn processes don't
+# invalidate cached profiles, so this bounds how outdated they get.
+PROFILE_CACHE_TTL = 30
+
+
+def get_favourite_civ(civ_stats):
+    """Get the civilization played most often.
+
+    Arguments:
+        civ_stats (dict): Tuples of number of games and wins by
+            civilization
+
+    Returns:
+        str with the civilization with the most games, ties are broken
+        by the number of wins, or None if there are no games
+
+    """
+    if not civ_stats:
+        return None
+    return max(sorted(civ_stats), key=lambda civ: civ_stats[civ])
+
+
+def get_engine_options(db_url, pool_size=None,  # pylint: disable=too-many-arguments
+                       max_overflow=None, pool_recycle=None, pool_pre_ping=False,
+                       statement_timeout=None):
+    """Get the options to create a database engine with.
+
+    File-based SQLite databases use a connection pool instead of
+    opening a new connection for every transaction, so connection
+    specific settings only have to be applied once per connection.
+
+    Arguments:
+        db_url (str): URL of the database
+        pool_size (int): Number of connections to keep open
+        max_overflow (int): Number of connections to open in addition
+            to the pool size under load
+        pool_recycle (int): Time in seconds after which connections
+            get replaced
+        pool_pre_ping (bool): Whether to check connections for
+            liveness before using them
+        statement_timeout (int): Time in milliseconds after which
+            statements get aborted, only supported for PostgreSQL
+
+    Returns:
+        dict with options for `sqlalchemy.create_engine()`
+
+    """
+    url = make_url(db_url)
+    backend = url.get_backend_name()
+    options = {}
+    connect_args = {}
+
+    if backend == 'sqlite':
+        if url.database and url.database != ':memory:':
+            options['poolclass'] = QueuePool
+            connect_args['check_same_thread'] = False
+        elif pool_size is not None or max_overflow is not None:
+            logging.warning("Pool size settings are ignored for in-memory SQLite databases")
+            pool_size = max_overflow = None
+
+    if pool_size is not None:
+        options['pool_size'] = pool_size
+    if max_overflow is not None:
+        options['max_overflow'] = max_overflow
+    if pool_recycle is not None:
+        options['pool_recycle'] = pool_recycle
+    if pool_pre_ping:
+        options['pool_pre_ping'] = True
+
+    if statement_timeout is not None:
+        if backend == 'postgresql':
+            connect_args['options'] = '-c statement_timeout=%i' % statement_timeout
+        else:
+            logging.warning("Statement timeouts are only supported for PostgreSQL")
+
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
+
+
+class CivStatsCache(object):
+    """In-memory copy of the civilization statistics of all players.
+
+    The statistics are replaced instead of modified on changes, so
+    readers can use them without locking or copying.
+
+    Loading and adding games are serialized by a lock. Each load
+    increments the generation of the statistics, so games committed
+    before a load started get skipped instead of being counted twice.
+    """
+
+    def __init__(self, ttl=CIV_STATS_CACHE_TTL):
+        """Initialize an empty cache.
+
+        Arguments:
+            ttl (float): Number of seconds after which the statistics
+                have to be loaded again
+
+        """
+        self.ttl = ttl
+        self.civs = {}
+        self.maps = {}
+        self.loaded = None
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def is_stale(self):
+        """Check whether the statistics have to be loaded.
+
+        Returns:
+            True if the statistics were never loaded or are older than
+            the time to live, False otherwise
+
+        """
+        return self.loaded is None or time.monotonic() - self.loaded > self.ttl
+
+    def load(self, db):
+        """Load the statistics from the database.
+
+        Arguments:
+            db (sqlalchemy.orm.Session): Session to load the
+                statistics with
+
+        """
+        with self.lock:
+            self.generation += 1
+            civs = {row.civ: (row.games, row.wins) for row in db.query(CivStats)}
+            maps = {}
+            for row in db.query(MapCivStats):
+                maps.setdefault(row.map, {})[row.civ] = (row.games, row.wins)
+            self.civs = civs
+            self.maps = maps
+            self.loaded = time.monotonic()
+
+    def add_game(self, map_name, results, generation):
+        """Add the results of a game committed to the database.
+
+        Arguments:
+            map_name (str): Name of the map of the game
+            results (list): Tuples of civilization and whether the
+                player won, for every player of the game
+            generation (int): Generation of the statistics before the
+                game got committed. If they got loaded since, the game
+                is skipped, as they may include it already.
+
+        """
+        with self.lock:
+            if self.loaded is None or self.generation != generation:
+                return
+            civs = dict(self.civs)
+            map_civs = dict(self.maps.get(map_name, {}))
+            for civ, won in results:
+                if not civ:
+                    continue
+                for stats in (civs, map_civs):
+                    games, wins = stats.get(civ, (0, 0))
+                    stats[civ] = (games + 1, wins + int(won))
+            self.civs = civs
+            self.maps = dict(self.maps)
+            self.maps[map_name] = map_civs
+
+    def get(self, map_name=None):
+        """Get the statistics of all civilizations.
+
+        Arguments:
+            map_name (str): Name of the map to get the statistics of,
+                None for the statistics of all maps
+
+        Returns:
+            dict with tuples of number of games and wins by
+            civilization, which must not be modified
+
+        """
+        if map_name is None:
+            return self.civs
+        return self.maps.get(map_name, {})
+
 
 class Leaderboard(object):
     """Class that provides and manages leaderboard data."""
 
-    def __init__(self, db_url):
-        """Initialize the leaderboard."""
+    def __init__(self, db_url, query_profiler=None, engine_options=None,
+                 read_db_url=None, read_engine_options=None):
+        """Initialize the leaderboard.
+
+        Arguments:
+            db_url (str): URL of the leaderboard database
+            query_profiler (QueryProfiler): Profiler to record the
+                executed SQL statements with
+            engine_options (dict): Additional options for the creation
+                of the database engine, as returned by
+                `get_engine_options()`
+            read_db_url (str): URL of a read replica of the leaderboard
+                database to run read-only queries against
+            read_engine_options (dict): Additional options for the
+                creation of the database engine for the read replica
+
+        """
         self.rating_messages = deque()
+        self.query_profiler = query_profiler
+        self.recent_writes = LimitedSizeDict(size_limit=2**12)
+        self.write_listeners = []
+        self.civ_stats = CivStatsCache()
+
+        self.db = scoped_session(sessionmaker(bind=self._create_engine(db_url,
+                                                                       engine_options)))
+        if read_db_url:
+            self.read_db = scoped_session(sessionmaker(
+                bind=self._create_engine(read_db_url, read_engine_options)))
+        else:
+            self.read_db = self.db
+
+    def _create_engine(self, db_url, engine_options=None):
+        """Create and instrument a database engine.
+
+        Arguments:
+            db_url (str): URL of the database
+            engine_options (dict): Additional options for the creation
+                of the database engine
+
+        Returns:
+            sqlalchemy.engine.Engine for the database
+
+        """
+        engine = create_engine(db_url, **(engine_options or {}))
+        configure_engine(engine)
+        instrument_engine(engine)
+        if self.query_profiler:
+            self.query_profiler.instrument(engine)
+        return engine
+
+    def _mark_written(self, player, old_rating=None, new_rating=None):
+        """Remember that data of a player has just been changed.
+
+        Listeners registered in `write_listeners` get called with the
+        JID of the player and its old and new rating.
+
+        Arguments:
+            player (Player): Player whose data got changed
+            old_rating (int): Rating of the player before the change,
+                None if the rating didn't change
+            new_rating (int): Rating of the player written by the
+                change, None if the rating didn't change
+
+        """
+        jid = player.jid.lower()
+        self.recent_writes.pop(jid, None)
+        self.recent_writes[jid] = time.monotonic()
+        for listener in self.write_listeners:
+            listener(player.jid, old_rating, new_rating)
+
+    def _lock_players(self, players):
+        """Lock the rows of players until the end of the transaction.
+
+        Rows get locked in the order of their ids, so processes
+        locking the same players can't deadlock. The players get
+        reloaded afterwards, so they contain the current data.
 
-        engine = create_engine(db_url)
-        session_factory = sessionmaker(bind=engine)
-        self.db = scoped_session(session_factory)
+        SQLite doesn't support locking rows and only starts
+        transactions when writing, so a write not changing anything
+        locks the whole database instead.
 
+        Arguments:
+            players (list): Player objects to lock
+
+        """
+        ids = sorted(player.id for player in players)
+        if self.db.get_bind().dialect.name == 'sqlite':
+            self.db.execute(Player.__table__.update().where(Player.id.in_(ids))
+                            .values(version=Player.version))
+        self.db.query(Player).filter(Player.id.in_(ids)).order_by(Player.id) \
+            .with_for_update().populate_existing().all()
+
+    def _get_session_for(self, jid):
+        """Get the database session to read data of a player from.
+
+        Reads go to the read replica, except for players whose data
+        got changed within the last `READ_YOUR_WRITES_WINDOW` seconds,
+        as the replica might not have caught up with these changes yet.
+
+        Arguments:
+            jid (sleekxmpp.jid.JID): JID of the player to read data of
+
+        Returns:
+            sqlalchemy.orm.scoped_session to use for reading
+
+        """
+        if self.read_db is self.db:
+            return self.db
+
+        written = self.recent_writes.get(str(jid).lower())
+        if written is not None and time.monotonic() - written < READ_YOUR_WRITES_WINDOW:
+            return self.db
+        return self.read_db
+
+    @query_context('get_or_create_player')
     def get_or_create_player(self, jid):
         """Get a player from the leaderboard database.
 
@@ -77,6 +466,7 @@ class Leaderboard(object):
         logging.debug("Created player %s", jid)
         return player
 
+    @query_context('get_profile')
     def get_profile(self, jid):
         """Get the leaderboard profile for the specified player.
 
@@ -90,7 +480,8 @@ class Leaderboard(object):
 
         """
         stats = {}
-        player = self.db.query(Player).filter(Player.jid.ilike(str(jid))).first()
+        db = self._get_session_for(jid)
+        player = db.query(Player).filter(Player.jid.ilike(str(jid))).first()
 
         if not player:
             logging.debug("Couldn't find profile for player %s", jid)
@@ -98,19 +489,21 @@ class Leaderboard(object):
 
         if player.rating != -1:
             stats['rating'] = player.rating
-            rank = self.db.query(Player).filter(Player.rating >= player.rating).count()
+            rank = db.query(Player).filter(Player.rating >= player.rating).count()
             stats['rank'] = rank
 
         if player.highest_rating != -1:
             stats['highestRating'] = player.highest_rating
 
-        games_played = self.db.query(PlayerInfo).filter_by(player_id=player.id).count()
-        wins = self.db.query(Game).filter_by(winner_id=player.id).count()
+        games_played = db.query(PlayerInfo).filter_by(player_id=player.id).count() + \
+            (player.archived_games or 0)
+        wins = db.query(Game).filter_by(winner_id=player.id).count()
         stats['totalGamesPlayed'] = games_played
         stats['wins'] = wins
         stats['losses'] = games_played - wins
         return stats
 
+    @query_context('add_game')
     def _add_game(self, game_report):  # pylint: disable=too-many-locals
         """Add a game to the database.
 
@@ -132,59 +525,36 @@ class Leaderboard(object):
             return None
 
         players = self.db.query(Player).filter(func.lower(Player.jid).in_(
-            dict.keys(game_report['playerStates'])))
+            dict.keys(game_report['playerStates']))).all()
 
         winning_jid = [jid for jid, state in game_report['playerStates'].items()
                        if state == 'won'][0]
 
-        # single_stats = {'timeElapsed', 'mapName', 'teamsLocked', 'matchID'}
-        total_score_stats = {'economyScore', 'militaryScore', 'totalScore'}
-        resource_stats = {'foodGathered', 'foodUsed', 'woodGathered', 'woodUsed', 'stoneGathered',
-                          'stoneUsed', 'metalGathered', 'metalUsed', 'vegetarianFoodGathered',
-                          'treasuresCollected', 'lootCollected', 'tributesSent',
-                          'tributesReceived'}
-        units_stats = {'totalUnitsTrained', 'totalUnitsLost', 'enemytotalUnitsKilled',
-                       'infantryUnitsTrained', 'infantryUnitsLost', 'enemyInfantryUnitsKilled',
-                       'workerUnitsTrained', 'workerUnitsLost', 'enemyWorkerUnitsKilled',
-                       'femaleCitizenUnitsTrained', 'femaleCitizenUnitsLost',
-                       'enemyFemaleCitizenUnitsKilled', 'cavalryUnitsTrained', 'cavalryUnitsLost',
-                       'enemyCavalryUnitsKilled', 'championUnitsTrained', 'championUnitsLost',
-                       'enemyChampionUnitsKilled', 'heroUnitsTrained', 'heroUnitsLost',
-                       'enemyHeroUnitsKilled', 'shipUnitsTrained', 'shipUnitsLost',
-                       'enemyShipUnitsKilled', 'traderUnitsTrained', 'traderUnitsLost',
-                       'enemyTraderUnitsKilled'}
-        buildings_stats = {'totalBuildingsConstructed', 'totalBuildingsLost',
-                           'enemytotalBuildingsDestroyed', 'civCentreBuildingsConstructed',
-                           'civCentreBuildingsLost', 'enemyCivCentreBuildingsDestroyed',
-                           'houseBuildingsConstructed', 'houseBuildingsLost',
-                           'enemyHouseBuildingsDestroyed', 'economicBuildingsConstructed',
-                           'economicBuildingsLost', 'enemyEconomicBuildingsDestroyed',
-                           'outpostBuildingsConstructed', 'outpostBuildingsLost',
-                           'enemyOutpostBuildingsDestroyed', 'militaryBuildingsConstructed',
-                           'militaryBuildingsLost', 'enemyMilitaryBuildingsDestroyed',
-                           'fortressBuildingsConstructed', 'fortressBuildingsLost',
-                           'enemyFortressBuildingsDestroyed', 'wonderBuildingsConstructed',
-                           'wonderBuildingsLost', 'enemyWonderBuildingsDestroyed'}
-        market_stats = {'woodBought', 'foodBought', 'stoneBought', 'metalBought', 'tradeIncome'}
-        misc_stats = {'civs', 'teams', 'percentMapExplored'}
-
-        stats = total_score_stats | resource_stats | units_stats | buildings_stats | market_stats \
-            | misc_stats
-
         player_infos = []
+        results = []
         for player in players:
             player_jid = sleekxmpp.jid.JID(player.jid)
             player_info = PlayerInfo(player=player)
-            for report_name in stats:
+            for report_name in REPORT_PLAYER_STATS:
                 setattr(player_info, report_name, game_report[report_name][player_jid])
             player_infos.append(player_info)
+            results.append((player.id, player_info.civs,
+                            player.jid.lower() == str(winning_jid).lower()))
 
         game = Game(map=game_report['mapName'], duration=int(game_report['timeElapsed']),
                     teamsLocked=bool(game_report['teamsLocked']), matchID=game_report['matchID'])
         game.player_info.extend(player_infos)
         game.winner = self.db.query(Player).filter(Player.jid.ilike(str(winning_jid))).first()
         self.db.add(game)
+        add_civ_stats(self.db, game.map, results)
+        # Wait for any load in progress, as it may already have
+        # incremented the generation without having read the statistics.
+        with self.civ_stats.lock:
+            generation = self.civ_stats.generation
         self.db.commit()
+        self.civ_stats.add_game(game.map, [(civ, won) for _, civ, won in results], generation)
+        for player in players:
+            self._mark_written(player)
         return game
 
     @staticmethod
@@ -207,23 +577,91 @@ class Leaderboard(object):
             return False
         return True
 
+    @query_context('rate_game')
     def _rate_game(self, game):
         """Update player ratings based on game outcome.
 
         Take a game with 2 players and alters their ratings based on
         the result of the game.
 
-        Adjusts the players ratings in the database.
+        Adjusts the players ratings in the database. As multiple
+        EcheLOn processes might rate games of the same players at the
+        same time, the rows of the players get locked before reading
+        their ratings. The update only succeeds if the ratings didn't
+        change since they got read nonetheless, otherwise the
+        adjustments get calculated again based on the current ratings
+        after a randomized backoff.
 
         Arguments:
             game (Game): game to rate
+
+        Raises:
+            sqlalchemy.orm.exc.StaleDataError: if the ratings kept
+                changing concurrently for `RATING_UPDATE_ATTEMPTS`
+                attempts
+
+        """
+        for attempt in range(1, RATING_UPDATE_ATTEMPTS + 1):
+            player1 = game.players[0]
+            player2 = game.players[1]
+            try:
+                self._lock_players([player1, player2])
+                old_rating1 = player1.rating
+                old_rating2 = player2.rating
+                # Loading related objects while adjusting the ratings
+                # can flush changes already, so conflicts can be
+                # detected before committing as well.
+                message = self._adjust_ratings(game, player1, player2)
+                # Committing expires the players, reading the ratings
+                # afterwards could return ratings written by others.
+                new_rating1 = player1.rating
+                new_rating2 = player2.rating
+                self.db.commit()
+            except StaleDataError:
+                # Rolling back expires all loaded objects, so the next
+                # attempt reads the current ratings.
+                self.db.rollback()
+                RATING_CONFLICTS.inc()
+                if attempt == RATING_UPDATE_ATTEMPTS:
+                    raise
+                logging.info("Ratings of %s and %s changed concurrently, retrying", player1.jid,
+                             player2.jid)
+                time.sleep(random.uniform(0, RATING_RETRY_BACKOFF * 2 ** attempt))
+            else:
+                break
+
+        self.rating_messages.append(message)
+        self._mark_written(player1, old_rating1, new_rating1)
+        self._mark_written(player2, old_rating2, new_rating2)
+
+    @staticmethod
+    def _adjust_ratings(game, player1, player2):
+        """Adjust the ratings of the players of a game.
+
+        Changes are only applied to the player objects and the results
+        of the game, they still need to be committed.
+
+        Arguments:
+            game (Game): game to rate
+            player1 (Player): first player of the game
+            player2 (Player): second player of the game
+
+        Returns:
+            str with a message announcing the rating adjustments
+
         """
-        player1 = game.players[0]
-        player2 = game.players[1]
         # Since it's impossible to draw in the game currently, the
         # database model, and therefore this code, requires a winner.
         # The Elo implementation does not, however.
         result = 1 if player1 == game.winner else -1
+
+        # Results of archived games aren't part of the relationship
+        # anymore, but still count as played games. They're read before
+        # changing any player, as loading them autoflushes pending
+        # changes.
+        games1 = len(player1.games) + (player1.archived_games or 0)
+        games2 = len(player2.games) + (player2.archived_games or 0)
+
         # Player's ratings are -1 unless they have played a rated game.
         if player1.rating == -1:
             player1.rating = LEADERBOARD_DEFAULT_RATING
@@ -232,11 +670,9 @@ class Leaderboard(object):
 
         try:
             rating_adjustment1 = int(get_rating_adjustment(player1.rating, player2.rating,
-                                                           len(player1.games), len(player2.games),
-                                                           result))
+                                                           games1, games2, result))
             rating_adjustment2 = int(get_rating_adjustment(player2.rating, player1.rating,
-                                                           len(player2.games), len(player1.games),
-                                                           result * -1))
+                                                           games2, games1, result * -1))
         except ValueError:
             rating_adjustment1 = 0
             rating_adjustment2 = 0
@@ -249,20 +685,23 @@ class Leaderboard(object):
             result_qualitative = 'lost'
         name1 = sleekxmpp.jid.JID(player1.jid).local
         name2 = sleekxmpp.jid.JID(player2.jid).local
-        self.rating_messages.append("A rated game has ended. %s %s against %s. Rating "
-                                    "Adjustment: %s (%s -> %s) and %s (%s -> %s)." %
-                                    (name1, result_qualitative, name2, name1, player1.rating,
-                                     player1.rating + rating_adjustment1, name2, player2.rating,
-                                     player2.rating + rating_adjustment2))
+        message = ("A rated game has ended. %s %s against %s. Rating Adjustment: %s (%s -> %s) "
+                   "and %s (%s -> %s)." %
+                   (name1, result_qualitative, name2, name1, player1.rating,
+                    player1.rating + rating_adjustment1, name2, player2.rating,
+                    player2.rating + rating_adjustment2))
         player1.rating += rating_adjustment1
         player2.rating += rating_adjustment2
+        rating_changes = {player1.id: rating_adjustment1, player2.id: rating_adjustment2}
+        for player_info in game.player_info:
+            player_info.rating_change = rating_changes.get(player_info.player_id)
         if not player1.highest_rating:
             player1.highest_rating = -1
         if not player2.highest_rating:
             player2.highest_rating = -1
         player1.highest_rating = max(player1.rating, player1.highest_rating)
         player2.highest_rating = max(player2.rating, player2.highest_rating)
-        self.db.commit()
+        return message
 
     def get_rating_messages(self):
         """Get messages announcing rated games.
@@ -273,6 +712,7 @@ class Leaderboard(object):
         """
         return self.rating_messages
 
+    @query_context('add_and_rate_game')
     def add_and_rate_game(self, game_report):
         """Add and rate a game.
 
@@ -290,24 +730,186 @@ class Leaderboard(object):
             self._rate_game(game)
         return game
 
-    def get_board(self, limit=100):
+    @query_context('get_civ_stats')
+    def get_civ_stats(self, map_name=None):
+        """Get the results of all players per civilization.
+
+        Statistics are served from memory and only loaded from the
+        database once they're older than `CIV_STATS_CACHE_TTL`.
+
+        Arguments:
+            map_name (str): Name of the map to get the statistics of,
+                None for the statistics of all maps
+
+        Returns:
+            dict with tuples of number of games and wins by
+            civilization, which must not be modified
+
+        """
+        if self.civ_stats.is_stale():
+            self.civ_stats.load(self.read_db)
+        return self.civ_stats.get(map_name)
+
+    @query_context('get_player_civ_stats')
+    def get_player_civ_stats(self, jid):
+        """Get the results of a player per civilization.
+
+        Arguments:
+            jid (sleekxmpp.jid.JID): JID of the player
+
+        Returns:
+            dict with tuples of number of games and wins by
+            civilization, empty if the player isn't known
+
+        """
+        db = self._get_session_for(jid)
+        rows = db.query(PlayerCivStats).join(Player, Player.id == PlayerCivStats.player_id) \
+            .filter(Player.jid.ilike(str(jid)))
+        return {row.civ: (row.games, row.wins) for row in rows}
+
+    @query_context('get_match_history')
+    def get_match_history(self, jid, limit, before=None):
+        """Get the most recent games of a player.
+
+        Pages beyond the first one are retrieved by passing the id of
+        the last game of the previous page, so every page can be
+        served by seeking in the indexes on player and game id,
+        instead of skipping over all more recent games. Archived
+        results are included.
+
+        Arguments:
+            jid (sleekxmpp.jid.JID): JID of the player
+            limit (int): Number of games to return
+            before (int): Id of the game before which to start the
+                returned page, None to start with the most recent game
+
+        Returns:
+            list of dicts with the id, map and duration of each game,
+            the civilization, team, result and rating change of the
+            player and tuples of nick, civilization and team of the
+            other players, most recent game first. Empty if the player
+            isn't known.
+
+        """
+        db = self._get_session_for(jid)
+        player = db.query(Player).filter(Player.jid.ilike(str(jid))).first()
+        if not player:
+            return []
+
+        # Results of a game are either all in the archive or all not,
+        # but while archiving is in progress the archive can contain
+        # games more recent than the oldest ones not archived yet, so
+        # a page gets taken from both and merged.
+        results = []
+        for model, rating_change in ((PlayerInfo, PlayerInfo.rating_change),
+                                     (PlayerInfoArchive, PlayerInfoArchive.stats)):
+            query = db.query(model.game_id, model.civs, model.teams, rating_change, Game.map,
+                             Game.duration, Game.winner_id) \
+                .join(Game, Game.id == model.game_id).filter(model.player_id == player.id)
+            if before is not None:
+                query = query.filter(model.game_id < before)
+            for row in query.order_by(model.game_id.desc()).limit(limit):
+                row = list(row)
+                if model is PlayerInfoArchive:
+                    row[3] = json.loads(row[3] or '{}').get('rating_change')
+                results.append(row)
+        results.sort(key=lambda row: row[0], reverse=True)
+        del results[limit:]
+
+        game_ids = [row[0] for row in results]
+        other_players = {game_id: [] for game_id in game_ids}
+        if game_ids:
+            for model in (PlayerInfo, PlayerInfoArchive):
+                rows = db.query(model.game_id, model.civs, model.teams, Player.jid) \
+                    .join(Player, Player.id == model.player_id) \
+                    .filter(model.game_id.in_(game_ids), model.player_id != player.id)
+                for game_id, civ, team, player_jid in rows:
+                    other_players[game_id].append((sleekxmpp.jid.JID(player_jid).local, civ,
+                                                   team))
+
+        return [{'id': game_id, 'map': map_name, 'duration': duration, 'civ': civ, 'team': team,
+                 'result': 'won' if winner_id == player.id else 'lost',
+                 'ratingChange': rating_change, 'players': sorted(other_players[game_id])}
+                for game_id, civ, team, rating_change, map_name, duration, winner_id in results]
+
+    @query_context('get_board')
+    def get_board(self, limit=100, after=None):
         """Return the ratings of the highest ranked players.
 
+        Pages beyond the first one are retrieved by passing the rating
+        and id of the last player of the previous page, so every page
+        can be served by seeking in the index on rating and id,
+        instead of skipping over all players ranked higher.
+
         Arguments:
             limit (int): Number of players to return
+            after (tuple): Rating and id of the player after which to
+                start the returned page, None to start at the top
 
         Returns:
-            dict with player JIDs, nicks and ratings
+            dict with player JIDs, nicks, ratings and ids
+
+        """
+        players = self.read_db.query(Player).filter(Player.rating != -1)
+        if after:
+            rating, player_id = after
+            players = players.filter(or_(Player.rating < rating,
+                                         and_(Player.rating == rating, Player.id > player_id)))
+        players = players.order_by(Player.rating.desc(), Player.id).limit(limit)
+        return self._get_board_entries(players)
+
+    @query_context('get_board_around')
+    def get_board_around(self, jid, limit=100):
+        """Return the page of the leaderboard centered on a player.
+
+        Arguments:
+            jid (sleekxmpp.jid.JID): JID of the player to center the
+                page on
+            limit (int): Number of players to return
+
+        Returns:
+            tuple of the position of the first returned player in the
+            leaderboard and a dict with player JIDs, nicks, ratings
+            and ids. If the player isn't known or doesn't have a
+            rating yet, the position is None and the dict is empty.
+
+        """
+        bare_jid = sleekxmpp.jid.JID(jid).bare
+        db = self._get_session_for(bare_jid)
+        player = db.query(Player).filter(Player.jid.ilike(bare_jid)).first()
+        if not player or player.rating == -1:
+            return None, {}
+
+        rated = db.query(Player).filter(Player.rating != -1)
+        ranked_higher = or_(Player.rating > player.rating,
+                            and_(Player.rating == player.rating, Player.id < player.id))
+        rank = rated.filter(ranked_higher).count()
+
+        before = rated.filter(ranked_higher) \
+            .order_by(Player.rating, Player.id.desc()).limit(limit // 2).all()
+        before.reverse()
+        after = rated.filter(~ranked_higher) \
+            .order_by(Player.rating.desc(), Player.id).limit(limit - len(before))
+        return rank - len(before) + 1, self._get_board_entries(before + after.all())
+
+    @staticmethod
+    def _get_board_entries(players):
+        """Convert players to entries of the leaderboard.
+
+        Arguments:
+            players (iterable): Player objects in leaderboard order
+
+        Returns:
+            dict with player JIDs, nicks, ratings and ids
 
         """
         ratings = {}
-        players = self.db.query(Player).filter(Player.rating != -1) \
-            .order_by(Player.rating.desc()).limit(limit)
         for player in players:
             ratings[player.jid] = {'name': sleekxmpp.jid.JID(player.jid).local,
-                                   'rating': player.rating}
+                                   'rating': player.rating, 'id': player.id}
         return ratings
 
+    @query_context('get_rating_list')
     def get_rating_list(self, nicks):
         """Return the ratings of all online players.
 
@@ -324,7 +926,7 @@ class Leaderboard(object):
         ratings = {}
         if nicks:
             player_filter = func.lower(Player.jid).in_([str(jid).lower() for jid in list(nicks)])
-            players = self.db.query(Player.jid, Player.rating).filter(player_filter)
+            players = self.read_db.query(Player.jid, Player.rating).filter(player_filter)
             for player in players:
                 rating = str(player.rating) if player.rating != -1 else ''
                 for jid in list(nicks):
@@ -349,6 +951,7 @@ class ReportManager(object):
         """
         self.leaderboard = leaderboard
         self.interim_report_tracker = LimitedSizeDict(size_limit=2**12)
+        self.report_mismatches = Counter()
 
     def add_report(self, jid, raw_game_report):
         """Add a game to the interface between a raw report and the leaderboard database.
@@ -370,9 +973,13 @@ class ReportManager(object):
         else:
             current_match = self.interim_report_tracker[match_id]
             if raw_game_report != current_match['report']:
-                report_diff = self._get_report_diff(raw_game_report, current_match['report'])
-                logging.warning("Retrieved reports for match %s differ:\n %s", match_id,
-                                report_diff)
+                fields = self._get_differing_fields(raw_game_report, current_match['report'])
+                report_diff = self._get_report_diff(raw_game_report, current_match['report'],
+                                                    fields)
+                self.report_mismatches.update(
+                    {field if field in REPORT_FIELDS else 'other' for field in fields})
+                logging.warning("Retrieved reports for match %s differ: %s", match_id,
+                                json.dumps(report_diff, sort_keys=True))
                 return
 
             player_jids = current_match['jids']
@@ -448,21 +1055,220 @@ class ReportManager(object):
         raise ValueError()
 
     @staticmethod
-    def _get_report_diff(report1, report2):
+    def _get_differing_fields(report1, report2):
+        """Get the names of the fields differing between two reports.
+
+        Arguments:
+            report1 (dict): Game report
+            report2 (dict): Game report
+
+        Returns:
+            sorted list with the names of the differing fields
+
+        """
+        return [key for key in sorted(set(report1) | set(report2))
+                if report1.get(key) != report2.get(key)]
+
+    @staticmethod
+    def _get_report_diff(report1, report2, fields=None):
         """Get differences between two reports.
 
+        Reports are compared key by key. Values containing
+        player-specific data are split into player slots and only
+        differing slots are included. To keep the result small only
+        the first `REPORT_DIFF_MAX_FIELDS` differing fields are
+        included and long values get truncated.
+
         Arguments:
             report1 (dict): Game report
             report2 (dict): Game report
+            fields (list): Sorted names of the differing fields, if
+                already determined by `_get_differing_fields()`
+
+        Returns:
+            dict with the names of the included differing fields in
+            `fields`, the details of the differences in `diff` and
+            whether fields got omitted in `truncated`
+
+        """
+        def shorten(value):
+            if value is not None and len(value) > REPORT_DIFF_MAX_VALUE_LENGTH:
+                return value[:REPORT_DIFF_MAX_VALUE_LENGTH] + '...'
+            return value
+
+        if fields is None:
+            fields = ReportManager._get_differing_fields(report1, report2)
+
+        diff = {}
+        for key in fields[:REPORT_DIFF_MAX_FIELDS]:
+            value1 = report1.get(key)
+            value2 = report2.get(key)
+            if value1 is not None and value2 is not None and ',' in value1 and ',' in value2:
+                slots1 = value1.split(',')
+                slots2 = value2.split(',')
+                slots = {}
+                for slot in range(max(len(slots1), len(slots2))):
+                    slot1 = slots1[slot] if slot < len(slots1) else None
+                    slot2 = slots2[slot] if slot < len(slots2) else None
+                    if slot1 != slot2:
+                        slots[slot] = [shorten(slot1), shorten(slot2)]
+                diff[key] = slots
+            else:
+                diff[key] = [shorten(value1), shorten(value2)]
+
+        return {'fields': fields[:REPORT_DIFF_MAX_FIELDS], 'diff': diff,
+                'truncated': len(fields) > REPORT_DIFF_MAX_FIELDS}
+
+    def get_report_mismatches(self, limit=None):
+        """Get the fields most often differing between reports.
+
+        Arguments:
+            limit (int): Maximum number of fields to return
+
+        Returns:
+            list of tuples with field name and the number of
+            mismatching reports, sorted by the number of mismatches
+
+        """
+        return self.report_mismatches.most_common(limit)
+
+
+class ProfileCache(object):
+    """Cache for the profile stanzas sent to clients.
+
+    Entries are invalidated when the leaderboard changes the data of
+    a player. As the rank of a player depends on the ratings of all
+    other players, a rating change also invalidates the entries of all
+    players whose rank is affected by it. Changes by other processes
+    sharing the database aren't noticed, so entries also expire after
+    a fixed time.
+    """
+
+    def __init__(self, size_limit=2**10, ttl=PROFILE_CACHE_TTL):
+        """Initialize the profile cache.
+
+        Arguments:
+            size_limit (int): Maximum number of cached profiles
+            ttl (float): Number of seconds after which cached profiles
+                expire
+
+        """
+        self.entries = LimitedSizeDict(size_limit=size_limit)
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(jid):
+        """Get the key to cache the profile of a player with.
+
+        Arguments:
+            jid (sleekxmpp.jid.JID, str): JID of the player
 
         Returns:
-            str with a textual representation of the differences
-                between the two reports
+            str with the lowercase bare JID of the player
 
         """
-        report1_list = ['{ %s: %s }' % (key, value) for key, value in report1.items()]
-        report2_list = ['{ %s: %s }' % (key, value) for key, value in report2.items()]
-        return '\n'.join(difflib.ndiff(report1_list, report2_list))
+        return sleekxmpp.jid.JID(jid).bare.lower()
+
+    def get(self, jid, nick):
+        """Get the cached profile stanza of a player.
+
+        Arguments:
+            jid (sleekxmpp.jid.JID): JID of the player
+            nick (str): Nick of the player, which is part of the
+                cached stanza
+
+        Returns:
+            ProfileXmppPlugin stanza for the player or None if there
+            is no cached profile for it
+
+        """
+        key = self._get_key(jid)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[3] <= time.monotonic():
+                del self.entries[key]
+                entry = None
+            if not entry or entry[0] != nick:
+                self.misses += 1
+                PROFILE_CACHE_REQUESTS.inc(result='miss')
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        PROFILE_CACHE_REQUESTS.inc(result='hit')
+        return entry[2]
+
+    def get_generation(self):
+        """Get the current generation of the cache.
+
+        The generation changes whenever entries get invalidated.
+        Profiles have to be retrieved after getting the generation to
+        be able to cache them.
+
+        Returns:
+            int with the current generation
+
+        """
+        return self.generation
+
+    def put(self, jid, nick, rating, stanza, generation):
+        """Cache the profile stanza of a player.
+
+        The stanza doesn't get cached if entries got invalidated since
+        the given generation, as it might contain outdated data then.
+
+        Arguments:
+            jid (sleekxmpp.jid.JID): JID of the player
+            nick (str): Nick of the player
+            rating (int): Rating of the player, None if the player
+                doesn't have a rank
+            stanza (ProfileXmppPlugin): Stanza to cache, which must
+                not be modified anymore
+            generation (int): Generation of the cache before the
+                profile got retrieved
+
+        """
+        with self.lock:
+            if generation == self.generation:
+                self.entries[self._get_key(jid)] = (nick, rating, stanza,
+                                                    time.monotonic() + self.ttl)
+
+    def invalidate(self, jid, old_rating=None, new_rating=None):
+        """Invalidate cached profiles affected by a change of a player.
+
+        Arguments:
+            jid (str): JID of the changed player
+            old_rating (int): Rating of the player before the change,
+                None if the rating didn't change
+            new_rating (int): Rating of the player after the change
+
+        """
+        key = self._get_key(jid)
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(key, None)
+            if old_rating is None or old_rating == new_rating:
+                return
+
+            # The rank of a player is the number of players with a
+            # rating greater or equal to its own rating.
+            low, high = sorted((old_rating, new_rating))
+            for cached_key, (_, rating, _, _) in list(self.entries.items()):
+                if rating is not None and low < rating <= high:
+                    del self.entries[cached_key]
+
+    def get_hit_rate(self):
+        """Get the ratio of requests served from the cache.
+
+        Returns:
+            float with the ratio of cache hits to all requests
+
+        """
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
 
 
 class EcheLOn(sleekxmpp.ClientXMPP):
@@ -479,10 +1285,15 @@ class EcheLOn(sleekxmpp.ClientXMPP):
 
         self.leaderboard = leaderboard
         self.report_manager = ReportManager(self.leaderboard)
+        self.profile_cache = ProfileCache()
+        self.in_flight = SingleFlight()
+        self.rate_limiters = {}
+        self.leaderboard.write_listeners.append(self.profile_cache.invalidate)
 
         register_stanza_plugin(Iq, BoardListXmppPlugin)
         register_stanza_plugin(Iq, GameReportXmppPlugin)
         register_stanza_plugin(Iq, ProfileXmppPlugin)
+        register_stanza_plugin(Iq, StatsXmppPlugin)
 
         self.register_handler(Callback('Iq Boardlist', StanzaPath('iq@type=get/boardlist'),
                                        self._iq_board_list_handler))
@@ -490,12 +1301,67 @@ class EcheLOn(sleekxmpp.ClientXMPP):
                                        self._iq_game_report_handler))
         self.register_handler(Callback('Iq Profile', StanzaPath('iq@type=get/profile'),
                                        self._iq_profile_handler))
+        self.register_handler(Callback('Iq Stats', StanzaPath('iq@type=get/stats'),
+                                       self._iq_stats_handler))
 
         self.add_event_handler('session_start', self._session_start)
         self.add_event_handler('muc::%s::got_online' % self.room, self._muc_online)
         self.add_event_handler('muc::%s::got_offline' % self.room, self._muc_offline)
         self.add_event_handler('groupchat_message', self._muc_message)
 
+        REGISTRY.gauge('xpartamupp_occupants', "Number of occupants of the MUC room",
+                       callback=lambda: len(self.plugin['xep_0045'].getRoster(self.room) or ()))
+        REGISTRY.gauge('xpartamupp_interim_reports',
+                       "Number of matches with incomplete game reports",
+                       callback=lambda: len(self.report_manager.interim_report_tracker))
+        REGISTRY.gauge('xpartamupp_report_mismatches', "Number of mismatching reports per field",
+                       ('field',), callback=lambda: {
+                           (field,): count
+                           for field, count in self.report_manager.get_report_mismatches()})
+        REGISTRY.gauge('xpartamupp_profile_cache_entries', "Number of cached profiles",
+                       callback=lambda: len(self.profile_cache.entries))
+        REGISTRY.gauge('xpartamupp_profile_cache_hit_ratio',
+                       "Ratio of profile requests served from the cache",
+                       callback=self.profile_cache.get_hit_rate)
+        register_queue_gauges(self)
+
+    def set_rate_limit(self, rate, burst):
+        """Limit the rate of IQ requests per JID.
+
+        Arguments:
+            rate (float): Number of requests per second and handler a
+                JID can send in the long run
+            burst (int): Number of requests per handler a JID can send
+                at once
+
+        """
+        self.rate_limiters = {handler: TokenBucketLimiter(rate, burst)
+                              for handler in ('boardlist', 'gamereport', 'profile', 'stats')}
+
+    def _is_rate_limited(self, handler, iq):
+        """Check whether an IQ request exceeds the rate limit.
+
+        Requests exceeding the rate limit get rejected with a
+        resource-constraint error.
+
+        Arguments:
+            handler (str): Name of the handler the request is for
+            iq (sleekxmpp.stanza.iq.IQ): Received IQ stanza
+
+        Returns:
+            True if the request exceeds the rate limit, False
+            otherwise
+
+        """
+        limiter = self.rate_limiters.get(handler)
+        if not limiter or limiter.allow(iq['from'].bare):
+            return False
+
+        logging.debug("Rate limited %s request from %s", handler, iq['from'])
+        RATE_LIMITED_REQUESTS.inc(handler=handler)
+        self._send_error(iq, 'resource-constraint', 'wait')
+        return True
+
     def _session_start(self, event):  # pylint: disable=unused-argument
         """Join MUC channel and announce presence.
 
@@ -508,6 +1374,7 @@ class EcheLOn(sleekxmpp.ClientXMPP):
         self.get_roster()
         logging.info("EcheLOn started")
 
+    @query_context('muc_online')
     def _muc_online(self, presence):
         """Add joining players to the list of players.
 
@@ -564,6 +1431,7 @@ class EcheLOn(sleekxmpp.ClientXMPP):
                                     "ratings is already difficult enough.",
                               mtype='groupchat')
 
+    @instrument_handler('boardlist')
     def _iq_board_list_handler(self, iq):
         """Handle incoming leaderboard list requests.
 
@@ -574,11 +1442,23 @@ class EcheLOn(sleekxmpp.ClientXMPP):
         if iq['from'].resource not in ['0ad']:
             return
 
+        if self._is_rate_limited('boardlist', iq):
+            return
+
         command = iq['boardlist']['command']
         self.leaderboard.get_or_create_player(iq['from'])
-        if command == 'getleaderboard':
+        if command in ['getleaderboard', 'getleaderboardposition']:
             try:
-                self._send_leaderboard(iq)
+                limit, after = self._parse_board_page(iq)
+            except ValueError:
+                logging.warning("Received invalid leaderboard request from %s", iq['from'].bare)
+                self._send_error(iq, 'bad-request')
+                return
+            try:
+                if command == 'getleaderboardposition':
+                    self._send_leaderboard(iq, limit, around=iq['from'])
+                else:
+                    self._send_leaderboard(iq, limit, after=after)
             except Exception:
                 logging.exception("Failed to process get leaderboard request from %s",
                                   iq['from'].bare)
@@ -588,6 +1468,78 @@ class EcheLOn(sleekxmpp.ClientXMPP):
             except Exception:
                 logging.exception("Failed to send the rating list to %s", iq['from'])
 
+    @staticmethod
+    def _parse_board_page(iq):
+        """Parse the requested page of the leaderboard.
+
+        Arguments:
+            iq (sleekxmpp.stanza.iq.IQ): Received IQ stanza
+
+        Returns:
+            tuple of the page size and the rating and id of the player
+            after which the page starts or None for the first page
+
+        Raises:
+            ValueError: if the page size or cursor is invalid
+
+        """
+        limit = LEADERBOARD_PAGE_SIZE
+        if iq['boardlist']['limit']:
+            limit = int(iq['boardlist']['limit'])
+            if not 0 < limit <= LEADERBOARD_MAX_PAGE_SIZE:
+                raise ValueError("Invalid page size: %s" % limit)
+
+        after = None
+        if iq['boardlist']['cursor']:
+            rating, player_id = iq['boardlist']['cursor'].split(',')
+            after = (int(rating), int(player_id))
+        return limit, after
+
+    @staticmethod
+    def _parse_history_page(iq):
+        """Parse the requested page of the match history of a player.
+
+        The page size is given in `history`, the id of the last game
+        of the previous page in `cursor`.
+
+        Arguments:
+            iq (sleekxmpp.stanza.iq.IQ): Received IQ stanza
+
+        Returns:
+            tuple of the page size and the id of the game before which
+            the page starts or None for the first page
+
+        Raises:
+            ValueError: if the page size or cursor is invalid
+
+        """
+        limit = int(iq['profile']['history'])
+        if not 0 < limit <= MATCH_HISTORY_MAX_PAGE_SIZE:
+            raise ValueError("Invalid page size: %s" % limit)
+
+        before = None
+        if iq['profile']['cursor']:
+            before = int(iq['profile']['cursor'])
+        return limit, before
+
+    def _send_error(self, iq, condition, error_type='modify'):
+        """Reply to an IQ stanza with an error.
+
+        Arguments:
+            iq (sleekxmpp.stanza.iq.IQ): IQ stanza to reply to
+            condition (str): Defined error condition to reply with
+            error_type (str): Type of the error
+
+        """
+        iq = iq.reply(clear=True).error()
+        iq['error']['type'] = error_type
+        iq['error']['condition'] = condition
+        try:
+            iq.send(block=False)
+        except Exception:
+            logging.exception("Failed to send error to %s", iq['to'])
+
+    @instrument_handler('gamereport')
     def _iq_game_report_handler(self, iq):
         """Handle end of game reports from clients.
 
@@ -598,6 +1550,9 @@ class EcheLOn(sleekxmpp.ClientXMPP):
         if iq['from'].resource not in ['0ad']:
             return
 
+        if self._is_rate_limited('gamereport', iq):
+            return
+
         try:
             self.report_manager.add_report(iq['from'], iq['gamereport']['game'])
         except Exception:
@@ -610,9 +1565,13 @@ class EcheLOn(sleekxmpp.ClientXMPP):
                 self.send_message(mto=self.room, mbody=message, mtype='groupchat', mnick=self.nick)
             self._broadcast_rating_list()
 
+    @instrument_handler('profile')
     def _iq_profile_handler(self, iq):
         """Handle profile requests from clients.
 
+        Requests including `history` ask for the match history of the
+        player instead, see `_parse_history_page()`.
+
         Arguments:
             iq (sleekxmpp.stanza.iq.IQ): Received IQ stanza
 
@@ -620,26 +1579,117 @@ class EcheLOn(sleekxmpp.ClientXMPP):
         if iq['from'].resource not in ['0ad']:
             return
 
+        if self._is_rate_limited('profile', iq):
+            return
+
+        if iq['profile']['history']:
+            try:
+                limit, before = self._parse_history_page(iq)
+            except ValueError:
+                logging.warning("Received invalid match history request from %s",
+                                iq['from'].bare)
+                self._send_error(iq, 'bad-request')
+                return
+            try:
+                self._send_match_history(iq, iq['profile']['command'], limit, before)
+            except Exception:
+                logging.exception("Failed to send match history of %s to %s",
+                                  iq['profile']['command'], iq['from'].bare)
+                self._send_error(iq, 'internal-server-error', 'wait')
+            return
+
         try:
             self._send_profile(iq, iq['profile']['command'])
         except Exception:
             logging.exception("Failed to send profile about %s to %s", iq['profile']['command'],
                               iq['from'].bare)
 
-    def _send_leaderboard(self, iq):
-        """Send the whole leaderboard.
+    @instrument_handler('stats')
+    def _iq_stats_handler(self, iq):
+        """Handle civilization statistics requests from clients.
+
+        The `civs` command requests the statistics of all players,
+        optionally limited to the map given in `map`. The `player`
+        command requests the statistics of the player whose nick is
+        given in `player`.
+
+        Arguments:
+            iq (sleekxmpp.stanza.iq.IQ): Received IQ stanza
+
+        """
+        if iq['from'].resource not in ['0ad']:
+            return
+
+        if self._is_rate_limited('stats', iq):
+            return
+
+        command = iq['stats']['command']
+        stanza = StatsXmppPlugin()
+        stanza.add_command(command)
+        try:
+            if command == 'civs':
+                map_name = iq['stats']['map']
+                civ_stats = self.leaderboard.get_civ_stats(map_name or None)
+                if map_name:
+                    stanza['map'] = map_name
+            elif command == 'player':
+                player_nick = iq['stats']['player']
+                civ_stats = self.leaderboard.get_player_civ_stats(
+                    self._get_player_jid(player_nick))
+                stanza['player'] = player_nick
+                if civ_stats:
+                    stanza['favouriteCiv'] = get_favourite_civ(civ_stats)
+            else:
+                logging.info('Received unknown stats command: "%s"', command)
+                self._send_error(iq, 'bad-request')
+                return
+        except Exception:
+            logging.exception("Failed to get civilization statistics for %s", iq['from'].bare)
+            self._send_error(iq, 'internal-server-error', 'wait')
+            return
+
+        stanza.add_items((civ, games, wins) for civ, (games, wins) in sorted(civ_stats.items()))
+        iq = iq.reply(clear=True)
+        iq.set_payload(stanza)
+        try:
+            iq.send(block=False)
+        except Exception:
+            logging.exception("Failed to send civilization statistics to %s", iq['to'])
+
+    def _send_leaderboard(self, iq, limit=LEADERBOARD_PAGE_SIZE, after=None, around=None):
+        """Send a page of the leaderboard.
+
+        If the page is full, the reply includes a cursor, which can be
+        used to request the next page.
 
         Arguments:
             iq (sleekxmpp.stanza.iq.IQ): IQ stanza to reply to
+            limit (int): Number of players to send
+            after (tuple): Rating and id of the player after which to
+                start the page
+            around (sleekxmpp.jid.JID): JID of a player to center the
+                page on. The reply includes the position of the first
+                player of the page, then.
 
         """
-        ratings = self.leaderboard.get_board()
+        position = None
+        if around:
+            position, ratings = self._coalesce(
+                ('board_around', around.bare.lower(), limit),
+                self.leaderboard.get_board_around, around, limit)
+        if not position:
+            ratings = self._coalesce(('board', limit, after), self.leaderboard.get_board, limit,
+                                     after)
 
         iq = iq.reply(clear=True)
         stanza = BoardListXmppPlugin()
         stanza.add_command('boardlist')
-        for player in ratings.values():
-            stanza.add_item(player['name'], player['rating'])
+        stanza.add_items((player['name'], player['rating']) for player in ratings.values())
+        if position:
+            stanza['position'] = str(position)
+        if ratings and len(ratings) == limit:
+            last = list(ratings.values())[-1]
+            stanza['cursor'] = '%i,%i' % (last['rating'], last['id'])
         iq.set_payload(stanza)
 
         try:
@@ -666,8 +1716,7 @@ class EcheLOn(sleekxmpp.ClientXMPP):
         iq = iq.reply(clear=True)
         stanza = BoardListXmppPlugin()
         stanza.add_command('ratinglist')
-        for player in ratings.values():
-            stanza.add_item(player['name'], player['rating'])
+        stanza.add_items((player['name'], player['rating']) for player in ratings.values())
         iq.set_payload(stanza)
 
         try:
@@ -688,16 +1737,18 @@ class EcheLOn(sleekxmpp.ClientXMPP):
 
         stanza = BoardListXmppPlugin()
         stanza.add_command('ratinglist')
-        for player in ratings.values():
-            stanza.add_item(player['name'], player['rating'])
+        stanza.add_items((player['name'], player['rating']) for player in ratings.values())
 
-        for jid in nicks:
-            iq = self.make_iq_result(ito=jid)
-            iq.set_payload(stanza)
-            try:
-                iq.send(block=False)
-            except Exception:
-                logging.exception("Failed to send rating list to %s", jid)
+        with BROADCAST_DURATION.time(broadcast='ratinglist'):
+            for jid in nicks:
+                iq = self.make_iq_result(ito=jid)
+                iq.set_payload(stanza)
+                try:
+                    iq.send(block=False)
+                except Exception:
+                    logging.exception("Failed to send rating list to %s", jid)
+        BROADCAST_RECIPIENTS.observe(len(nicks), broadcast='ratinglist')
+        BROADCAST_ITEMS.observe(len(ratings), broadcast='ratinglist')
 
     def _send_profile(self, iq, player_nick):
         """Send the player profile to a specified target.
@@ -707,22 +1758,114 @@ class EcheLOn(sleekxmpp.ClientXMPP):
             player_nick (str): The nick of the player to get the
                 profile for
 
+        """
+        player_jid = self._get_player_jid(player_nick)
+        stanza = self.profile_cache.get(player_jid, player_nick)
+        if stanza is None:
+            stanza = self._coalesce(('profile', player_jid.bare.lower(), player_nick),
+                                    self._get_profile_stanza, player_jid, player_nick)
+
+        iq = iq.reply(clear=True)
+        iq.set_payload(stanza)
+
+        try:
+            iq.send(block=False)
+        except Exception:
+            logging.exception("Failed to send profile to %s", iq['to'])
+
+    def _send_match_history(self, iq, player_nick, limit, before=None):
+        """Send a page of the match history of a player.
+
+        If the page is full, the reply includes a cursor, which can be
+        used to request the next page.
+
+        Arguments:
+            iq (sleekxmpp.stanza.iq.IQ): IQ stanza to reply to
+            player_nick (str): Nick of the player to get the match
+                history of
+            limit (int): Number of games to send
+            before (int): Id of the game before which to start the
+                page
+
+        """
+        player_jid = self._get_player_jid(player_nick)
+        games = self._coalesce(('match_history', player_jid.bare.lower(), limit, before),
+                               self.leaderboard.get_match_history, player_jid, limit, before)
+
+        stanza = ProfileXmppPlugin()
+        stanza.add_command(player_nick)
+        stanza['history'] = str(limit)
+        stanza.add_games(games)
+        if len(games) == limit:
+            stanza['cursor'] = str(games[-1]['id'])
+
+        iq = iq.reply(clear=True)
+        iq.set_payload(stanza)
+        try:
+            iq.send(block=False)
+        except Exception:
+            logging.exception("Failed to send match history to %s", iq['to'])
+
+    def _get_player_jid(self, player_nick):
+        """Get the JID of a player by nick.
+
+        Arguments:
+            player_nick (str): Nick of the player
+
+        Returns:
+            sleekxmpp.jid.JID of the player
+
         """
         jid_str = self.plugin['xep_0045'].getJidProperty(self.room, player_nick, 'jid')
-        player_jid = sleekxmpp.jid.JID(jid_str) if jid_str else None
+        if jid_str:
+            return sleekxmpp.jid.JID(jid_str)
+
+        # The player is not online, so let's assume the JID contains
+        # the nick as local part.
+        return sleekxmpp.jid.JID('%s@%s/%s' % (player_nick, self.sjid.domain, '0ad'))
+
+    def _coalesce(self, key, function, *args):
+        """Call a function, unless an identical call is in progress.
 
-        # The player the profile got requested for is not online, so
-        # let's assume the JID contains the nick as local part.
-        if not player_jid:
-            player_jid = sleekxmpp.jid.JID('%s@%s/%s' % (player_nick, self.sjid.domain, '0ad'))
+        Concurrent requests for the same data wait for the call in
+        progress and share its result, instead of querying the
+        database again. The result must not be modified.
+
+        Arguments:
+            key (tuple): Key identifying identical calls, the first
+                item is used as label for the metrics
+            function (callable): Function to call
+            args: Arguments to call the function with
 
+        Returns:
+            Result of the function
+
+        """
+        result, shared = self.in_flight.do(key, function, *args)
+        if shared:
+            COALESCED_REQUESTS.inc(request=key[0])
+        return result
+
+    def _get_profile_stanza(self, player_jid, player_nick):
+        """Create the profile stanza for a player.
+
+        Successfully created stanzas get added to the profile cache.
+
+        Arguments:
+            player_jid (sleekxmpp.jid.JID): JID of the player
+            player_nick (str): Nick of the player
+
+        Returns:
+            ProfileXmppPlugin stanza for the player
+
+        """
+        generation = self.profile_cache.get_generation()
         try:
             stats = self.leaderboard.get_profile(player_jid)
         except Exception:
             logging.exception("Failed to get leaderboard profile for player %s", player_jid)
-            stats = {}
+            stats = None
 
-        iq = iq.reply(clear=True)
         stanza = ProfileXmppPlugin()
         if stats:
             stanza.add_item(player_nick, stats['rating'], stats['highestRating'],
@@ -731,12 +1874,11 @@ class EcheLOn(sleekxmpp.ClientXMPP):
         else:
             stanza.add_item(player_nick, -2)
         stanza.add_command(player_nick)
-        iq.set_payload(stanza)
 
-        try:
-            iq.send(block=False)
-        except Exception:
-            logging.exception("Failed to send profile to %s", iq['to'])
+        if stats is not None:
+            self.profile_cache.put(player_jid, player_nick, stats.get('rating'), stanza,
+                                   generation)
+        return stanza
 
 
 def parse_args(args):
@@ -769,6 +1911,49 @@ def parse_args(args):
     parser.add_argument('-r', '--room', help="XMPP MUC room to join", default='arena')
     parser.add_argument('--database-url', help="URL for the leaderboard database",
                         default='sqlite:///lobby_rankings.sqlite3')
+    parser.add_argument('--database-read-url',
+                        help="URL for a read replica of the leaderboard database to run "
+                             "read-only queries against")
+    parser.add_argument('--database-pool-size', type=int,
+                        help="number of database connections to keep open")
+    parser.add_argument('--database-max-overflow', type=int,
+                        help="number of database connections to open in addition to the pool "
+                             "size under load")
+    parser.add_argument('--database-pool-recycle', type=int,
+                        help="time in seconds after which database connections get replaced")
+    parser.add_argument('--database-pool-pre-ping', action='store_true',
+                        help="check database connections for liveness before using them")
+    parser.add_argument('--database-statement-timeout', type=int,
+                        help="time in milliseconds after which SQL statements get aborted, "
+                             "only supported for PostgreSQL")
+    parser.add_argument('--slow-query-threshold', type=float,
+                        help="duration in milliseconds above which SQL statements get logged "
+                             "as slow, disabled if not set")
+    parser.add_argument('--slow-query-log',
+                        help="file to write slow SQL statements to instead of the regular log")
+    parser.add_argument('--query-summary-interval', type=int,
+                        help="interval in seconds in which to log the SQL statements with the "
+                             "highest total execution time, disabled if not set")
+    parser.add_argument('--admin-jid', action='append', dest='admin_jids',
+                        help="JID allowed to trigger diagnostics via ad-hoc commands, can be "
+                             "given multiple times")
+    parser.add_argument('--diagnostics-dir', default='.',
+                        help="directory to write CPU profiles and memory snapshots to")
+    parser.add_argument('--cpu-profile-duration', type=parse_cpu_profile_duration,
+                        default=CPU_PROFILE_DURATION,
+                        help="duration in seconds of CPU profiles triggered by SIGUSR1 and the "
+                             "default for the ad-hoc command")
+    parser.add_argument('--metrics-port', type=int,
+                        help="port to expose metrics on via HTTP, disabled if not set")
+    parser.add_argument('--metrics-address', help="address to expose metrics on",
+                        default='127.0.0.1')
+    parser.add_argument('--rate-limit', type=float,
+                        help="number of requests per second a JID can send per request type in "
+                             "the long run, disabled if not set")
+    parser.add_argument('--rate-limit-burst', type=int, default=10,
+                        help="number of requests a JID can send at once per request type")
+    parser.add_argument('--runtime', choices=('threaded', 'asyncio'), default='threaded',
+                        help="runtime to handle stanzas with, asyncio requires slixmpp")
 
     return parser.parse_args(args)
 
@@ -781,15 +1966,62 @@ def main():
                         format='%(asctime)s %(levelname)-8s %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
 
-    leaderboard = Leaderboard(args.database_url)
-    xmpp = EcheLOn(sleekxmpp.jid.JID('%s@%s/%s' % (args.login, args.domain, 'CC')), args.password,
-                   args.room + '@conference.' + args.domain, args.nickname, leaderboard)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port, args.metrics_address)
+
+    query_profiler = None
+    if args.slow_query_threshold is not None or args.query_summary_interval:
+        slow_query_threshold = None
+        if args.slow_query_threshold is not None:
+            slow_query_threshold = args.slow_query_threshold / 1000
+        query_profiler = QueryProfiler(slow_query_threshold)
+
+    if args.slow_query_log:
+        handler = logging.FileHandler(args.slow_query_log)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s',
+                                               datefmt='%Y-%m-%d %H:%M:%S'))
+        slow_query_logger.addHandler(handler)
+        slow_query_logger.propagate = False
+
+    engine_options, read_engine_options = [
+        get_engine_options(db_url, args.database_pool_size, args.database_max_overflow,
+                           args.database_pool_recycle, args.database_pool_pre_ping,
+                           args.database_statement_timeout) if db_url else None
+        for db_url in (args.database_url, args.database_read_url)]
+    leaderboard = Leaderboard(args.database_url, query_profiler=query_profiler,
+                              engine_options=engine_options,
+                              read_db_url=args.database_read_url,
+                              read_engine_options=read_engine_options)
+    if args.runtime == 'asyncio':
+        # slixmpp is only required for the asyncio runtime
+        from xpartamupp import async_bots  # pylint: disable=import-outside-toplevel
+        bot_class = async_bots.AsyncEcheLOn
+    else:
+        bot_class = EcheLOn
+
+    xmpp = bot_class(sleekxmpp.jid.JID('%s@%s/%s' % (args.login, args.domain, 'CC')),
+                     args.password, args.room + '@conference.' + args.domain, args.nickname,
+                     leaderboard)
     xmpp.register_plugin('xep_0030')  # Service Discovery
     xmpp.register_plugin('xep_0004')  # Data Forms
     xmpp.register_plugin('xep_0045')  # Multi-User Chat
     xmpp.register_plugin('xep_0060')  # Publish-Subscribe
     xmpp.register_plugin('xep_0199', {'keepalive': True})  # XMPP Ping
 
+    if args.rate_limit:
+        xmpp.set_rate_limit(args.rate_limit, args.rate_limit_burst)
+
+    diagnostics = Diagnostics(args.diagnostics_dir,
+                              cpu_profile_duration=args.cpu_profile_duration)
+    diagnostics.install_signal_handlers()
+    if args.admin_jids:
+        xmpp.register_plugin('xep_0050')  # Ad-Hoc Commands
+        diagnostics.register_commands(xmpp, args.admin_jids)
+
+    if query_profiler and args.query_summary_interval:
+        xmpp.schedule('Query summary', args.query_summary_interval, query_profiler.log_summary,
+                      repeat=True)
+
     if xmpp.connect():
         xmpp.process()
     else:
@@ -19,14 +19,53 @@
 """Database schema used by the XMPP bots to store game information."""
 
 import argparse
+import gzip
+import json
 import sys
 
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, create_engine
+from sqlalchemy import (Boolean, Column, ForeignKey, Index, Integer, MetaData, String, Table,
+                        Text, bindparam, case, create_engine, event, func, inspect, select,
+                        text, union_all)
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+# Pragmas applied to every new SQLite connection. WAL mode together
+# with synchronous=NORMAL avoids a full fsync on every commit, while
+# still keeping the database consistent in case of crashes.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 2**28),
+    ('cache_size', -2**16),
+    ('busy_timeout', 5000),
+)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):  # pylint: disable=unused-argument
+    """Apply the SQLite pragmas to a new connection."""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute('PRAGMA %s=%s' % (name, value))
+    finally:
+        cursor.close()
+
+
+def configure_engine(engine):
+    """Apply database specific tuning to an engine.
+
+    For SQLite this enables the write-ahead log and relaxes syncing
+    to disk for every new connection.
+
+    Arguments:
+        engine (sqlalchemy.engine.Engine): Engine to configure
+
+    """
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _set_sqlite_pragmas)
+
 
 class Player(Base):
     """Model representing players."""
@@ -37,12 +76,25 @@ class Player(Base):
     jid = Column(String(255))
     rating = Column(Integer)
     highest_rating = Column(Integer)
+    # Incremented on every update, so concurrent updates of the same
+    # player by multiple EcheLOn processes get detected instead of
+    # silently overwriting each other.
+    version = Column(Integer, nullable=False, default=1)
+    # Number of games whose results got moved to the archive, so the
+    # number of games played stays the same.
+    archived_games = Column(Integer, nullable=False, default=0)
     games = relationship('Game', secondary='players_info')
     # These two relations really only exist to satisfy the linkage
     # between PlayerInfo and Player and Game and player.
     games_info = relationship('PlayerInfo', backref='player')
     games_won = relationship('Game', backref='winner')
 
+    # Matches the order of the leaderboard, so pages of it can be
+    # retrieved by seeking to the last rating and id of the previous
+    # page and ranks can be counted from an index range.
+    __table_args__ = (Index('ix_players_rating_id', rating.desc(), id),)
+    __mapper_args__ = {'version_id_col': version}
+
 
 class PlayerInfo(Base):
     """Model representing game results."""
@@ -51,9 +103,12 @@ class PlayerInfo(Base):
 
     id = Column(Integer, primary_key=True)
     player_id = Column(Integer, ForeignKey('players.id'))
-    game_id = Column(Integer, ForeignKey('games.id'))
+    game_id = Column(Integer, ForeignKey('games.id'), index=True)
     civs = Column(String(20))
     teams = Column(Integer)
+    # Change of the rating of the player caused by the game, None for
+    # unrated games.
+    rating_change = Column(Integer)
     economyScore = Column(Integer)
     militaryScore = Column(Integer)
     totalScore = Column(Integer)
@@ -128,6 +183,40 @@ class PlayerInfo(Base):
     tradeIncome = Column(Integer)
     percentMapExplored = Column(Integer)
 
+    # Serves the match history of players, which is paged by seeking
+    # to the last game id of the previous page.
+    __table_args__ = (Index('ix_players_info_player_id_game_id', player_id, game_id.desc()),)
+
+
+class PlayerInfoArchive(Base):
+    """Model representing archived game results.
+
+    Only the columns needed to find the results of a player are kept
+    as columns, all statistics are stored together as JSON.
+    """
+
+    __tablename__ = 'players_info_archive'
+
+    id = Column(Integer, primary_key=True)
+    player_id = Column(Integer, ForeignKey('players.id'))
+    game_id = Column(Integer, ForeignKey('games.id'), index=True)
+    civs = Column(String(20))
+    teams = Column(Integer)
+    stats = Column(Text)
+
+    __table_args__ = (Index('ix_players_info_archive_player_id_game_id', player_id,
+                            game_id.desc()),)
+
+    def get_stats(self):
+        """Get the statistics of the player in the game.
+
+        Returns:
+            dict with the statistics, statistics which weren't
+            reported are missing
+
+        """
+        return json.loads(self.stats or '{}')
+
 
 class Game(Base):
     """Model representing games."""
@@ -138,12 +227,625 @@ class Game(Base):
     map = Column(String(80))
     duration = Column(Integer)
     teamsLocked = Column(Boolean)
-    matchID = Column(String(20))
-    winner_id = Column(Integer, ForeignKey('players.id'))
+    matchID = Column(String(20), index=True)
+    winner_id = Column(Integer, ForeignKey('players.id'), index=True)
     player_info = relationship('PlayerInfo', backref='game')
     players = relationship('Player', secondary='players_info')
 
 
+class CivStats(Base):
+    """Model representing the results of all players per civilization."""
+
+    __tablename__ = 'civ_stats'
+
+    civ = Column(String(20), primary_key=True)
+    games = Column(Integer, nullable=False, default=0)
+    wins = Column(Integer, nullable=False, default=0)
+
+
+class MapCivStats(Base):
+    """Model representing the results of all players per map and civilization."""
+
+    __tablename__ = 'map_civ_stats'
+
+    map = Column(String(80), primary_key=True)
+    civ = Column(String(20), primary_key=True)
+    games = Column(Integer, nullable=False, default=0)
+    wins = Column(Integer, nullable=False, default=0)
+
+
+class PlayerCivStats(Base):
+    """Model representing the results of a player per civilization."""
+
+    __tablename__ = 'player_civ_stats'
+
+    player_id = Column(Integer, ForeignKey('players.id'), primary_key=True)
+    civ = Column(String(20), primary_key=True)
+    games = Column(Integer, nullable=False, default=0)
+    wins = Column(Integer, nullable=False, default=0)
+
+
+def _make_civ_stats_increment(table, key_columns):
+    """Create a statement adding the result of a player to statistics.
+
+    The statement inserts the row for the key or increments the
+    counters of the existing row atomically, so concurrent games don't
+    conflict. It requires SQLite 3.24 or PostgreSQL 9.5.
+
+    Arguments:
+        table (sqlalchemy.Table): Table of the statistics
+        key_columns (tuple): Names of the primary key columns
+
+    Returns:
+        sqlalchemy.sql.expression.TextClause taking the key columns
+        and `won` as parameters
+
+    """
+    keys = ', '.join(key_columns)
+    return text('INSERT INTO {table} ({keys}, games, wins) VALUES ({values}, 1, :won) '
+                'ON CONFLICT ({keys}) DO UPDATE SET games = {table}.games + 1, '
+                'wins = {table}.wins + excluded.wins'
+                .format(table=table.name, keys=keys,
+                        values=', '.join(':' + column for column in key_columns)))
+
+
+CIV_STATS_INCREMENTS = (
+    _make_civ_stats_increment(CivStats.__table__, ('civ',)),
+    _make_civ_stats_increment(MapCivStats.__table__, ('map', 'civ')),
+    _make_civ_stats_increment(PlayerCivStats.__table__, ('player_id', 'civ')),
+)
+
+
+def add_civ_stats(session, map_name, results):
+    """Add the results of a game to the civilization statistics.
+
+    The statistics get changed within the current transaction of the
+    session, so they're committed together with the game.
+
+    Arguments:
+        session (sqlalchemy.orm.Session): Session to use
+        map_name (str): Name of the map of the game
+        results (list): Tuples of player id, civilization and whether
+            the player won, for every player of the game
+
+    """
+    params = [{'map': map_name, 'player_id': player_id, 'civ': civ, 'won': int(won)}
+              for player_id, civ, won in results if civ]
+    if not params:
+        return
+    for statement in CIV_STATS_INCREMENTS:
+        session.execute(statement, params)
+
+
+class SchemaVersion(Base):
+    """Model storing the version of the schema of the database."""
+
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True)
+
+
+# Indexes on columns used by `get_profile()`, `get_board()` and the
+# relationships between the models, as tuples of name, table and
+# columns.
+HOT_PATH_INDEXES = (
+    ('ix_players_info_player_id', 'players_info', ('player_id',)),
+    ('ix_players_info_game_id', 'players_info', ('game_id',)),
+    ('ix_games_winner_id', 'games', ('winner_id',)),
+    ('ix_games_matchID', 'games', ('matchID',)),
+)
+
+# Indexes serving the match history of players, as tuples of name,
+# table and columns, and the indexes they supersede.
+MATCH_HISTORY_INDEXES = (
+    ('ix_players_info_player_id_game_id', 'players_info', ('player_id', 'game_id DESC')),
+    ('ix_players_info_archive_player_id_game_id', 'players_info_archive',
+     ('player_id', 'game_id DESC')),
+    ('ix_players_info_archive_game_id', 'players_info_archive', ('game_id',)),
+)
+SUPERSEDED_INDEXES = (
+    ('ix_players_info_player_id', 'players_info'),
+    ('ix_players_info_archive_player_id', 'players_info_archive'),
+)
+
+
+def _create_index(connection, name, table, columns):
+    """Create an index unless it exists already.
+
+    Arguments:
+        connection (sqlalchemy.engine.Connection): Connection to use
+        name (str): Name of the index
+        table (str): Name of the table to index
+        columns (iterable): Names of the columns to index, optionally
+            followed by the sort order, e.g. "rating DESC"
+
+    """
+    if name in {index['name'] for index in inspect(connection).get_indexes(table)}:
+        return
+    quote = connection.dialect.identifier_preparer.quote
+    columns = [' '.join([quote(column.split()[0])] + column.split()[1:]) for column in columns]
+    connection.execute('CREATE INDEX %s ON %s (%s)' % (quote(name), quote(table),
+                                                       ', '.join(columns)))
+
+
+def _add_player_versions(connection):
+    """Add the columns and indexes added to players since the baseline.
+
+    Arguments:
+        connection (sqlalchemy.engine.Connection): Connection to use
+
+    """
+    if 'version' not in {column['name'] for column in inspect(connection).get_columns('players')}:
+        connection.execute('ALTER TABLE players ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+    _create_index(connection, 'ix_players_rating_id', 'players', ('rating DESC', 'id'))
+
+
+def _get_migration_metadata():
+    """Get metadata for the tables created by a migration.
+
+    Migrations define the tables they create as of their version
+    instead of using the models, so later changes of the models don't
+    change what they create. The metadata contains the columns of the
+    tables existing since the baseline, which migrations refer to.
+
+    Returns:
+        sqlalchemy.MetaData with the players, games and players_info
+        tables
+
+    """
+    metadata = MetaData()
+    Table('players', metadata, Column('id', Integer, primary_key=True))
+    Table('games', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('map', String(80)),
+          Column('winner_id', Integer, ForeignKey('players.id')))
+    Table('players_info', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('player_id', Integer, ForeignKey('players.id')),
+          Column('game_id', Integer, ForeignKey('games.id')),
+          Column('civs', String(20)))
+    return metadata
+
+
+def _add_player_info_archive(connection):
+    """Add the archive of game results.
+
+    Arguments:
+        connection (sqlalchemy.engine.Connection): Connection to use
+
+    """
+    if 'archived_games' not in {column['name']
+                                for column in inspect(connection).get_columns('players')}:
+        connection.execute('ALTER TABLE players ADD COLUMN archived_games INTEGER NOT NULL '
+                           'DEFAULT 0')
+    archive = Table('players_info_archive', _get_migration_metadata(),
+                    Column('id', Integer, primary_key=True),
+                    Column('player_id', Integer, ForeignKey('players.id'), index=True),
+                    Column('game_id', Integer, ForeignKey('games.id')),
+                    Column('civs', String(20)),
+                    Column('teams', Integer),
+                    Column('stats', Text))
+    archive.create(connection, checkfirst=True)
+
+
+def _add_civ_stats(connection):
+    """Add the civilization statistics computed from all past games.
+
+    Arguments:
+        connection (sqlalchemy.engine.Connection): Connection to use
+
+    """
+    metadata = _get_migration_metadata()
+    archive = Table('players_info_archive', metadata,
+                    Column('id', Integer, primary_key=True),
+                    Column('player_id', Integer, ForeignKey('players.id')),
+                    Column('game_id', Integer, ForeignKey('games.id')),
+                    Column('civs', String(20)))
+    stats_tables = (
+        Table('civ_stats', metadata,
+              Column('civ', String(20), primary_key=True),
+              Column('games', Integer, nullable=False, default=0),
+              Column('wins', Integer, nullable=False, default=0)),
+        Table('map_civ_stats', metadata,
+              Column('map', String(80), primary_key=True),
+              Column('civ', String(20), primary_key=True),
+              Column('games', Integer, nullable=False, default=0),
+              Column('wins', Integer, nullable=False, default=0)),
+        Table('player_civ_stats', metadata,
+              Column('player_id', Integer, ForeignKey('players.id'), primary_key=True),
+              Column('civ', String(20), primary_key=True),
+              Column('games', Integer, nullable=False, default=0),
+              Column('wins', Integer, nullable=False, default=0)),
+    )
+    for stats_table in stats_tables:
+        stats_table.create(connection, checkfirst=True)
+
+    games = metadata.tables['games']
+    results = union_all(*[select([table.c.player_id, table.c.game_id, table.c.civs])
+                          for table in (metadata.tables['players_info'], archive)]) \
+        .alias('results')
+    joined = results.join(games, results.c.game_id == games.c.id)
+    won = func.sum(case([(results.c.player_id == games.c.winner_id, 1)], else_=0))
+
+    for stats_table, key_columns in zip(stats_tables,
+                                        ([results.c.civs],
+                                         [games.c.map, results.c.civs],
+                                         [results.c.player_id, results.c.civs])):
+        query = select(key_columns + [func.count(), won]).select_from(joined) \
+            .where(results.c.civs.isnot(None)).group_by(*key_columns)
+        for column in key_columns[:-1]:
+            query = query.where(column.isnot(None))
+        connection.execute(stats_table.insert().from_select(
+            [column.name for column in stats_table.primary_key.columns] + ['games', 'wins'],
+            query))
+
+
+def create_hot_path_indexes(connection):
+    """Add the indexes in `HOT_PATH_INDEXES`.
+
+    Arguments:
+        connection (sqlalchemy.engine.Connection): Connection to use
+
+    """
+    for name, table, columns in HOT_PATH_INDEXES:
+        _create_index(connection, name, table, columns)
+
+
+def create_match_history_indexes(connection):
+    """Add the indexes in `MATCH_HISTORY_INDEXES`.
+
+    The indexes in `SUPERSEDED_INDEXES` get dropped afterwards, as
+    the new indexes start with the same columns.
+
+    Arguments:
+        connection (sqlalchemy.engine.Connection): Connection to use
+
+    """
+    for name, table, columns in MATCH_HISTORY_INDEXES:
+        _create_index(connection, name, table, columns)
+
+    quote = connection.dialect.identifier_preparer.quote
+    for name, table in SUPERSEDED_INDEXES:
+        if name in {index['name'] for index in inspect(connection).get_indexes(table)}:
+            connection.execute('DROP INDEX %s' % quote(name))
+
+
+def _add_match_history(connection):
+    """Add the rating changes and indexes needed for match histories.
+
+    Arguments:
+        connection (sqlalchemy.engine.Connection): Connection to use
+
+    """
+    if 'rating_change' not in {column['name']
+                               for column in inspect(connection).get_columns('players_info')}:
+        connection.execute('ALTER TABLE players_info ADD COLUMN rating_change INTEGER')
+    create_match_history_indexes(connection)
+
+
+# Migrations applied by `upgrade()` in order, each one to get from the
+# schema version matching its position in this list to the next one.
+# Version 0 is the schema of databases created before migrations
+# existed. Never change existing migrations, only append new ones and
+# keep the models in sync with them. Migrations must not use the models
+# to create tables, as they change with later versions.
+MIGRATIONS = [
+    _add_player_versions,
+    create_hot_path_indexes,
+    _add_player_info_archive,
+    _add_civ_stats,
+    _add_match_history,
+]
+
+
+def get_schema_version(connection):
+    """Get the version of the schema of a database.
+
+    Arguments:
+        connection (sqlalchemy.engine.Connection): Connection to use
+
+    Returns:
+        Version of the schema, 0 for databases created before schema
+        versions got tracked and None for empty databases
+
+    """
+    tables = inspect(connection).get_table_names()
+    if SchemaVersion.__tablename__ not in tables:
+        return 0 if Player.__tablename__ in tables else None
+    return connection.execute(select([func.max(SchemaVersion.version)])).scalar() or 0
+
+
+def stamp_schema_version(connection, version):
+    """Record the version of the schema of a database.
+
+    Arguments:
+        connection (sqlalchemy.engine.Connection): Connection to use
+        version (int): Version of the schema
+
+    """
+    connection.execute(SchemaVersion.__table__.delete())
+    connection.execute(SchemaVersion.__table__.insert(), version=version)
+
+
+def create_schema(engine):
+    """Create all tables of the current schema.
+
+    Only empty databases get marked as having the current schema
+    version, existing tables have to be migrated with `upgrade()`.
+
+    Arguments:
+        engine (sqlalchemy.engine.Engine): Engine of the database
+
+    """
+    with engine.connect() as connection:
+        version = get_schema_version(connection)
+    Base.metadata.create_all(engine)
+    if version is None:
+        with engine.begin() as connection:
+            stamp_schema_version(connection, len(MIGRATIONS))
+
+
+def upgrade(engine):
+    """Upgrade the schema of a database to the current version.
+
+    Every migration gets applied in its own transaction together with
+    recording the new version, so an interrupted upgrade can be
+    resumed. Empty databases get the current schema created instead.
+
+    Arguments:
+        engine (sqlalchemy.engine.Engine): Engine of the database
+
+    Returns:
+        list of the versions the database got upgraded to
+
+    """
+    with engine.connect() as connection:
+        version = get_schema_version(connection)
+    if version is None:
+        create_schema(engine)
+        return [len(MIGRATIONS)]
+
+    SchemaVersion.__table__.create(engine, checkfirst=True)
+    applied = []
+    for version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with engine.begin() as connection:
+            migration(connection)
+            stamp_schema_version(connection, version)
+        applied.append(version)
+    return applied
+
+
+# Identifies files written by `export_database()`, so other files get
+# rejected on import. Increment the version on incompatible changes of
+# the format.
+EXPORT_FORMAT = 'lobby-rankings'
+EXPORT_FORMAT_VERSION = 1
+
+# Number of rows fetched from and inserted into the database at once
+# during export and import.
+EXPORT_CHUNK_SIZE = 10000
+
+
+def _export_tables():
+    """Get the tables to export in an order satisfying foreign keys.
+
+    Returns:
+        list of sqlalchemy.Table
+
+    """
+    return [Player.__table__, Game.__table__, PlayerInfo.__table__, PlayerInfoArchive.__table__,
+            CivStats.__table__, MapCivStats.__table__, PlayerCivStats.__table__]
+
+
+def export_database(engine, path, chunk_size=EXPORT_CHUNK_SIZE):
+    """Export all tables of the database to a file.
+
+    The file is a gzip-compressed sequence of JSON lines. The first
+    line describes the format, followed by a header line with the name
+    and columns of each table and a line per row of that table.
+
+    Rows get streamed from the database using server-side cursors
+    where supported, so memory use doesn't depend on the size of the
+    database. All tables are read in a single transaction, which on
+    PostgreSQL uses repeatable read isolation to get a consistent
+    snapshot while the bots keep writing.
+
+    Arguments:
+        engine (sqlalchemy.engine.Engine): Engine of the database to
+            export
+        path (str): Path of the file to write
+        chunk_size (int): Number of rows to fetch at once
+
+    Returns:
+        dict with the number of exported rows per table
+
+    """
+    counts = {}
+    with engine.connect() as connection:
+        if engine.dialect.name == 'postgresql':
+            connection = connection.execution_options(isolation_level='REPEATABLE READ')
+        with connection.begin(), gzip.open(path, 'wt', encoding='utf-8') as export_file:
+            export_file.write(json.dumps({'format': EXPORT_FORMAT,
+                                          'version': EXPORT_FORMAT_VERSION}) + '\n')
+            for table in _export_tables():
+                columns = [column.name for column in table.columns]
+                export_file.write(json.dumps({'table': table.name, 'columns': columns}) + '\n')
+                result = connection.execution_options(stream_results=True).execute(
+                    select([table]).order_by(*table.primary_key.columns))
+                counts[table.name] = 0
+                while True:
+                    rows = result.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    export_file.writelines(json.dumps(list(row)) + '\n' for row in rows)
+                    counts[table.name] += len(rows)
+    return counts
+
+
+def _read_export(export_file, chunk_size):
+    """Read chunks of rows from an exported file.
+
+    Arguments:
+        export_file (file): Opened file written by `export_database()`
+        chunk_size (int): Maximum number of rows per chunk
+
+    Yields:
+        tuples of the table name and a list of dicts with the values
+        of the rows
+
+    Raises:
+        ValueError: if the file isn't a valid export
+
+    """
+    header = json.loads(export_file.readline() or '{}')
+    if header.get('format') != EXPORT_FORMAT or header.get('version') != EXPORT_FORMAT_VERSION:
+        raise ValueError("Unsupported export format: %s" % header)
+
+    table = None
+    columns = None
+    rows = []
+    for line in export_file:
+        values = json.loads(line)
+        if isinstance(values, dict):
+            if rows:
+                yield table, rows
+                rows = []
+            table = values['table']
+            columns = values['columns']
+            continue
+        if columns is None:
+            raise ValueError("Row without table header in export")
+        rows.append(dict(zip(columns, values)))
+        if len(rows) >= chunk_size:
+            yield table, rows
+            rows = []
+    if rows:
+        yield table, rows
+
+
+def import_database(engine, path, chunk_size=EXPORT_CHUNK_SIZE):
+    """Import a file written by `export_database()` into a database.
+
+    Missing tables get created. The tables must be empty, as the rows
+    keep their ids. Rows are inserted in chunks with a single
+    statement each, all within one transaction, so either the whole
+    file gets imported or nothing.
+
+    Arguments:
+        engine (sqlalchemy.engine.Engine): Engine of the database to
+            import into
+        path (str): Path of the file to read
+        chunk_size (int): Number of rows to insert at once
+
+    Returns:
+        dict with the number of imported rows per table
+
+    Raises:
+        ValueError: if the file isn't a valid export or the tables
+            aren't empty
+
+    """
+    create_schema(engine)
+    tables = {table.name: table for table in _export_tables()}
+    counts = dict.fromkeys(tables, 0)
+    with engine.begin() as connection, gzip.open(path, 'rt', encoding='utf-8') as export_file:
+        for table in tables.values():
+            if connection.execute(select([func.count()]).select_from(table)).scalar():
+                raise ValueError("Table %s isn't empty" % table.name)
+
+        for table_name, rows in _read_export(export_file, chunk_size):
+            if table_name not in tables:
+                raise ValueError("Unknown table in export: %s" % table_name)
+            connection.execute(tables[table_name].insert(), rows)
+            counts[table_name] += len(rows)
+
+        if engine.dialect.name == 'postgresql':
+            # Explicitly inserted ids don't advance the sequences
+            # used for new rows.
+            for table in tables.values():
+                if 'id' not in table.c:
+                    continue
+                connection.execute(text("SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                                        "COALESCE(MAX(id), 0) + 1, false) FROM %s" % table.name),
+                                   table=table.name)
+    return counts
+
+
+# Number of most recent games whose results don't get archived by
+# default.
+ARCHIVE_KEEP_GAMES = 100000
+
+# Columns of `PlayerInfo` which are kept as columns when archiving,
+# all others get stored as JSON.
+ARCHIVE_COLUMNS = ('id', 'player_id', 'game_id', 'civs', 'teams')
+
+
+def archive_player_info(engine, keep_games=ARCHIVE_KEEP_GAMES, batch_size=EXPORT_CHUNK_SIZE):
+    """Move the results of old games to the archive.
+
+    Results of all games except the most recent ones get moved from
+    `players_info` to `players_info_archive`. Each batch gets moved in
+    its own transaction, which also increments the number of archived
+    games of the affected players, so the number of games played and
+    thereby ratings and profiles stay the same. The games themselves
+    are kept.
+
+    Arguments:
+        engine (sqlalchemy.engine.Engine): Engine of the database
+        keep_games (int): Number of most recent games to keep the
+            results of
+        batch_size (int): Number of results to move per transaction
+
+    Returns:
+        Number of archived results
+
+    """
+    games = Game.__table__
+    player_info = PlayerInfo.__table__
+    players = Player.__table__
+    stats_columns = [column for column in player_info.columns
+                     if column.name not in ARCHIVE_COLUMNS]
+
+    with engine.connect() as connection:
+        cutoff = connection.execute(select([games.c.id]).order_by(games.c.id.desc())
+                                    .offset(keep_games).limit(1)).scalar()
+    if cutoff is None:
+        return 0
+
+    update_players = players.update() \
+        .where(players.c.id == bindparam('player_id')) \
+        .values(archived_games=players.c.archived_games + bindparam('archived'),
+                version=players.c.version + 1)
+
+    archived = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(select([player_info])
+                                      .where(player_info.c.game_id <= cutoff)
+                                      .order_by(player_info.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+
+            connection.execute(PlayerInfoArchive.__table__.insert(), [
+                dict({name: row[name] for name in ARCHIVE_COLUMNS},
+                     stats=json.dumps({column.name: row[column] for column in stats_columns
+                                       if row[column] is not None}, separators=(',', ':')))
+                for row in rows])
+
+            archived_per_player = {}
+            for row in rows:
+                archived_per_player[row.player_id] = archived_per_player.get(row.player_id, 0) + 1
+            connection.execute(update_players,
+                               [{'player_id': player_id, 'archived': count}
+                                for player_id, count in archived_per_player.items()
+                                if player_id is not None])
+
+            connection.execute(player_info.delete().where(
+                player_info.c.id.in_([row.id for row in rows])))
+        archived += len(rows)
+    return archived
+
+
 def parse_args(args):
     """Parse command line arguments.
 
@@ -157,9 +859,15 @@ def parse_args(args):
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                      description="Helper command for database creation")
     parser.add_argument('action', help='Action to apply to the database',
-                        choices=['create'])
+                        choices=['create', 'upgrade', 'export', 'import', 'archive'])
     parser.add_argument('--database-url', help='URL for the leaderboard database',
                         default='sqlite:///lobby_rankings.sqlite3')
+    parser.add_argument('--file', help='file to export the database to or import it from',
+                        default='lobby_rankings.jsonl.gz')
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                        help='number of rows to fetch, insert or archive at once')
+    parser.add_argument('--keep-games', type=int, default=ARCHIVE_KEEP_GAMES,
+                        help='number of most recent games to keep the results of')
     return parser.parse_args(args)
 
 
@@ -167,8 +875,20 @@ def main():
     """Entry point a console script."""
     args = parse_args(sys.argv[1:])
     engine = create_engine(args.database_url)
+    configure_engine(engine)
     if args.action == 'create':
-        Base.metadata.create_all(engine)
+        create_schema(engine)
+    elif args.action == 'upgrade':
+        upgrade(engine)
+    elif args.action == 'export':
+        export_database(engine, args.file, args.chunk_size)
+    elif args.action == 'import':
+        try:
+            import_database(engine, args.file, args.chunk_size)
+        except ValueError as exc:
+            sys.exit("Import failed: %s" % exc)
+    elif args.action == 'archive':
+        archive_player_info(engine, args.keep_games, args.chunk_size)
 
 
 if __name__ == '__main__':
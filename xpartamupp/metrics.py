@@ -0,0 +1,487 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Collection and exposition of metrics of the XMPP-bots.
+
+Metrics are kept in a registry and can be exposed in the Prometheus
+text format by a small HTTP server, which only uses the standard
+library.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from sqlalchemy import event
+
+from xpartamupp.query_log import query_context
+
+# Default buckets for histograms measuring durations in seconds.
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                    10)
+
+# Default buckets for histograms measuring sizes of broadcasts.
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def _escape_label_value(value):
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    """Format labels for the Prometheus text format.
+
+    Arguments:
+        labels (tuple): Tuples of label names and values
+
+    Returns:
+        str with the formatted labels or an empty string if there
+        are no labels
+
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape_label_value(value))
+                             for name, value in labels)
+
+
+def _format_value(value):
+    """Format a sample value for the Prometheus text format."""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric(object):
+    """Base class for metrics with optional labels."""
+
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        """Initialize the metric.
+
+        Arguments:
+            name (str): Name of the metric
+            documentation (str): Description of the metric
+            labelnames (tuple): Names of the labels of the metric
+
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        """Get the key for the values of a label combination."""
+        if set(labels) != set(self.labelnames):
+            raise ValueError("Metric %s requires the labels %s, got %s" %
+                             (self.name, self.labelnames, tuple(labels)))
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """Get the samples of the metric.
+
+        Returns:
+            list of tuples with sample name suffix, labels and value
+
+        """
+        with self._lock:
+            return [('', key, value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        """Render the metric in the Prometheus text format.
+
+        Returns:
+            list with the lines of the rendered metric
+
+        """
+        lines = ['# HELP %s %s' % (self.name, self.documentation.replace('\n', ' ')),
+                 '# TYPE %s %s' % (self.name, self.metric_type)]
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, _format_labels(labels),
+                                        _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """Metric which only ever increases."""
+
+    metric_type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        """Initialize the counter.
+
+        Arguments:
+            name (str): Name of the metric
+            documentation (str): Description of the metric
+            labelnames (tuple): Names of the labels of the metric
+
+        """
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter.
+
+        Arguments:
+            amount (float): Value to add to the counter
+            labels: Values of the labels of the counter
+
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Metric with a value which can go up and down.
+
+    Instead of setting values explicitly, a callback can be given,
+    which gets called to determine the value whenever the metric gets
+    rendered. The callback has to return a number for gauges without
+    labels or a dict with tuples of label values as keys for gauges
+    with labels.
+    """
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        """Initialize the gauge.
+
+        Arguments:
+            name (str): Name of the metric
+            documentation (str): Description of the metric
+            labelnames (tuple): Names of the labels of the metric
+            callback (callable): Function returning the current value
+
+        """
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        """Set the value of the gauge.
+
+        Arguments:
+            value (float): New value of the gauge
+            labels: Values of the labels of the gauge
+
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        """Get the samples of the gauge, calling the callback if set."""
+        if not self.callback:
+            return super().samples()
+
+        try:
+            values = self.callback()
+        except Exception:
+            logging.exception("Failed to get value for metric %s", self.name)
+            return []
+
+        if not self.labelnames:
+            return [('', (), values)]
+        return [('', tuple(zip(self.labelnames, label_values)), value)
+                for label_values, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """Metric counting observations in configurable buckets."""
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        """Initialize the histogram.
+
+        Arguments:
+            name (str): Name of the metric
+            documentation (str): Description of the metric
+            labelnames (tuple): Names of the labels of the metric
+            buckets (tuple): Upper bounds of the buckets
+
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        if not self.labelnames:
+            self._values[()] = ([0] * len(self.buckets), 0)
+
+    def observe(self, value, **labels):
+        """Record an observation.
+
+        Arguments:
+            value (float): Observed value
+            labels: Values of the labels of the histogram
+
+        """
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a block of code in seconds.
+
+        Arguments:
+            labels: Values of the labels of the histogram
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        """Get the bucket, sum and count samples of the histogram."""
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+
+        samples = []
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(('_bucket', labels + (('le', _format_value(float(bound))),),
+                                cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+class Registry(object):
+    """Collection of all metrics of a process."""
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, metric_class, name, *args, **kwargs):
+        """Get a metric by name or create it if it doesn't exist yet."""
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, *args, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_class):
+                raise ValueError("Metric %s already exists with a different type" % name)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """Get or create a counter.
+
+        Arguments:
+            name (str): Name of the metric
+            documentation (str): Description of the metric
+            labelnames (tuple): Names of the labels of the metric
+
+        Returns:
+            Counter with the given name
+
+        """
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        """Get or create a gauge.
+
+        If the gauge already exists and a callback is given, the
+        callback of the existing gauge gets replaced.
+
+        Arguments:
+            name (str): Name of the metric
+            documentation (str): Description of the metric
+            labelnames (tuple): Names of the labels of the metric
+            callback (callable): Function returning the current value
+
+        Returns:
+            Gauge with the given name
+
+        """
+        gauge = self._get_or_create(Gauge, name, documentation, labelnames)
+        if callback is not None:
+            gauge.callback = callback
+        return gauge
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        """Get or create a histogram.
+
+        Arguments:
+            name (str): Name of the metric
+            documentation (str): Description of the metric
+            labelnames (tuple): Names of the labels of the metric
+            buckets (tuple): Upper bounds of the buckets
+
+        Returns:
+            Histogram with the given name
+
+        """
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self):
+        """Render all metrics in the Prometheus text format.
+
+        Returns:
+            str with all metrics
+
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+IQ_REQUESTS = REGISTRY.counter('xpartamupp_iq_requests_total', "Number of handled IQ stanzas",
+                               ('handler',))
+RATE_LIMITED_REQUESTS = REGISTRY.counter('xpartamupp_rate_limited_requests_total',
+                                         "Number of IQ stanzas rejected due to rate limiting",
+                                         ('handler',))
+IQ_DURATION = REGISTRY.histogram('xpartamupp_iq_handler_duration_seconds',
+                                 "Time spent handling IQ stanzas", ('handler',))
+BROADCAST_DURATION = REGISTRY.histogram('xpartamupp_broadcast_duration_seconds',
+                                        "Time spent broadcasting stanzas", ('broadcast',))
+BROADCAST_RECIPIENTS = REGISTRY.histogram('xpartamupp_broadcast_recipients',
+                                          "Number of recipients of broadcasts", ('broadcast',),
+                                          SIZE_BUCKETS)
+BROADCAST_ITEMS = REGISTRY.histogram('xpartamupp_broadcast_items',
+                                     "Number of items contained in broadcasts", ('broadcast',),
+                                     SIZE_BUCKETS)
+DB_QUERIES = REGISTRY.counter('xpartamupp_db_queries_total', "Number of executed SQL statements")
+DB_QUERY_DURATION = REGISTRY.histogram('xpartamupp_db_query_duration_seconds',
+                                       "Time spent executing SQL statements")
+
+
+def instrument_handler(handler_name):
+    """Count calls and measure the duration of an IQ handler.
+
+    SQL statements executed by the handler get attributed to it.
+
+    Arguments:
+        handler_name (str): Name of the handler used as label
+
+    Returns:
+        Decorator for the handler
+
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            IQ_REQUESTS.inc(handler=handler_name)
+            with IQ_DURATION.time(handler=handler_name), query_context(handler_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def register_queue_gauges(xmpp):
+    """Expose the depths of the queues of an XMPP client.
+
+    Arguments:
+        xmpp (sleekxmpp.ClientXMPP): XMPP client to expose the queue
+            depths of
+
+    """
+    REGISTRY.gauge('xpartamupp_queue_depth', "Number of items waiting in internal queues",
+                   ('queue',), callback=lambda: {('send',): xmpp.send_queue.qsize(),
+                                                 ('event',): xmpp.event_queue.qsize()})
+
+
+def instrument_engine(engine):
+    """Count and measure the duration of SQL statements of an engine.
+
+    Arguments:
+        engine (sqlalchemy.engine.Engine): Engine to instrument
+
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement,  # pylint: disable=unused-variable
+                              parameters, context, executemany):  # pylint: disable=unused-argument
+        context.query_start_time = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement,  # pylint: disable=unused-variable
+                             parameters, context, executemany):  # pylint: disable=unused-argument
+        DB_QUERIES.inc()
+        DB_QUERY_DURATION.observe(time.perf_counter() - context.query_start_time)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Request handler serving the metrics of a registry."""
+
+    registry = REGISTRY
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve the metrics."""
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Log requests only in debug mode."""
+        logging.debug("Metrics request from %s: %s", self.address_string(), format % args)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in a separate thread."""
+
+    daemon_threads = True
+
+
+def start_metrics_server(port, address='127.0.0.1', registry=REGISTRY):
+    """Start an HTTP server exposing metrics in a background thread.
+
+    Arguments:
+        port (int): Port to listen on
+        address (str): Address to listen on
+        registry (Registry): Registry with the metrics to expose
+
+    Returns:
+        HTTP server serving the metrics
+
+    """
+    handler = type('MetricsRequestHandler', (_MetricsRequestHandler,), {'registry': registry})
+    server = _ThreadingHTTPServer((address, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    logging.info("Serving metrics on http://%s:%s/metrics", address, server.server_port)
+    return server
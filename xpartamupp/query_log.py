@@ -0,0 +1,296 @@
+# Copyright (C) 2018 Wildfire Games.
+# This file is part of 0 A.D.
+#
+# 0 A.D. is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# 0 A.D. is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Instrumentation of SQL statements executed by the XMPP-bots.
+
+Every statement executed through an instrumented engine gets
+attributed to the code which caused it, e.g. the IQ handler and the
+`Leaderboard` method. Counts and durations are aggregated per
+statement and caller, statements slower than a threshold are written
+to a slow-query log together with their query plan, if the database
+supports it.
+"""
+
+import heapq
+import logging
+import re
+import threading
+import time
+from contextlib import ContextDecorator
+
+from sqlalchemy import event
+
+# Logger for slow statements, so they can be written to a separate
+# file.
+slow_query_logger = logging.getLogger('xpartamupp.slow_queries')
+
+# Prefixes to get the query plan of a statement per SQL dialect.
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+_context = threading.local()
+
+# A bind parameter in any of the parameter styles of the supported
+# database drivers.
+_BIND_PARAMETER = r'(?:\?|%s|%\(\w+\)s|:\w+|\$\d+)'
+
+# Lists of bind parameters of `IN` operators and multi-row `VALUES`
+# clauses, whose length depends on the data.
+_BIND_LIST = r'\(\s*%s(?:\s*,\s*%s)*\s*\)' % (_BIND_PARAMETER, _BIND_PARAMETER)
+_VARIABLE_LISTS = re.compile(r'\b(IN|VALUES)\s*%s(?:\s*,\s*%s)*' % (_BIND_LIST, _BIND_LIST),
+                             re.IGNORECASE)
+
+
+def normalize_statement(statement):
+    """Normalize a statement to aggregate statistics of variants of it.
+
+    Lists of bind parameters get collapsed, so e.g. statements
+    differing only in the number of values passed to an `IN`
+    operator are aggregated together.
+
+    Arguments:
+        statement (str): Statement to normalize
+
+    Returns:
+        str with the normalized statement
+
+    """
+    return _VARIABLE_LISTS.sub(r'\1 (...)', statement)
+
+
+class query_context(ContextDecorator):  # pylint: disable=invalid-name
+    """Attribute SQL statements to a caller.
+
+    Can be used as decorator or as context manager. Contexts can be
+    nested, statements get attributed to all active contexts of the
+    current thread.
+    """
+
+    def __init__(self, name):
+        """Initialize the context.
+
+        Arguments:
+            name (str): Name of the caller
+
+        """
+        self.name = name
+
+    def __enter__(self):
+        """Add the context to the contexts of the current thread."""
+        if not hasattr(_context, 'stack'):
+            _context.stack = []
+        _context.stack.append(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        """Remove the context from the contexts of the current thread."""
+        _context.stack.pop()
+        return False
+
+
+def get_current_context():
+    """Get the callers active in the current thread.
+
+    Returns:
+        str with the names of the active callers, outermost first
+
+    """
+    stack = getattr(_context, 'stack', None)
+    return '/'.join(stack) if stack else 'unknown'
+
+
+class QueryProfiler(object):
+    """Aggregates statistics about executed SQL statements."""
+
+    def __init__(self, slow_query_threshold=None, explain=True, max_statements=2**10):
+        """Initialize the profiler.
+
+        Arguments:
+            slow_query_threshold (float): Duration in seconds above
+                which statements get logged as slow, disabled if None
+            explain (bool): Whether to log the query plan of slow
+                statements
+            max_statements (int): Maximum number of distinct
+                statements to keep statistics for. Once reached, the
+                statistics of the statement with the lowest total
+                execution time get dropped for a new statement.
+
+        """
+        self.slow_query_threshold = slow_query_threshold
+        self.explain = explain
+        self.max_statements = max_statements
+        self._lock = threading.Lock()
+        self.statistics = {}
+        # Heap of the total durations of the statements when they got
+        # pushed and their keys, to find the statement to evict. The
+        # totals only grow, so outdated entries get pushed again with
+        # their current total when they get to the top.
+        self._eviction_heap = []
+
+    def instrument(self, engine):
+        """Record statistics for all statements executed by an engine.
+
+        Arguments:
+            engine (sqlalchemy.engine.Engine): Engine to instrument
+
+        """
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        """Remember when the execution of a statement started."""
+        # pylint: disable=too-many-arguments,unused-argument
+        context.profiler_start_time = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        """Record the duration of an executed statement."""
+        # pylint: disable=too-many-arguments,unused-argument
+        duration = time.perf_counter() - context.profiler_start_time
+        caller = get_current_context()
+        self.record(caller, statement, duration)
+
+        if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+            plan = None
+            if self.explain and not executemany:
+                plan = self._get_query_plan(conn, statement, parameters)
+            slow_query_logger.warning("Slow query (%.1f ms) from %s: %s; parameters: %s%s",
+                                      duration * 1000, caller, statement, parameters,
+                                      '\nQuery plan:\n%s' % plan if plan else '')
+
+    def record(self, caller, statement, duration):
+        """Record the execution of a statement.
+
+        Arguments:
+            caller (str): Caller which executed the statement
+            statement (str): Executed statement, which gets normalized
+                using `normalize_statement()`
+            duration (float): Execution time in seconds
+
+        """
+        key = (caller, normalize_statement(statement))
+        with self._lock:
+            statistics = self.statistics.get(key)
+            if statistics is None:
+                if len(self.statistics) >= self.max_statements:
+                    self._evict()
+                self.statistics[key] = [1, duration, duration]
+                heapq.heappush(self._eviction_heap, (duration, key))
+            else:
+                statistics[0] += 1
+                statistics[1] += duration
+                statistics[2] = max(statistics[2], duration)
+
+    def _evict(self):
+        """Drop the statistics of the statement with the lowest total time.
+
+        Has to be called with the lock held.
+        """
+        while True:
+            total, key = heapq.heappop(self._eviction_heap)
+            current_total = self.statistics[key][1]
+            if current_total == total:
+                del self.statistics[key]
+                return
+            heapq.heappush(self._eviction_heap, (current_total, key))
+
+    @staticmethod
+    def _get_query_plan(conn, statement, parameters):
+        """Get the query plan of a statement.
+
+        The statement gets explained on the connection it got executed
+        on, which might be in the middle of a transaction. Except for
+        SQLite, a failing statement aborts the transaction, so the
+        query plan gets retrieved within a savepoint there.
+
+        Arguments:
+            conn (sqlalchemy.engine.Connection): Connection the
+                statement got executed on
+            statement (str): Executed statement
+            parameters: Parameters of the statement
+
+        Returns:
+            str with the query plan or None if it couldn't be
+            determined
+
+        """
+        prefix = EXPLAIN_PREFIXES.get(conn.dialect.name)
+        if not prefix or not statement.lstrip().upper().startswith('SELECT'):
+            return None
+
+        savepoint = conn.dialect.name != 'sqlite'
+        try:
+            cursor = conn.connection.cursor()
+            try:
+                if savepoint:
+                    cursor.execute('SAVEPOINT query_plan')
+                try:
+                    cursor.execute(prefix + statement, parameters)
+                    rows = cursor.fetchall()
+                except Exception:
+                    if savepoint:
+                        cursor.execute('ROLLBACK TO SAVEPOINT query_plan')
+                    raise
+                finally:
+                    if savepoint:
+                        cursor.execute('RELEASE SAVEPOINT query_plan')
+            finally:
+                cursor.close()
+        except Exception:
+            logging.warning("Failed to get query plan for: %s", statement, exc_info=True)
+            return None
+        return '\n'.join(' '.join(str(column) for column in row) for row in rows)
+
+    def get_top_queries(self, limit=10):
+        """Get the statements with the highest total execution time.
+
+        Arguments:
+            limit (int): Maximum number of statements to return
+
+        Returns:
+            list of dicts with caller, statement, number of
+            executions, total, mean and maximum duration in seconds
+
+        """
+        with self._lock:
+            items = [(caller, statement, count, total, maximum)
+                     for (caller, statement), (count, total, maximum)
+                     in self.statistics.items()]
+        items.sort(key=lambda item: item[3], reverse=True)
+        return [{'caller': caller, 'statement': statement, 'count': count, 'total': total,
+                 'mean': total / count, 'max': maximum}
+                for caller, statement, count, total, maximum in items[:limit]]
+
+    def log_summary(self, limit=10):
+        """Log the statements with the highest total execution time.
+
+        Arguments:
+            limit (int): Maximum number of statements to log
+
+        """
+        top_queries = self.get_top_queries(limit)
+        if not top_queries:
+            return
+
+        lines = ['%8.1f ms total, %6i calls, %7.2f ms mean, %7.2f ms max, %s: %s' %
+                 (query['total'] * 1000, query['count'], query['mean'] * 1000,
+                  query['max'] * 1000, query['caller'], ' '.join(query['statement'].split()))
+                 for query in top_queries]
+        logging.info("Top %i queries by total time:\n%s", len(lines), '\n'.join(lines))
@@ -14,17 +14,90 @@
 # You should have received a copy of the GNU General Public License
 # along with 0 A.D.  If not, see <http://www.gnu.org/licenses/>.
 
-"""0ad-specific XMPP-stanzas."""
+"""0ad-specific XMPP-stanzas.
+
+The stanza extensions are defined independently of the XMPP library
+in use, so they can be shared between the threaded bots built on
+sleekxmpp and the asyncio-based bots built on slixmpp. The
+`*XmppPlugin` classes bind them to sleekxmpp.
+"""
+
+from copy import deepcopy
 
 from sleekxmpp.xmlstream import ElementBase, ET
 
 
-class BoardListXmppPlugin(ElementBase):
-    """Class for custom boardlist and ratinglist stanza extension."""
+class ElementTemplate(object):
+    """Template for XML elements with a fixed set of attributes.
+
+    Building elements from a template avoids constructing an
+    attribute dictionary by hand for every single element and
+    ensures all values get converted to strings.
+    """
+
+    __slots__ = ('tag', 'attributes')
+
+    def __init__(self, tag, attributes=()):
+        """Initialize the template.
+
+        Arguments:
+            tag (str): Tag of the elements to create
+            attributes (tuple): Names of the attributes of the
+                elements to create, in the order values get passed to
+                `make()`
+
+        """
+        self.tag = tag
+        self.attributes = tuple(attributes)
+
+    def make(self, *values):
+        """Create a new element from the template.
+
+        Arguments:
+            values: Values for the attributes of the template, in the
+                order of the template attributes
+
+        Returns:
+            xml.etree.ElementTree.Element with the given attribute
+            values
+
+        """
+        return ET.Element(self.tag, dict(zip(self.attributes, map(str, values))))
+
+
+def make_text_element(tag, text):
+    """Create an element containing only text.
+
+    Arguments:
+        tag (str): Tag of the element
+        text (str): Text of the element, which gets escaped when
+            serialized
+
+    Returns:
+        xml.etree.ElementTree.Element containing the text
+
+    """
+    element = ET.Element(tag)
+    element.text = text
+    return element
+
+
+BOARD_TEMPLATE = ElementTemplate('{jabber:iq:boardlist}board', ('name', 'rating'))
+PROFILE_TEMPLATE = ElementTemplate('{jabber:iq:profile}profile',
+                                   ('player', 'rating', 'highestRating', 'rank',
+                                    'totalGamesPlayed', 'wins', 'losses'))
+CIV_STATS_TEMPLATE = ElementTemplate('{jabber:iq:stats}civ', ('name', 'games', 'wins'))
+MATCH_TEMPLATE = ElementTemplate('{jabber:iq:profile}game',
+                                 ('id', 'map', 'duration', 'civ', 'team', 'result'))
+MATCH_PLAYER_TEMPLATE = ElementTemplate('{jabber:iq:profile}player', ('name', 'civ', 'team'))
+
+
+class BoardList(object):
+    """Definition of the custom boardlist and ratinglist stanza extension."""
 
     name = 'query'
     namespace = 'jabber:iq:boardlist'
-    interfaces = {'board', 'command'}
+    interfaces = {'board', 'command', 'limit', 'cursor', 'position'}
     sub_interfaces = interfaces
     plugin_attrib = 'boardlist'
 
@@ -34,7 +107,7 @@ class BoardListXmppPlugin(ElementBase):
         Arguments:
             command (str): Command to add
         """
-        self.xml.append(ET.fromstring('<command>%s</command>' % command))
+        self.xml.append(make_text_element('{%s}command' % self.namespace, command))
 
     def add_item(self, name, rating):
         """Add an item to the extension.
@@ -43,11 +116,21 @@ class BoardListXmppPlugin(ElementBase):
             name (str): Name of the player to add
             rating (int): Rating of the player to add
         """
-        self.xml.append(ET.Element('board', {'name': name, 'rating': str(rating)}))
+        self.xml.append(BOARD_TEMPLATE.make(name, rating))
 
+    def add_items(self, items):
+        """Add multiple items to the extension.
+
+        Arguments:
+            items (iterable): Tuples of name and rating of the
+                players to add
+        """
+        make = BOARD_TEMPLATE.make
+        self.xml.extend([make(name, rating) for name, rating in items])
 
-class GameListXmppPlugin(ElementBase):
-    """Class for custom gamelist stanza extension."""
+
+class GameList(object):
+    """Definition of the custom gamelist stanza extension."""
 
     name = 'query'
     namespace = 'jabber:iq:gamelist'
@@ -61,7 +144,26 @@ class GameListXmppPlugin(ElementBase):
         Arguments:
             data (dict): game data to add
         """
-        self.xml.append(ET.Element('game', data))
+        self.xml.append(ET.Element('{%s}game' % self.namespace, data))
+
+    def add_items(self, games):
+        """Add multiple games to the extension.
+
+        Arguments:
+            games (iterable): dicts with the data of the games to add
+        """
+        tag = '{%s}game' % self.namespace
+        self.xml.extend([ET.Element(tag, data) for data in games])
+
+    def add_elements(self, elements):
+        """Add multiple prebuilt game elements to the extension.
+
+        Arguments:
+            elements (iterable): xml.etree.ElementTree.Element
+                objects with the tag `game` in the namespace of this
+                extension
+        """
+        self.xml.extend(elements)
 
     def get_game(self):
         """Get game from stanza.
@@ -81,8 +183,8 @@ class GameListXmppPlugin(ElementBase):
         return data
 
 
-class GameReportXmppPlugin(ElementBase):
-    """Class for custom gamereport stanza extension."""
+class GameReport(object):
+    """Definition of the custom gamereport stanza extension."""
 
     name = 'report'
     namespace = 'jabber:iq:gamereport'
@@ -94,10 +196,17 @@ class GameReportXmppPlugin(ElementBase):
         """Add a game to the extension.
 
         Arguments:
-            game_report (dict): a report about a game
+            game_report (GameReport or dict): a report about a game,
+                either as stanza or as dict with the attributes of the
+                report
 
         """
-        self.xml.append(ET.fromstring(str(game_report)).find('{%s}game' % self.namespace))
+        if isinstance(game_report, dict):
+            self.xml.append(ET.Element('{%s}game' % self.namespace, game_report))
+        else:
+            game = game_report.xml.find('{%s}game' % self.namespace)
+            if game is not None:
+                self.xml.append(deepcopy(game))
 
     def get_game(self):
         """Get game from stanza.
@@ -117,12 +226,12 @@ class GameReportXmppPlugin(ElementBase):
         return data
 
 
-class ProfileXmppPlugin(ElementBase):
-    """Class for custom profile."""
+class Profile(object):
+    """Definition of the custom profile stanza extension."""
 
     name = 'query'
     namespace = 'jabber:iq:profile'
-    interfaces = {'profile', 'command'}
+    interfaces = {'profile', 'command', 'history', 'cursor'}
     sub_interfaces = interfaces
     plugin_attrib = 'profile'
 
@@ -133,7 +242,7 @@ class ProfileXmppPlugin(ElementBase):
             player_nick (str): the nick of the player the profile is about
 
         """
-        self.xml.append(ET.fromstring('<command>%s</command>' % player_nick))
+        self.xml.append(make_text_element('{%s}command' % self.namespace, player_nick))
 
     def add_item(self, player, rating, highest_rating=0,  # pylint: disable=too-many-arguments
                  rank=0, total_games_played=0, wins=0, losses=0):
@@ -149,8 +258,99 @@ class ProfileXmppPlugin(ElementBase):
             wins (int): Number of won games the player had
             losses (int): Number of lost games the player had
         """
-        item_xml = ET.Element('profile', {'player': player, 'rating': str(rating),
-                                          'highestRating': str(highest_rating), 'rank': str(rank),
-                                          'totalGamesPlayed': str(total_games_played),
-                                          'wins': str(wins), 'losses': str(losses)})
-        self.xml.append(item_xml)
+        self.xml.append(PROFILE_TEMPLATE.make(player, rating, highest_rating, rank,
+                                              total_games_played, wins, losses))
+
+    def add_games(self, games):
+        """Add games of the match history of a player to the extension.
+
+        Arguments:
+            games (iterable): dicts with the id, map, duration, civ,
+                team, result and ratingChange of the player in each
+                game and tuples of name, civ and team of the other
+                players in `players`. Rating changes which are None
+                get omitted.
+        """
+        make_player = MATCH_PLAYER_TEMPLATE.make
+        for game in games:
+            element = MATCH_TEMPLATE.make(game['id'], game['map'], game['duration'],
+                                          game['civ'], game['team'], game['result'])
+            if game['ratingChange'] is not None:
+                element.set('ratingChange', str(game['ratingChange']))
+            element.extend([make_player(*player) for player in game['players']])
+            self.xml.append(element)
+
+    def get_games(self):
+        """Get the games of the match history in the extension.
+
+        Returns:
+            list of dicts with the attributes of each game and a list
+            of dicts with the attributes of the other players in
+            `players`
+
+        """
+        games = []
+        for element in self.xml.findall('{%s}game' % self.namespace):
+            game = dict(element.items())
+            game['players'] = [dict(player.items()) for player in
+                               element.findall('{%s}player' % self.namespace)]
+            games.append(game)
+        return games
+
+
+class Stats(object):
+    """Definition of the custom civilization statistics stanza extension."""
+
+    name = 'query'
+    namespace = 'jabber:iq:stats'
+    interfaces = {'command', 'map', 'player', 'favouriteCiv'}
+    sub_interfaces = interfaces
+    plugin_attrib = 'stats'
+
+    def add_command(self, command):
+        """Add a command to the extension.
+
+        Arguments:
+            command (str): Command to add
+        """
+        self.xml.append(make_text_element('{%s}command' % self.namespace, command))
+
+    def add_items(self, items):
+        """Add the statistics of multiple civilizations to the extension.
+
+        Arguments:
+            items (iterable): Tuples of name, number of games and
+                number of wins of the civilizations to add
+        """
+        make = CIV_STATS_TEMPLATE.make
+        self.xml.extend([make(civ, games, wins) for civ, games, wins in items])
+
+    def get_items(self):
+        """Get the statistics of all civilizations in the extension.
+
+        Returns:
+            list of dicts with the name, number of games and number of
+            wins of each civilization
+
+        """
+        return [dict(civ.items()) for civ in self.xml.findall('{%s}civ' % self.namespace)]
+
+
+class BoardListXmppPlugin(BoardList, ElementBase):
+    """Class for custom boardlist and ratinglist stanza extension."""
+
+
+class GameListXmppPlugin(GameList, ElementBase):
+    """Class for custom gamelist stanza extension."""
+
+
+class GameReportXmppPlugin(GameReport, ElementBase):
+    """Class for custom gamereport stanza extension."""
+
+
+class ProfileXmppPlugin(Profile, ElementBase):
+    """Class for custom profile."""
+
+
+class StatsXmppPlugin(Stats, ElementBase):
+    """Class for custom civilization statistics stanza extension."""
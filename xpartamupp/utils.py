@@ -16,6 +16,8 @@
 
 """Collection of utility functions used by the XMPP-bots."""
 
+import threading
+import time
 from collections import OrderedDict
 
 
@@ -46,3 +48,121 @@ class LimitedSizeDict(OrderedDict):
         if self.size_limit:
             while len(self) > self.size_limit:
                 self.popitem(last=False)
+
+
+class TokenBucketLimiter(object):
+    """Rate limiter with a token bucket per key.
+
+    Every request takes a token from the bucket of its key. Buckets
+    refill at a constant rate up to their capacity, which allows short
+    bursts of requests. To keep the memory usage bounded, only the
+    buckets of the most recently seen keys are kept. Buckets of
+    evicted keys start full again.
+    """
+
+    def __init__(self, rate, burst, size_limit=2**14, clock=time.monotonic):
+        """Initialize the rate limiter.
+
+        Arguments:
+            rate (float): Number of tokens added to a bucket per second
+            burst (int): Capacity of a bucket
+            size_limit (int): Maximum number of buckets to keep
+            clock (callable): Function returning the current time in
+                seconds
+
+        """
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.buckets = LimitedSizeDict(size_limit=size_limit)
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        """Take a token from the bucket of a key, if there is one.
+
+        Arguments:
+            key (hashable): Key identifying the bucket
+
+        Returns:
+            True if the request is allowed, False if the bucket of the
+            key is empty
+
+        """
+        now = self.clock()
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+        return allowed
+
+
+class _Call(object):
+    """State of a call in progress of `SingleFlight`."""
+
+    def __init__(self):
+        """Initialize the call."""
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls for the same key into a single call.
+
+    While a call for a key is in progress, other threads requesting
+    the same key wait for that call to finish and get its result,
+    instead of doing the same work again. The result isn't stored
+    beyond the duration of the call.
+    """
+
+    def __init__(self):
+        """Initialize the coalescing of calls."""
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Call a function unless a call for the same key is running.
+
+        Arguments:
+            key (hashable): Key identifying calls with the same result
+            func (callable): Function to call
+            args: Positional arguments to call the function with
+            kwargs: Keyword arguments to call the function with
+
+        Returns:
+            tuple of the result of the function and whether the
+            result got shared from a call of another thread
+
+        Raises:
+            Exception: the exception raised by the function, also if
+                it got raised in another thread
+
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            shared = call is not None
+            if shared:
+                call.waiters += 1
+            else:
+                call = self.calls[key] = _Call()
+
+        if shared:
+            call.done.wait()
+            if call.exception:
+                raise call.exception
+            return call.result, True
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as exc:
+            call.exception = exc
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
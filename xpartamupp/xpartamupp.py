@@ -19,26 +19,296 @@
 """0ad XMPP-bot responsible for managing game listings."""
 
 import argparse
+import heapq
+import json
 import logging
+import os
+import tempfile
 import time
 import sys
+from collections import defaultdict
+from collections.abc import Mapping
+from itertools import count
 
 import sleekxmpp
 from sleekxmpp.stanza import Iq
+from sleekxmpp.xmlstream import ET
 from sleekxmpp.xmlstream.handler import Callback
 from sleekxmpp.xmlstream.matcher import StanzaPath
 from sleekxmpp.xmlstream.stanzabase import register_stanza_plugin
 
+from xpartamupp.diagnostics import (CPU_PROFILE_DURATION, Diagnostics,
+                                    parse_cpu_profile_duration)
+from xpartamupp.metrics import (BROADCAST_DURATION, BROADCAST_ITEMS, BROADCAST_RECIPIENTS,
+                                RATE_LIMITED_REQUESTS, REGISTRY, instrument_handler,
+                                register_queue_gauges, start_metrics_server)
 from xpartamupp.stanzas import GameListXmppPlugin
-from xpartamupp.utils import LimitedSizeDict
+from xpartamupp.utils import TokenBucketLimiter
+
+
+# Attributes of games which get indexed, so the game list can be
+# queried for games with specific values of them without scanning all
+# games.
+INDEXED_GAME_ATTRIBUTES = ('state', 'mapName', 'mapType', 'victoryCondition')
+
+# Pseudo attribute for game list queries to only get games with at
+# least the given number of free player slots.
+FREE_SLOTS_FILTER = 'freeSlots'
+
+# Number of outdated entries the expiry queue of games may contain in
+# addition to two entries per game, before it gets rebuilt.
+EXPIRY_QUEUE_SLACK = 2**6
+
+# Default number of bytes the games of a single room may use, before
+# the games whose hosts were seen least recently get removed.
+GAMES_MEMORY_LIMIT = 2**26
+
+# Estimated number of bytes used by a game record and its entries in
+# the data structures of `Games`, excluding its attribute values.
+GAME_RECORD_OVERHEAD = 2**9
+
+# Names of the attributes of games sent by 0ad or added by the bot.
+# Only layouts consisting of these get shared and only these names get
+# interned, so clients sending arbitrary attributes can't grow the
+# shared structures without bound.
+KNOWN_GAME_ATTRIBUTES = frozenset({
+    'name', 'hostUsername', 'ip', 'port', 'stunIP', 'stunPort', 'hasPassword', 'mapName',
+    'niceMapName', 'mapSize', 'mapType', 'victoryCondition', 'nbp', 'maxnbp', 'players',
+    'mods', 'state', 'startTime',
+})
+
+# Attributes with the value of another attribute at the time the game
+# got added. They're derived instead of stored, as they only differ
+# once a game started.
+INITIAL_GAME_ATTRIBUTES = (('players-init', 'players'), ('nbp-init', 'nbp'))
+
+GAME_ELEMENT_TAG = '{%s}game' % GameListXmppPlugin.namespace
+
+EXPIRED_GAMES = REGISTRY.counter('xpartamupp_expired_games_total',
+                                 "Number of games removed due to inactivity of their hosts")
+EVICTED_GAMES = REGISTRY.counter('xpartamupp_evicted_games_total',
+                                 "Number of games removed due to the memory limit")
+
+
+class GameLayout(object):
+    """Names and positions of the attributes of game records.
+
+    Most games have the same set of attributes, so all records with
+    the same known attribute names share a single layout.
+    """
+
+    __slots__ = ('names', 'positions')
+
+    _layouts = {}
+
+    def __init__(self, names):
+        """Initialize the layout.
+
+        Arguments:
+            names (tuple): Names of the attributes
+
+        """
+        self.names = names
+        self.positions = {name: position for position, name in enumerate(names)}
+
+    @classmethod
+    def get(cls, names):
+        """Get the shared layout for the given attribute names.
+
+        Arguments:
+            names (iterable): Names of the attributes
+
+        Returns:
+            GameLayout for the attribute names, which is only shared
+            if all names are in `KNOWN_GAME_ATTRIBUTES`
+
+        """
+        names = tuple(names)
+        if not KNOWN_GAME_ATTRIBUTES.issuperset(names):
+            return cls(names)
+        names = tuple(sys.intern(name) for name in names)
+        layout = cls._layouts.get(names)
+        if layout is None:
+            layout = cls._layouts.setdefault(names, cls(names))
+        return layout
+
+
+class GameRecord(Mapping):
+    """Compact, read-only mapping of the attributes of a game.
+
+    Values are stored in a tuple, with the names of the attributes in
+    a layout shared by most games. The attributes in
+    `INITIAL_GAME_ATTRIBUTES` are derived from the current values,
+    until these change for the first time. The XML element sent to
+    clients gets built once and is reused until the game changes.
+    """
+
+    __slots__ = ('layout', 'values', 'initial', '_element')
+
+    def __init__(self, attributes):
+        """Initialize the record.
+
+        Arguments:
+            attributes (dict): Attributes of the game, including the
+                initial attributes only if they differ from the
+                current values, like for games restored from a snapshot
+
+        """
+        attributes = dict(attributes)
+        initial = tuple(attributes.pop(name, attributes.get(source))
+                        for name, source in INITIAL_GAME_ATTRIBUTES)
+        self.layout = GameLayout.get(attributes)
+        self.values = tuple(attributes[name] for name in self.layout.names)
+        self.initial = None
+        if initial != self._get_current_initial():
+            self.initial = initial
+        self._element = None
+
+    def _get_current_initial(self):
+        """Get the current values of the initial attributes."""
+        return tuple(self._get_value(source) for _, source in INITIAL_GAME_ATTRIBUTES)
+
+    def _get_value(self, name):
+        """Get the stored value of an attribute or None."""
+        position = self.layout.positions.get(name)
+        return None if position is None else self.values[position]
+
+    def _get_initial(self):
+        """Get the names and values of the initial attributes set."""
+        initial = self.initial or self._get_current_initial()
+        return [(name, value) for (name, _), value in zip(INITIAL_GAME_ATTRIBUTES, initial)
+                if value is not None]
+
+    def __getitem__(self, name):
+        """Get the value of an attribute."""
+        position = self.layout.positions.get(name)
+        if position is not None:
+            return self.values[position]
+        for initial_name, value in self._get_initial():
+            if initial_name == name:
+                return value
+        raise KeyError(name)
+
+    def __iter__(self):
+        """Iterate over the names of the attributes."""
+        yield from self.layout.names
+        for name, _ in self._get_initial():
+            yield name
+
+    def __len__(self):
+        """Get the number of attributes."""
+        return len(self.values) + len(self._get_initial())
+
+    def __repr__(self):
+        """Represent the record like a dict of its attributes."""
+        return '%s(%r)' % (self.__class__.__name__, dict(self))
+
+    def update(self, changes):
+        """Change attributes of the game.
+
+        Arguments:
+            changes (dict): New values of attributes to change or add
+
+        """
+        if self.initial is None:
+            self.initial = self._get_current_initial()
+        attributes = dict(zip(self.layout.names, self.values))
+        attributes.update(changes)
+        self.layout = GameLayout.get(attributes)
+        self.values = tuple(attributes[name] for name in self.layout.names)
+        if self.initial == self._get_current_initial():
+            self.initial = None
+        self._element = None
+
+    def get_element(self):
+        """Get the XML element representing the game.
+
+        Returns:
+            xml.etree.ElementTree.Element with the attributes of the
+            game, which must not be modified
+
+        """
+        if self._element is None:
+            self._element = ET.Element(GAME_ELEMENT_TAG, dict(self))
+        return self._element
+
+    def get_size(self):
+        """Estimate the number of bytes used by the game.
+
+        Values shared with other games are counted for every game, so
+        this is an upper bound.
+
+        Returns:
+            Estimated number of bytes
+
+        """
+        values = self.values + (self.initial or ())
+        return GAME_RECORD_OVERHEAD + sum(len(value) for value in values
+                                          if isinstance(value, str))
 
 
 class Games(object):
-    """Class to tracks all games in the lobby."""
+    """Class to tracks all games in the lobby.
+
+    In addition to the games themselves, indexes from the values of
+    the attributes in `INDEXED_GAME_ATTRIBUTES` to the JIDs of the
+    games having these values are maintained.
+
+    The time their hosts were last seen is tracked for all games as
+    well. A min-heap ordered by that time allows finding stale games
+    without checking all games. Instead of updating entries in place,
+    new entries get pushed whenever a host is seen and outdated
+    entries get skipped when popped.
+
+    To bound the memory used, the games whose hosts were seen least
+    recently get removed once the estimated size of all games exceeds
+    the memory limit.
+    """
+
+    def __init__(self, memory_limit=GAMES_MEMORY_LIMIT):
+        """Initialize with empty games.
+
+        Arguments:
+            memory_limit (int): Number of bytes the games may use
+
+        """
+        self.games = {}
+        self.memory_limit = memory_limit
+        self.memory_used = 0
+        self.indexes = {attribute: defaultdict(set) for attribute in INDEXED_GAME_ATTRIBUTES}
+        self.last_seen = {}
+        self.expiry_queue = []
+        self._sequence = count()
+
+    def _index(self, jid, game):
+        """Add a game to the indexes.
+
+        Arguments:
+            jid (sleekxmpp.jid.JID): JID of the player who started the
+                game
+            game (GameRecord): the game
 
-    def __init__(self):
-        """Initialize with empty games."""
-        self.games = LimitedSizeDict(size_limit=2**7)
+        """
+        for attribute, index in self.indexes.items():
+            if attribute in game:
+                index[game[attribute]].add(jid)
+
+    def _unindex(self, jid, game):
+        """Remove a game from the indexes.
+
+        Arguments:
+            jid (sleekxmpp.jid.JID): JID of the player who started the
+                game
+            game (GameRecord): the game as it got indexed
+
+        """
+        for attribute, index in self.indexes.items():
+            jids = index.get(game.get(attribute))
+            if jids is None:
+                continue
+            jids.discard(jid)
+            if not jids:
+                del index[game[attribute]]
 
     def add_game(self, jid, data):
         """Add a game.
@@ -52,16 +322,114 @@ class Games(object):
             True if adding the game succeeded, False if not
 
         """
-        try:
-            data['players-init'] = data['players']
-            data['nbp-init'] = data['nbp']
-            data['state'] = 'init'
-        except (KeyError, TypeError, ValueError):
+        if not isinstance(data, dict) or 'players' not in data or 'nbp' not in data:
             logging.warning("Received invalid data for add game from 0ad: %s", data)
             return False
-        else:
-            self.games[jid] = data
-            return True
+
+        for name, _ in INITIAL_GAME_ATTRIBUTES:
+            data.pop(name, None)
+        data['state'] = 'init'
+        self._store_game(jid, GameRecord(data))
+        return True
+
+    def restore_game(self, jid, data):
+        """Add a game with the information tracked about it before.
+
+        Unlike `add_game()` the state of the game is kept, so this is
+        suitable for games restored from a snapshot.
+
+        Arguments:
+            jid (sleekxmpp.jid.JID): JID of the player who started the
+                game
+            data (dict): information about the game
+
+        """
+        self._store_game(jid, GameRecord(data))
+
+    def _store_game(self, jid, game):
+        """Store a game and add it to the indexes.
+
+        If the games exceed the memory limit afterwards, the games
+        whose hosts were seen least recently get removed.
+
+        Arguments:
+            jid (sleekxmpp.jid.JID): JID of the player who started the
+                game
+            game (GameRecord): the game
+
+        """
+        previous = self.games.get(jid)
+        if previous is not None:
+            self._unindex(jid, previous)
+            self.memory_used -= previous.get_size()
+        self.games[jid] = game
+        self.memory_used += game.get_size()
+        self._index(jid, game)
+        self._mark_seen(jid)
+        self._enforce_memory_limit()
+
+    def _enforce_memory_limit(self):
+        """Remove games until the memory limit isn't exceeded anymore."""
+        while self.memory_used > self.memory_limit and len(self.games) > 1:
+            while True:
+                seen, _, jid = heapq.heappop(self.expiry_queue)
+                if self.last_seen.get(jid) == seen:
+                    break
+            logging.warning("Removing game of %s to stay within the memory limit", jid)
+            EVICTED_GAMES.inc()
+            self.remove_game(jid)
+
+    def _mark_seen(self, jid):
+        """Remember that the host of a game has just been seen.
+
+        Arguments:
+            jid (sleekxmpp.jid.JID): JID of the player who started the
+                game
+
+        """
+        now = time.time()
+        self.last_seen[jid] = now
+        heapq.heappush(self.expiry_queue, (now, next(self._sequence), jid))
+        if len(self.expiry_queue) > 2 * len(self.last_seen) + EXPIRY_QUEUE_SLACK:
+            self.expiry_queue = [(seen, next(self._sequence), game_jid)
+                                 for game_jid, seen in self.last_seen.items()]
+            heapq.heapify(self.expiry_queue)
+
+    def touch(self, jid):
+        """Refresh the time the host of a game was last seen.
+
+        Arguments:
+            jid (sleekxmpp.jid.JID): JID of the player who might host
+                a game
+
+        Returns:
+            True if the player hosts a game, False if not
+
+        """
+        if jid not in self.games:
+            return False
+        self._mark_seen(jid)
+        return True
+
+    def expire_games(self, max_age):
+        """Remove all games whose hosts weren't seen for a while.
+
+        Arguments:
+            max_age (float): Number of seconds after which a game
+                without activity of its host is considered stale
+
+        Returns:
+            list with the JIDs of the removed games
+
+        """
+        cutoff = time.time() - max_age
+        expired = []
+        while self.expiry_queue and self.expiry_queue[0][0] < cutoff:
+            seen, _, jid = heapq.heappop(self.expiry_queue)
+            if self.last_seen.get(jid) == seen:
+                self.remove_game(jid)
+                expired.append(jid)
+        return expired
 
     def remove_game(self, jid):
         """Remove a game attached to a JID.
@@ -75,23 +443,87 @@ class Games(object):
 
         """
         try:
-            del self.games[jid]
+            game = self.games.pop(jid)
         except KeyError:
             logging.warning("Game for jid %s didn't exist", jid)
             return False
         else:
+            self._unindex(jid, game)
+            self.memory_used -= game.get_size()
+            del self.last_seen[jid]
             return True
 
     def get_all_games(self):
         """Return all games.
 
         Returns:
-            dict containing all games with the JID of the player who
-            started the game as key.
+            dict containing all games as GameRecord with the JID of
+            the player who started the game as key.
 
         """
         return self.games
 
+    def get_games(self, filters):
+        """Return the games matching all filters.
+
+        Filters on indexed attributes get resolved using the indexes,
+        all other filters get checked for the remaining games only.
+
+        Arguments:
+            filters (dict): Values the attributes of the games have to
+                be equal to. The value of `FREE_SLOTS_FILTER` is the
+                minimum number of free player slots instead.
+
+        Returns:
+            dict containing the matching games as GameRecord with the
+            JID of the player who started the game as key.
+
+        Raises:
+            ValueError: if the number of free slots isn't an integer
+
+        """
+        filters = dict(filters)
+        free_slots = filters.pop(FREE_SLOTS_FILTER, None)
+        if free_slots is not None:
+            free_slots = int(free_slots)
+
+        jids = None
+        for attribute in INDEXED_GAME_ATTRIBUTES:
+            if attribute not in filters:
+                continue
+            matching = self.indexes[attribute].get(filters.pop(attribute), set())
+            jids = matching if jids is None else jids & matching
+            if not jids:
+                return {}
+
+        candidates = self.games.items() if jids is None else \
+            ((jid, self.games[jid]) for jid in jids)
+        games = {}
+        for jid, game in candidates:
+            if any(game.get(attribute) != value for attribute, value in filters.items()):
+                continue
+            if free_slots is not None and self._get_free_slots(game) < free_slots:
+                continue
+            games[jid] = game
+        return games
+
+    @staticmethod
+    def _get_free_slots(game):
+        """Get the number of free player slots of a game.
+
+        Arguments:
+            game (GameRecord): the game
+
+        Returns:
+            Number of free player slots, 0 if the game doesn't contain
+            valid information about its slots
+
+        """
+        try:
+            return int(game['maxnbp']) - int(game['nbp'])
+        except (KeyError, ValueError):
+            return 0
+
     def change_game_state(self, jid, data):
         """Switch game state between running and waiting.
 
@@ -104,61 +536,292 @@ class Games(object):
             True if changing the game state succeeded, False if not
 
         """
-        if jid not in self.games:
+        game = self.games.get(jid)
+        if game is None:
             logging.warning("Tried to change state for non-existent game %s", jid)
             return False
 
         try:
-            if self.games[jid]['nbp-init'] > data['nbp']:
-                logging.debug("change game (%s) state from %s to %s", jid,
-                              self.games[jid]['state'], 'waiting')
-                self.games[jid]['state'] = 'waiting'
-            else:
-                logging.debug("change game (%s) state from %s to %s", jid,
-                              self.games[jid]['state'], 'running')
-                self.games[jid]['state'] = 'running'
-            self.games[jid]['nbp'] = data['nbp']
-            self.games[jid]['players'] = data['players']
+            state = 'waiting' if game['nbp-init'] > data['nbp'] else 'running'
+            changes = {'state': state, 'nbp': data['nbp'], 'players': data['players']}
         except (KeyError, ValueError):
             logging.warning("Received invalid data for change game state from 0ad: %s", data)
             return False
-        else:
-            if 'startTime' not in self.games[jid]:
-                self.games[jid]['startTime'] = str(round(time.time()))
-            return True
+
+        logging.debug("change game (%s) state from %s to %s", jid, game['state'], state)
+        if 'startTime' not in game:
+            changes['startTime'] = str(round(time.time()))
+
+        self._unindex(jid, game)
+        self.memory_used -= game.get_size()
+        game.update(changes)
+        self.memory_used += game.get_size()
+        self._index(jid, game)
+        return True
+
+
+class GameSnapshot(object):
+    """Snapshot of the games of all rooms stored in a file.
+
+    Snapshots get written to a temporary file first, which then
+    replaces the previous snapshot, so a crash while writing never
+    leaves a truncated snapshot behind.
+    """
+
+    def __init__(self, path):
+        """Initialize the snapshot.
+
+        Arguments:
+            path (str): Path of the snapshot file
+
+        """
+        self.path = path
+
+    def save(self, games):
+        """Write the games of all rooms to the snapshot file.
+
+        Arguments:
+            games (dict): Games instances with the JID of their room as
+                key
+
+        """
+        snapshot = {'time': time.time(),
+                    'rooms': {room: {str(jid): dict(game)
+                                     for jid, game in list(room_games.get_all_games().items())}
+                              for room, room_games in games.items()}}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.games-', suffix='.tmp',
+                                         delete=False) as snapshot_file:
+            try:
+                json.dump(snapshot, snapshot_file)
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            except Exception:
+                os.unlink(snapshot_file.name)
+                raise
+        os.replace(snapshot_file.name, self.path)
+
+    def load(self):
+        """Read the games of all rooms from the snapshot file.
+
+        Returns:
+            dict with the JIDs of the rooms as keys and dicts with
+            the games of the room as values, in which the JIDs of the
+            hosts as strings are the keys. Empty if there is no
+            readable snapshot.
+
+        """
+        try:
+            with open(self.path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logging.exception("Failed to read game snapshot from %s", self.path)
+            return {}
+
+        logging.info("Loaded game snapshot from %s taken %i seconds ago", self.path,
+                     time.time() - snapshot.get('time', 0))
+        return snapshot.get('rooms', {})
 
 
 class XpartaMuPP(sleekxmpp.ClientXMPP):
     """Main class which handles IQ data and sends new data."""
 
-    def __init__(self, sjid, password, room, nick):
+    def __init__(self, sjid, password, rooms, nick):
         """Initialize XpartaMuPP.
 
+        Each room has its own list of games, which only gets sent to
+        the occupants of that room.
+
         Arguments:
              sjid (sleekxmpp.jid.JID): JID to use for authentication
              password (str): password to use for authentication
-             room (str): XMPP MUC room to join
+             rooms (str, list): XMPP MUC room or list of rooms to
+                 join. Games of players who aren't known to be in any
+                 of the rooms get added to the first room.
              nick (str): Nick to use in MUC
 
         """
         sleekxmpp.ClientXMPP.__init__(self, sjid, password)
         self.whitespace_keepalive = False
 
-        self.room = room
+        self.rooms = [rooms] if isinstance(rooms, str) else list(rooms)
         self.nick = nick
 
-        self.games = Games()
+        self.games = {room: Games() for room in self.rooms}
+        self.player_rooms = {}
+        self.rate_limiters = {}
+        self.snapshot = None
+        self.unverified_rooms = set()
+        self.game_timeout = None
 
         register_stanza_plugin(Iq, GameListXmppPlugin)
 
         self.register_handler(Callback('Iq Gamelist', StanzaPath('iq@type=set/gamelist'),
                                        self._iq_game_list_handler))
+        self.register_handler(Callback('Iq Gamelist Query', StanzaPath('iq@type=get/gamelist'),
+                                       self._iq_game_list_query_handler))
 
         self.add_event_handler('session_start', self._session_start)
-        self.add_event_handler('muc::%s::got_online' % self.room, self._muc_online)
-        self.add_event_handler('muc::%s::got_offline' % self.room, self._muc_offline)
+        for room in self.rooms:
+            self.add_event_handler('muc::%s::got_online' % room, self._muc_online)
+            self.add_event_handler('muc::%s::got_offline' % room, self._muc_offline)
+            self.add_event_handler('muc::%s::presence' % room, self._muc_presence)
         self.add_event_handler('groupchat_message', self._muc_message)
 
+        REGISTRY.gauge('xpartamupp_games', "Number of games in the lobby",
+                       callback=lambda: sum(len(games.get_all_games())
+                                            for games in self.games.values()))
+        REGISTRY.gauge('xpartamupp_room_games', "Number of games per MUC room", ('room',),
+                       callback=lambda: {(room,): len(games.get_all_games())
+                                         for room, games in self.games.items()})
+        REGISTRY.gauge('xpartamupp_room_games_bytes',
+                       "Estimated number of bytes used by the games per MUC room", ('room',),
+                       callback=lambda: {(room,): games.memory_used
+                                         for room, games in self.games.items()})
+        REGISTRY.gauge('xpartamupp_occupants', "Number of occupants of the MUC rooms",
+                       callback=lambda: sum(len(self.plugin['xep_0045'].getRoster(room) or ())
+                                            for room in self.rooms))
+        register_queue_gauges(self)
+
+    def set_rate_limit(self, rate, burst):
+        """Limit the rate of IQ requests per JID.
+
+        Arguments:
+            rate (float): Number of requests per second and handler a
+                JID can send in the long run
+            burst (int): Number of requests per handler a JID can send
+                at once
+
+        """
+        self.rate_limiters = {handler: TokenBucketLimiter(rate, burst)
+                              for handler in ('gamelist', 'gamelist_query')}
+
+    def set_games_memory_limit(self, limit):
+        """Limit the memory used by the games of each room.
+
+        Arguments:
+            limit (int): Number of bytes the games of a room may use
+                before the games whose hosts were seen least recently
+                get removed
+
+        """
+        for games in self.games.values():
+            games.memory_limit = limit
+
+    def enable_snapshots(self, path, interval):
+        """Periodically save the games to a snapshot file.
+
+        The games of an existing snapshot get restored right away, so
+        they can be sent to players once the bot is connected again.
+        After a room got joined, restored games whose hosts aren't in
+        the room anymore get removed.
+
+        Arguments:
+            path (str): Path of the snapshot file
+            interval (float): Number of seconds between two snapshots
+
+        """
+        self.snapshot = GameSnapshot(path)
+        for room, games in self.snapshot.load().items():
+            if room not in self.games:
+                logging.info("Ignoring games of room %s from snapshot", room)
+                continue
+            for jid, data in games.items():
+                self.games[room].restore_game(sleekxmpp.jid.JID(jid), data)
+            self.unverified_rooms.add(room)
+            logging.info("Restored %i games of room %s", len(games), room)
+
+        self.schedule('Game snapshot', interval, self._save_snapshot, repeat=True)
+        self.add_event_handler('disconnected', self._save_snapshot)
+
+    def _save_snapshot(self, event=None):  # pylint: disable=unused-argument
+        """Save the games of all rooms to the snapshot file.
+
+        Arguments:
+            event (dict): empty dummy dict, if called as event handler
+
+        """
+        try:
+            self.snapshot.save(self.games)
+        except Exception:
+            logging.exception("Failed to save game snapshot to %s", self.snapshot.path)
+
+    def enable_game_expiry(self, timeout, interval):
+        """Periodically remove games whose hosts went silent.
+
+        Hosts which crash without leaving the room would otherwise
+        leave their games behind. Any IQ or presence of a host counts
+        as sign of life for its game.
+
+        Arguments:
+            timeout (float): Number of seconds without any sign of life
+                of the host after which a game gets removed
+            interval (float): Number of seconds between two checks for
+                stale games
+
+        """
+        self.game_timeout = timeout
+        self.schedule('Game expiry', interval, self._expire_games, repeat=True)
+
+    def _expire_games(self):
+        """Remove stale games and send one update per affected room."""
+        for room, games in self.games.items():
+            expired = games.expire_games(self.game_timeout)
+            if not expired:
+                continue
+
+            EXPIRED_GAMES.inc(len(expired))
+            logging.info("Removed %i stale games of room %s", len(expired), room)
+            try:
+                self._send_game_list(room)
+            except Exception:
+                logging.exception("Failed to send game list after removing stale games")
+
+    def _verify_restored_games(self, room):
+        """Remove restored games whose hosts aren't in the room anymore.
+
+        Arguments:
+            room (str): MUC room the bot has just joined
+
+        """
+        self.unverified_rooms.discard(room)
+        muc = self.plugin['xep_0045']
+        occupants = {str(muc.getJidProperty(room, nick, 'jid')) for nick in muc.getRoster(room)}
+        games = self.games[room]
+        stale = [jid for jid in games.get_all_games() if str(jid) not in occupants]
+        for jid in stale:
+            games.remove_game(jid)
+
+        logging.info("Removed %i restored games of room %s whose hosts left", len(stale), room)
+        if stale:
+            self._send_game_list(room)
+
+    def _is_rate_limited(self, handler, iq):
+        """Check whether an IQ request exceeds the rate limit.
+
+        Requests exceeding the rate limit get rejected with a
+        resource-constraint error.
+
+        Arguments:
+            handler (str): Name of the handler the request is for
+            iq (sleekxmpp.stanza.iq.IQ): Received IQ stanza
+
+        Returns:
+            True if the request exceeds the rate limit, False
+            otherwise
+
+        """
+        limiter = self.rate_limiters.get(handler)
+        if not limiter or limiter.allow(iq['from'].bare):
+            return False
+
+        logging.debug("Rate limited %s request from %s", handler, iq['from'])
+        RATE_LIMITED_REQUESTS.inc(handler=handler)
+        self._send_error(iq, 'resource-constraint', 'wait')
+        return True
+
     def _session_start(self, event):  # pylint: disable=unused-argument
         """Join MUC channel and announce presence.
 
@@ -166,7 +829,8 @@ class XpartaMuPP(sleekxmpp.ClientXMPP):
             event (dict): empty dummy dict
 
         """
-        self.plugin['xep_0045'].joinMUC(self.room, self.nick)
+        for room in self.rooms:
+            self.plugin['xep_0045'].joinMUC(room, self.nick)
         self.send_presence()
         self.get_roster()
         logging.info("XpartaMuPP started")
@@ -182,16 +846,22 @@ class XpartaMuPP(sleekxmpp.ClientXMPP):
                 presence stanza.
 
         """
+        room = str(presence['muc']['room'])
         nick = str(presence['muc']['nick'])
         jid = sleekxmpp.jid.JID(presence['muc']['jid'])
 
         if nick == self.nick:
+            # The own presence is the last one received when joining a
+            # room, so the roster is complete now.
+            if room in self.unverified_rooms:
+                self._verify_restored_games(room)
             return
 
         if jid.resource not in ['0ad', 'CC']:
             return
 
-        self._send_game_list(jid)
+        self.player_rooms[str(jid)] = room
+        self._send_game_list(room, jid)
 
         logging.debug("Client '%s' connected with a nick '%s'.", jid, nick)
 
@@ -206,17 +876,33 @@ class XpartaMuPP(sleekxmpp.ClientXMPP):
                 presence stanza.
 
         """
+        room = str(presence['muc']['room'])
         nick = str(presence['muc']['nick'])
         jid = sleekxmpp.jid.JID(presence['muc']['jid'])
 
         if nick == self.nick:
             return
 
-        if self.games.remove_game(jid):
-            self._send_game_list()
+        if self.player_rooms.get(str(jid)) == room:
+            del self.player_rooms[str(jid)]
+
+        if self.games[room].remove_game(jid):
+            self._send_game_list(room)
 
         logging.debug("Client '%s' with nick '%s' disconnected", jid, nick)
 
+    def _muc_presence(self, presence):
+        """Refresh the game of a player whose presence changed.
+
+        Arguments:
+            presence (sleekxmpp.stanza.presence.Presence): Received
+                presence stanza.
+
+        """
+        room = str(presence['muc']['room'])
+        if room in self.games and presence['type'] != 'unavailable':
+            self.games[room].touch(sleekxmpp.jid.JID(presence['muc']['jid']))
+
     def _muc_message(self, msg):
         """Process messages in the MUC room.
 
@@ -234,6 +920,7 @@ class XpartaMuPP(sleekxmpp.ClientXMPP):
                                     "just chilling.",
                               mtype='groupchat')
 
+    @instrument_handler('gamelist')
     def _iq_game_list_handler(self, iq):
         """Handle game state change requests.
 
@@ -244,51 +931,122 @@ class XpartaMuPP(sleekxmpp.ClientXMPP):
         if iq['from'].resource != '0ad':
             return
 
+        if self._is_rate_limited('gamelist', iq):
+            return
+
+        room = self.player_rooms.get(str(iq['from']), self.rooms[0])
+        games = self.games[room]
+        games.touch(iq['from'])
+
         command = iq['gamelist']['command']
         if command == 'register':
-            success = self.games.add_game(iq['from'], iq['gamelist']['game'])
+            success = games.add_game(iq['from'], iq['gamelist']['game'])
         elif command == 'unregister':
-            success = self.games.remove_game(iq['from'])
+            success = games.remove_game(iq['from'])
         elif command == 'changestate':
-            success = self.games.change_game_state(iq['from'], iq['gamelist']['game'])
+            success = games.change_game_state(iq['from'], iq['gamelist']['game'])
         else:
             logging.info('Received unknown game command: "%s"', command)
             return
 
         if success:
             try:
-                self._send_game_list()
+                self._send_game_list(room)
             except Exception:
                 logging.exception('Failed to send game list after "%s" command', command)
 
-    def _send_game_list(self, to=None):
-        """Send a massive stanza with the whole game list.
+    @instrument_handler('gamelist_query')
+    def _iq_game_list_query_handler(self, iq):
+        """Handle requests for the games matching a filter.
+
+        The attributes of the game element of the request are used as
+        filter, so clients only get the games they're interested in,
+        e.g. games which haven't started yet.
+
+        Arguments:
+            iq (sleekxmpp.stanza.iq.IQ): Received IQ stanza
+
+        """
+        if iq['from'].resource != '0ad':
+            return
+
+        if self._is_rate_limited('gamelist_query', iq):
+            return
+
+        command = iq['gamelist']['command']
+        if command != 'query':
+            logging.info('Received unknown game list query command: "%s"', command)
+            self._send_error(iq, 'bad-request')
+            return
+
+        room = self.player_rooms.get(str(iq['from']), self.rooms[0])
+        self.games[room].touch(iq['from'])
+        try:
+            games = self.games[room].get_games(iq['gamelist']['game'])
+        except ValueError:
+            logging.warning("Received invalid game list query from %s", iq['from'].bare)
+            self._send_error(iq, 'bad-request')
+            return
+
+        stanza = GameListXmppPlugin()
+        stanza.add_elements([game.get_element() for game in games.values()])
+        iq = iq.reply(clear=True)
+        iq.set_payload(stanza)
+        try:
+            iq.send(block=False)
+        except Exception:
+            logging.exception("Failed to send game list query result to %s", iq['to'])
+
+    def _send_error(self, iq, condition, error_type='modify'):
+        """Reply to an IQ stanza with an error.
+
+        Arguments:
+            iq (sleekxmpp.stanza.iq.IQ): IQ stanza to reply to
+            condition (str): Defined error condition to reply with
+            error_type (str): Type of the error
+
+        """
+        iq = iq.reply(clear=True).error()
+        iq['error']['type'] = error_type
+        iq['error']['condition'] = condition
+        try:
+            iq.send(block=False)
+        except Exception:
+            logging.exception("Failed to send error to %s", iq['to'])
+
+    def _send_game_list(self, room, to=None):
+        """Send a massive stanza with the whole game list of a room.
 
         If no target is passed the gamelist is broadcasted to all
-        clients.
+        clients in the room.
 
         Arguments:
+            room (str): MUC room to send the game list of
             to (sleekxmpp.jid.JID): Player to send the game list to.
                 If None, the game list will be broadcasted
         """
-        games = self.games.get_all_games()
+        games = self.games[room].get_all_games()
 
         stanza = GameListXmppPlugin()
-        for jid in games:
-            stanza.add_game(games[jid])
+        stanza.add_elements([game.get_element() for game in games.values()])
 
         if not to:
-            for nick in self.plugin['xep_0045'].getRoster(self.room):
-                if nick == self.nick:
-                    continue
-                jid_str = self.plugin['xep_0045'].getJidProperty(self.room, nick, 'jid')
-                jid = sleekxmpp.jid.JID(jid_str)
-                iq = self.make_iq_result(ito=jid)
-                iq.set_payload(stanza)
-                try:
-                    iq.send(block=False)
-                except Exception:
-                    logging.exception("Failed to send game list to %s", jid)
+            recipients = 0
+            with BROADCAST_DURATION.time(broadcast='gamelist'):
+                for nick in self.plugin['xep_0045'].getRoster(room):
+                    if nick == self.nick:
+                        continue
+                    jid_str = self.plugin['xep_0045'].getJidProperty(room, nick, 'jid')
+                    jid = sleekxmpp.jid.JID(jid_str)
+                    iq = self.make_iq_result(ito=jid)
+                    iq.set_payload(stanza)
+                    recipients += 1
+                    try:
+                        iq.send(block=False)
+                    except Exception:
+                        logging.exception("Failed to send game list to %s", jid)
+            BROADCAST_RECIPIENTS.observe(recipients, broadcast='gamelist')
+            BROADCAST_ITEMS.observe(len(games), broadcast='gamelist')
         else:
             iq = self.make_iq_result(ito=to)
             iq.set_payload(stanza)
@@ -325,7 +1083,42 @@ def parse_args(args):
     parser.add_argument('-l', '--login', help="username for login", default='xpartamupp')
     parser.add_argument('-p', '--password', help="password for login", default='XXXXXX')
     parser.add_argument('-n', '--nickname', help="nickname shown to players", default='WFGBot')
-    parser.add_argument('-r', '--room', help="XMPP MUC room to join", default='arena')
+    parser.add_argument('-r', '--room', default='arena',
+                        help="XMPP MUC room to join, multiple rooms can be given separated by "
+                             "commas")
+    parser.add_argument('--admin-jid', action='append', dest='admin_jids',
+                        help="JID allowed to trigger diagnostics via ad-hoc commands, can be "
+                             "given multiple times")
+    parser.add_argument('--diagnostics-dir', default='.',
+                        help="directory to write CPU profiles and memory snapshots to")
+    parser.add_argument('--cpu-profile-duration', type=parse_cpu_profile_duration,
+                        default=CPU_PROFILE_DURATION,
+                        help="duration in seconds of CPU profiles triggered by SIGUSR1 and the "
+                             "default for the ad-hoc command")
+    parser.add_argument('--metrics-port', type=int,
+                        help="port to expose metrics on via HTTP, disabled if not set")
+    parser.add_argument('--metrics-address', help="address to expose metrics on",
+                        default='127.0.0.1')
+    parser.add_argument('--rate-limit', type=float,
+                        help="number of requests per second a JID can send per request type in "
+                             "the long run, disabled if not set")
+    parser.add_argument('--rate-limit-burst', type=int, default=10,
+                        help="number of requests a JID can send at once per request type")
+    parser.add_argument('--runtime', choices=('threaded', 'asyncio'), default='threaded',
+                        help="runtime to handle stanzas with, asyncio requires slixmpp")
+    parser.add_argument('--snapshot-file',
+                        help="file to periodically save the games to and restore them from "
+                             "on startup, disabled if not set")
+    parser.add_argument('--snapshot-interval', type=float, default=30,
+                        help="number of seconds between two snapshots of the games")
+    parser.add_argument('--game-timeout', type=float,
+                        help="number of seconds without any IQ or presence of its host after "
+                             "which a game gets removed, disabled if not set")
+    parser.add_argument('--game-expiry-interval', type=float, default=60,
+                        help="number of seconds between two checks for stale games")
+    parser.add_argument('--games-memory-limit', type=int, default=GAMES_MEMORY_LIMIT // 2**20,
+                        help="number of MiB the games of a room may use before the games "
+                             "whose hosts were seen least recently get removed")
 
     return parser.parse_args(args)
 
@@ -338,14 +1131,43 @@ def main():
                         format='%(asctime)s %(levelname)-8s %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
 
-    xmpp = XpartaMuPP(sleekxmpp.jid.JID('%s@%s/%s' % (args.login, args.domain, 'CC')),
-                      args.password, args.room + '@conference.' + args.domain, args.nickname)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port, args.metrics_address)
+
+    if args.runtime == 'asyncio':
+        # slixmpp is only required for the asyncio runtime
+        from xpartamupp import async_bots  # pylint: disable=import-outside-toplevel
+        bot_class = async_bots.AsyncXpartaMuPP
+    else:
+        bot_class = XpartaMuPP
+
+    rooms = [room.strip() + '@conference.' + args.domain for room in args.room.split(',')]
+    xmpp = bot_class(sleekxmpp.jid.JID('%s@%s/%s' % (args.login, args.domain, 'CC')),
+                     args.password, rooms, args.nickname)
     xmpp.register_plugin('xep_0030')  # Service Discovery
     xmpp.register_plugin('xep_0004')  # Data Forms
     xmpp.register_plugin('xep_0045')  # Multi-User Chat
     xmpp.register_plugin('xep_0060')  # Publish-Subscribe
     xmpp.register_plugin('xep_0199', {'keepalive': True})  # XMPP Ping
 
+    if args.rate_limit:
+        xmpp.set_rate_limit(args.rate_limit, args.rate_limit_burst)
+
+    xmpp.set_games_memory_limit(args.games_memory_limit * 2**20)
+
+    if args.snapshot_file:
+        xmpp.enable_snapshots(args.snapshot_file, args.snapshot_interval)
+
+    if args.game_timeout:
+        xmpp.enable_game_expiry(args.game_timeout, args.game_expiry_interval)
+
+    diagnostics = Diagnostics(args.diagnostics_dir,
+                              cpu_profile_duration=args.cpu_profile_duration)
+    diagnostics.install_signal_handlers()
+    if args.admin_jids:
+        xmpp.register_plugin('xep_0050')  # Ad-Hoc Commands
+        diagnostics.register_commands(xmpp, args.admin_jids)
+
     if xmpp.connect():
         xmpp.process()
     else: